@@ -1,5 +1,7 @@
 import json
 import os
+from types import MappingProxyType
+from typing import NamedTuple
 
 
 try:
@@ -8,7 +10,8 @@ except NameError:
     SCRIPT_DIR = os.path.realpath(os.getcwd())
 
 
-def get_configuration():
+def load_configuration():
+    '''Parse `configuration.json' and fill in the defaults, without caching'''
     TICKET_IMAGE = 'ticket-image.png'
     CONFIGURATION_DEFAULTS = {
         'logdir': os.getenv('TEMP', SCRIPT_DIR),
@@ -19,6 +22,9 @@ def get_configuration():
         "full_payment_confirmation_template": '<p>Hi,</p><p>Thank you for your payment for <a href="%reservation_url%">your reservation</a>.</p><p>Greetings,<br>--&nbsp;<br>Signature</p>',
         "partial_payment_confirmation_template": '<p>Hi,</p><p>Thank you for your payment for <a href="%reservation_url%">your reservation</a>.</p><p>You can wire the remaining %remaining_amount_in_euro% € to %organizer_name% (%bank_account%, organizer_bic%) with the communication <pre>%formatted_bank_id%</pre>.</p><p>Greetings,<br>--&nbsp;<br>Signature</p>',
         'cgitb_display': 1,
+        'compression_level': 6,
+        'qr_cache_max_bytes': 4 * 1024 * 1024,
+        'csrf_secret': '', # empty: a random key is generated next to the database
         'info_email': 'nobody@example.com',
         'disabled': False,
         "main_starter_short": "TomMozz",
@@ -70,3 +76,70 @@ def get_configuration():
     for k, v in CONFIGURATION_DEFAULTS.items():
         configuration.setdefault(k, v)
     return configuration
+
+
+DISH_KEYS = ('main_starter', 'extra_starter', 'main_dish', 'extra_dish', 'third_dish',
+             'main_dessert', 'extra_dessert', 'kids_main_dish', 'kids_extra_dish', 'kids_third_dish')
+
+
+class Dish(NamedTuple):
+    name: str
+    name_plural: str
+    short: str
+    ticket: str
+    image: str
+
+
+def make_dishes(configuration):
+    '''Read-only table of the `Dish'es of `configuration' by `DISH_KEYS' '''
+    return MappingProxyType({
+        key: Dish(name=configuration[f'{key}_name'],
+                  name_plural=configuration[f'{key}_name_plural'],
+                  short=configuration[f'{key}_short'],
+                  ticket=configuration.get(f'{key}_ticket', configuration[f'{key}_name']),
+                  image=configuration[f'{key}_image'])
+        for key in DISH_KEYS})
+
+
+# (stamp of `configuration.json', read-only view of the merged configuration,
+#  its dishes table)
+_SNAPSHOT = None
+
+
+def _stamp():
+    try:
+        stat = os.stat(os.path.join(SCRIPT_DIR, 'configuration.json'))
+    except OSError:
+        file_stamp = None
+    else:
+        file_stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    # `TEMP' provides the default `logdir' and `dbdir'
+    return file_stamp, os.getenv('TEMP')
+
+
+def _snapshot():
+    global _SNAPSHOT
+    stamp = _stamp()
+    if _SNAPSHOT is None or _SNAPSHOT[0] != stamp:
+        configuration = load_configuration()
+        _SNAPSHOT = (stamp, MappingProxyType(configuration), make_dishes(configuration))
+    return _SNAPSHOT
+
+
+def get_configuration():
+    '''Merged configuration, shared by the whole process
+
+    `configuration.json' is parsed again only when a stat() of it shows that
+    it changed.  The result is a read-only mapping.'''
+    return _snapshot()[1]
+
+
+def get_dishes():
+    '''`make_dishes' of `get_configuration()', built once per parse'''
+    return _snapshot()[2]
+
+
+def forget_configuration():
+    '''Make the next `get_configuration' parse `configuration.json' again'''
+    global _SNAPSHOT
+    _SNAPSHOT = None
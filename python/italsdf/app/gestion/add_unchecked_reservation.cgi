@@ -4,8 +4,6 @@
 # After finding a way to make the CSRF check allow the script to proceed, test with
 #
 # echo | (script_name=add_unchecked_reservation.cgi && env SERVER_NAME=1.2.3.4 SCRIPT_NAME=$script_name REMOTE_USER=admin REQUEST_METHOD=POST 'QUERY_STRING=name=Qui+m%27appelle%3F&extraComment=02%2F123.45.67&places=1&insidemainstarter=1&insideextrastarter=0&insidemaindish=0&insideextradish=1&kidsmaindish=0&extradishkids=0&outsidemainstarter=0&outsideextrastarter=0&outsidemaindish=0&outsideextradish=0&outsidedessert=0&csrf_token=e0eb75317b2d4084b0aa3594a8545375&date=2023-04-23' python3 $script_name)
-import cgi
-import cgitb
 import os
 import sys
 
@@ -14,6 +12,7 @@ sys.path.append('..')
 
 import config
 from htmlgen import (
+    enable_cgitb,
     html_document,
     print_content_type,
     redirect_to_event,
@@ -45,7 +44,7 @@ if __name__ == '__main__':
         fail_add_unchecked_reservation()
     CONFIGURATION = config.get_configuration()
 
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
         if CONFIGURATION.get('disabled', False):
@@ -54,6 +53,7 @@ if __name__ == '__main__':
 
         db_connection = create_db(CONFIGURATION)
 
+        import cgi
         # Get form data
         form = cgi.FieldStorage()
         csrf_token = form.getfirst('csrf_token')
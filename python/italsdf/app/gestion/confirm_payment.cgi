@@ -5,8 +5,6 @@
 #
 # (cd app/gestion && env REQUEST_METHOD=GET REMOTE_USER=secretaire REMOTE_ADDR=1.2.3.4 SERVER_NAME=localhost SCRIPT_NAME=confirm_payment.cgi QUERY_STRING=uuid_hex=395e7b845afb4a71876360e0655138a7&src_id=2024-00071 python3 confirm_payment.cgi)
 
-import cgi
-import cgitb
 import os
 import sys
 import time
@@ -15,6 +13,8 @@ import time
 sys.path.append('..')
 import config
 from htmlgen import (
+    cgitb_handler,
+    enable_cgitb,
     print_content_type,
     redirect_to_event,
     respond_html,
@@ -37,9 +37,10 @@ if __name__ == '__main__':
     assert SCRIPT_NAME
 
     CONFIGURATION = config.get_configuration()
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
+        import cgi
         params = cgi.parse()
         connection = create_db(CONFIGURATION)
         form = cgi.FieldStorage()
@@ -81,8 +82,8 @@ if __name__ == '__main__':
                 SCRIPT_NAME,
                 REMOTE_USER,
                 REMOTE_ADDR)
-            respond_html(response)
+            respond_html(response, contains_secret=True)
     except Exception:
         if print_content_type('text/html; charset=utf-8'):
             print()
-        cgitb.handler()
+        cgitb_handler()
@@ -1,15 +1,17 @@
 #!/usr/pkg/bin/python3
 # -*- coding: utf-8 -*-
-import cgitb
-import csv
 import math
 import os
 import sys
+import urllib.parse
 
 # hack to get at my utilities:
 sys.path.append('..')
 import config
 from htmlgen import (
+    Response,
+    cgitb_handler,
+    enable_cgitb,
     print_content_type,
     redirect_to_event,
 )
@@ -22,23 +24,38 @@ from lib_export_csv import (
     write_column_header_rows,
 )
 
+# Last row of a CSV cut short by an error (the traceback is in the logs)
+INCOMPLETE_EXPORT_ROW = '"ERREUR: export incomplet, voir le journal du serveur"\r\n'
+
 if __name__ == '__main__':
     if os.getenv('REQUEST_METHOD') != 'GET' or os.getenv('REMOTE_USER') is None:
         redirect_to_event()
+    # Incremental export: only the reservations that changed since `since'
+    # (seconds since the epoch)
+    since = urllib.parse.parse_qs(os.getenv('QUERY_STRING', '')).get('since', [''])[0]
+    try:
+        changed_since = float(since) if since else None
+    except ValueError:
+        redirect_to_event()
+    if changed_since is not None and not math.isfinite(changed_since):
+        redirect_to_event()
 
     CONFIGURATION = config.get_configuration()
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
+    response = None
     try:
+        import csv
         connection = create_db(CONFIGURATION)
-        writer = csv.writer(sys.stdout, 'excel')
-        if print_content_type('text/csv; charset=utf-8'):
-            print()
+        response = Response('text/csv; charset=utf-8', streaming=True)
+        writer = csv.writer(response, 'excel')
         write_column_header_rows(writer)
-        for x in Reservation.select(connection,
-                                    order_columns=('ACTIVE', 'date', 'name')):
+        for x in Reservation.select_for_export(connection, changed_since):
             export_reservation(writer, connection, x)
+        response.finish()
     except Exception:
-        if print_content_type('text/html; charset=utf-8'):
-            print()
-        cgitb.handler()
+        # Part of the CSV may be sent already: no error page then
+        if response is None or not response.abort(CONFIGURATION['logdir'], trailer=INCOMPLETE_EXPORT_ROW):
+            if print_content_type('text/html; charset=utf-8'):
+                print()
+            cgitb_handler()
@@ -1,7 +1,5 @@
 #!/usr/pkg/bin/python3
 # -*- coding: utf-8 -*-
-import cgi
-import cgitb
 import os
 import sys
 
@@ -9,10 +7,12 @@ import sys
 sys.path.append('..')
 import config
 from htmlgen import (
+    enable_cgitb,
     html_document,
     pluriel_naif,
     print_content_type,
     redirect_to_event,
+    respond_bytes,
     respond_html,
 )
 from storage import (
@@ -20,10 +20,6 @@ from storage import (
     Reservation,
     create_db,
 )
-from create_tickets import (
-    create_full_ticket_list,
-    ul_for_menu_data,
-)
 
 
 def fail_generate_tickets():
@@ -43,6 +39,7 @@ def get_method(db_connection, configuration, user, ip):
      total_kids_third_dish,
      total_main_dessert,
      total_extra_dessert) = Reservation.count_menu_data(db_connection)
+    menu_data_by_date = Reservation.menu_data_by_date(db_connection)
     respond_html(html_document(
         'Impression des tickets pour la nourriture',
         (('p', 'Il y a ', pluriel_naif(active_reservations, 'réservation'), ':'),
@@ -50,6 +47,9 @@ def get_method(db_connection, configuration, user, ip):
                           total_main_dish, total_extra_dish, total_third_dish,
                           total_kids_main_dish, total_kids_extra_dish, total_kids_third_dish,
                           total_main_dessert, total_extra_dessert),
+         *((('p', 'Le ', date, ': ', pluriel_naif(menu_data[0], 'réservation')),
+            ul_for_menu_data(*menu_data[1:]))
+           for date, menu_data in (menu_data_by_date if len(menu_data_by_date) > 1 else ())),
          (('form', 'method', 'POST'),
           (('input', 'type', 'hidden', 'id', 'csrf_token', 'name', 'csrf_token', 'value', csrf_token.token),),
           (('label', 'for', 'main_starter'), configuration['main_starter_name'], ':'),
@@ -82,10 +82,15 @@ def get_method(db_connection, configuration, user, ip):
           (('label', 'for', 'extra_dessert'), configuration['extra_dessert_name'], ':'),
           (('input', 'type', 'number', 'id', 'extra_dessert', 'name', 'extra_dessert', 'value', str(total_extra_dessert), 'min', str(total_extra_dessert), 'max', '200'), ),
           ('br',),
-          (('input', 'type', 'submit', 'value', 'Générer les tickets pour impression'),)))))
+          *(((('input', 'type', 'checkbox', 'id', 'per_date', 'name', 'per_date', 'value', '1'),),
+             (('label', 'for', 'per_date'), 'Une feuille par date (archive zip)'),
+             ('br',))
+            if len(menu_data_by_date) > 1 else ()),
+          (('input', 'type', 'submit', 'value', 'Générer les tickets pour impression'),)))),
+        contains_secret=True)
 
 
-def post_method(db_connection, user, ip):
+def post_method(db_connection, configuration, user, ip):
     def safe_non_negative_int_less_or_equal_than_500(x):
         try:
             x = int(x)
@@ -93,6 +98,7 @@ def post_method(db_connection, user, ip):
         except Exception:
             return 0
 
+    import cgi
     # Get form data
     form = cgi.FieldStorage()
     csrf_token = form.getfirst('csrf_token')
@@ -115,30 +121,29 @@ def post_method(db_connection, user, ip):
     main_dessert = safe_non_negative_int_less_or_equal_than_500(form.getfirst('main_dessert', default=0))
     extra_dessert = safe_non_negative_int_less_or_equal_than_500(form.getfirst('extra_dessert', default=0))
 
-    if print_content_type('text/html; charset=utf-8'):
-        print('Content-Language: en')
-        print()
-
-    respond_html(html_document(
-        'Liste des tickets à imprimer',
-        create_full_ticket_list(
-            db_connection,
-            Reservation.select(
-                db_connection,
-                filtering=[('active', True)],
-                order_columns=['date', 'name', 'email']),
-            extra_starter=extra_starter,
-            main_starter=main_starter,
-            main_dish=main_dish,
-            extra_dish=extra_dish,
-            third_dish=third_dish,
-            kids_main_dish=kids_main_dish,
-            kids_extra_dish=kids_extra_dish,
-            kids_third_dish=kids_third_dish,
-            main_dessert=main_dessert,
-            extra_dessert=extra_dessert),
-        with_banner=False))
-
+    pools = {'extra_starter': extra_starter,
+             'main_starter': main_starter,
+             'main_dish': main_dish,
+             'extra_dish': extra_dish,
+             'third_dish': third_dish,
+             'kids_main_dish': kids_main_dish,
+             'kids_extra_dish': kids_extra_dish,
+             'kids_third_dish': kids_third_dish,
+             'main_dessert': main_dessert,
+             'extra_dessert': extra_dessert}
+    # Before anything is sent: the error page can still replace the sheet
+    check_ticket_pools(db_connection, pools)
+
+    if form.getfirst('per_date'):
+        # One sheet per date, rendered in parallel
+        respond_bytes(
+            'application/zip',
+            create_ticket_sheets(db_connection, configuration, pools),
+            headers=(('Content-Disposition', 'attachment; filename="tickets.zip"'),))
+        return
+
+    # The sheet is sent reservation by reservation
+    respond_full_ticket_list(db_connection, pools, logdir=configuration['logdir'])
 
 if __name__ == '__main__':
     try:
@@ -149,14 +154,16 @@ if __name__ == '__main__':
 
         CONFIGURATION = config.get_configuration()
 
-        cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+        enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+
+        from create_tickets import check_ticket_pools, create_ticket_sheets, respond_full_ticket_list, ul_for_menu_data
 
         db_connection = create_db(CONFIGURATION)
 
         if os.getenv('REQUEST_METHOD') == 'GET':
             get_method(db_connection, CONFIGURATION, remote_user, remote_addr)
         elif os.getenv('REQUEST_METHOD') == 'POST':
-            post_method(db_connection, remote_user, remote_addr)
+            post_method(db_connection, CONFIGURATION, remote_user, remote_addr)
         else:
             fail_generate_tickets()
     except Exception:
@@ -5,8 +5,6 @@
 #
 # (cd app/gestion && env REQUEST_METHOD=GET REMOTE_USER=secretaire REMOTE_ADDR=1.2.3.4 SERVER_NAME=localhost SCRIPT_NAME=list_payments.cgi python list_payments.cgi)
 
-import cgi
-import cgitb
 import itertools
 import os
 import sys
@@ -17,6 +15,9 @@ import urllib.parse
 sys.path.append('..')
 import config
 from htmlgen import (
+    cgitb_handler,
+    conditional_get,
+    enable_cgitb,
     html_document,
     print_content_type,
     redirect_to_event,
@@ -25,9 +26,13 @@ from htmlgen import (
 from storage import (
     Csrf,
     Payment,
+    Reservation,
     create_db,
+    data_version,
+    keyset_key_from_str,
+    keyset_key_to_str,
 )
-from lib_payments import get_list_payments_row
+from lib_payments import PaymentReconciliation, get_list_payments_row
 
 def update_sort_order(new_col_name: str, sort_order: list[str]) -> list[str]:
     if sort_order:
@@ -41,10 +46,12 @@ def update_sort_order(new_col_name: str, sort_order: list[str]) -> list[str]:
         return [new_col_name]
 
 
-def make_url(sort_order: list[str], limit: Optional[int], offset: Optional[int], show_active: bool, base_url: str) -> str:
+def make_url(sort_order: list[str], limit: Optional[int], offset: Optional[int], show_active: bool, base_url: str, after: Optional[list] = None, before: Optional[list] = None) -> str:
     params = list((k, v) for k, v in itertools.chain(
         (('limit', limit),
          ('offset', offset),
+         ('after', keyset_key_to_str(after)),
+         ('before', keyset_key_to_str(before)),
          ('show_active', 1 if show_active else 0)),
         (('sort_order', s) for s in sort_order))
                   if v is not None)
@@ -57,10 +64,10 @@ def make_url(sort_order: list[str], limit: Optional[int], offset: Optional[int],
         split_result.fragment))
 
 
-def make_navigation_a_elt(sort_order: list[str], limit: Optional[int], offset: Optional[int], show_active: bool, text: str, base_url: str) -> tuple[tuple[str, str, str, str, str], str]:
+def make_navigation_a_elt(sort_order: list[str], limit: Optional[int], offset: Optional[int], show_active: bool, text: str, base_url: str, after: Optional[list] = None, before: Optional[list] = None) -> tuple[tuple[str, str, str, str, str], str]:
     return (('a',
              'class', 'navigation',
-             'href', make_url(sort_order, limit, offset, show_active, base_url)),
+             'href', make_url(sort_order, limit, offset, show_active, base_url, after, before)),
             text)
 
 
@@ -89,7 +96,7 @@ if __name__ == '__main__':
         redirect_to_event()
 
     CONFIGURATION = config.get_configuration()
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
         script_name = os.getenv('SCRIPT_NAME')
@@ -98,12 +105,16 @@ if __name__ == '__main__':
         remote_addr = os.getenv('REMOTE_ADDR')
         assert script_name is not None and server_name is not None and remote_user is not None and remote_addr is not None
         base_url = urllib.parse.urljoin(f'https://{server_name}', script_name)
-        params = cgi.parse()
+        params = urllib.parse.parse_qs(os.getenv('QUERY_STRING', ''))
         sort_order = params.get('sort_order', ["SRC_ID"])
         try:
             limit = min(int(get_first(params, 'limit') or DEFAULT_LIMIT), MAX_LIMIT)
         except Exception:
             limit = DEFAULT_LIMIT
+        # With a sort key to seek to, `offset' is only the position of the
+        # page in the list.
+        after = keyset_key_from_str(get_first(params, 'after'), Payment.keyset_ordering(sort_order))
+        before = None if after is not None else keyset_key_from_str(get_first(params, 'before'), Payment.keyset_ordering(sort_order))
         try:
             offset = max(int(get_first(params, 'offset') or 0), 0)
         except Exception:
@@ -114,6 +125,11 @@ if __name__ == '__main__':
             show_active = True
         connection = create_db(CONFIGURATION)
         csrf_token = Csrf.get_by_user_and_ip(connection, remote_user, remote_addr)
+        # The lists are refreshed constantly on event night
+        versions, last_modified = data_version(connection, (Reservation, Payment))
+        validators = conditional_get(
+            (os.getenv('QUERY_STRING'), os.getenv('SCRIPT_NAME'), os.getenv('SERVER_NAME'), csrf_token.token, versions),
+            last_modified)
 
         COLUMNS = [('src_id', 'N° séquence'),
                    ('timestamp', 'Date exécution'),
@@ -127,19 +143,26 @@ if __name__ == '__main__':
             ('th', make_navigation_a_elt(update_sort_order(column, sort_order), limit, offset, show_active,
                                          header + sort_direction(column, sort_order), base_url))
             for column, header in COLUMNS) + (('th', 'Réservation'),)
-        payment_count = Payment.length(connection, filtering=[('active', True)] if show_active else None)
+        page = Payment.join_reservations_page(connection,
+                                              filtering=[('active', True)] if show_active else None,
+                                              order_columns=sort_order,
+                                              limit=limit,
+                                              after=after,
+                                              before=before,
+                                              offset=offset)
+        reconciliation = PaymentReconciliation(connection, page.items)
         pagination_links = tuple((
             x for x in
             [('li', make_navigation_a_elt(sort_order, limit, 0, show_active, 'Début', base_url))
-             if offset > 0
+             if page.has_previous
              else None,
              ('li',
-              make_navigation_a_elt(sort_order, limit, offset - limit, show_active, 'Précédent', base_url))
-             if offset > limit else
+              make_navigation_a_elt(sort_order, limit, max(offset - limit, 0), show_active, 'Précédent', base_url, before=page.first_key))
+             if page.has_previous and offset > limit else
              None,
              ('li',
-              make_navigation_a_elt(sort_order, limit, offset + limit, show_active, 'Suivant', base_url))
-             if offset + limit < payment_count else
+              make_navigation_a_elt(sort_order, limit, offset + limit, show_active, 'Suivant', base_url, after=page.last_key))
+             if page.has_next else
              None,
              ('li',
               make_navigation_a_elt(sort_order, limit, 0, not show_active, f'{"Inclure" if show_active else "Cacher"} paiements inintéressants', base_url))]
@@ -157,21 +180,23 @@ if __name__ == '__main__':
               (('input', 'type', 'submit', 'value', 'Rafraichir la page'),),
               *((('input', 'id', 'sort_order', 'name', 'sort_order', 'type', 'hidden', 'value', v),)
                 for v in sort_order),
-              (('input', 'id', 'offset', 'name', 'offset', 'type', 'hidden', 'value', str(offset)),)),
+              (('input', 'id', 'offset', 'name', 'offset', 'type', 'hidden', 'value', str(offset)),),
+              *((('input', 'id', name, 'name', name, 'type', 'hidden', 'value', keyset_key_to_str(key)),)
+                for name, key in (('after', after), ('before', before))
+                if key is not None)),
              (('ul', 'class', 'navbar'), *pagination_links) if pagination_links else '',
              (('table', 'class', 'list'),
               ('tr', *table_header_row),
-              *tuple(('tr', *get_list_payments_row(connection, pmnt, res, server_name, script_name, csrf_token.token))
-                     for pmnt, res in Payment.join_reservations(connection,
-                                                                filtering=[('active', True)] if show_active else None,
-                                                                order_columns=sort_order,
-                                                                limit=limit,
-                                                                offset=offset))),
+              *tuple(('tr', *get_list_payments_row(connection, pmnt, res, server_name, script_name, csrf_token.token, reconciliation))
+                     for pmnt, res in page.items)),
+             *reconciliation.page_elements(),
              ('hr',),
              ('ul',
               ('li', (('a', 'href', 'list_reservations.cgi'), 'Liste des réservations')),
-              ('li', (('a', 'href', 'generate_tickets.cgi'), 'Générer les tickets nourriture pour impression'))))))
+              ('li', (('a', 'href', 'generate_tickets.cgi'), 'Générer les tickets nourriture pour impression'))))),
+            headers=validators,
+            contains_secret=True)
     except Exception:
         if print_content_type('text/html; charset=utf-8'):
             print()
-        cgitb.handler()
+        cgitb_handler()
@@ -5,8 +5,6 @@
 #
 # (cd app/gestion && env REQUEST_METHOD=GET REMOTE_USER=secretaire REMOTE_ADDR=1.2.3.4 SERVER_NAME=localhost SCRIPT_NAME=list_reservations.cgi python list_reservations.cgi)
 
-import cgi
-import cgitb
 import itertools
 import os
 import sys
@@ -19,6 +17,9 @@ sys.path.append('..')
 import config
 from htmlgen import (
     cents_to_euro,
+    cgitb_handler,
+    conditional_get,
+    enable_cgitb,
     format_bank_id,
     html_document,
     pluriel_naif,
@@ -29,14 +30,14 @@ from htmlgen import (
 from lib_post_reservation import (
     make_show_reservation_url
 )
-import pricing
 from storage import (
     Csrf,
+    Payment,
     Reservation,
     create_db,
-)
-from create_tickets import (
-    ul_for_menu_data,
+    data_version,
+    keyset_key_from_str,
+    keyset_key_to_str,
 )
 
 def multi_replace(s: str, replaces: list[tuple[str, str]]) -> str:
@@ -57,13 +58,15 @@ def update_sort_order(new_col_name, sort_order):
         return [new_col_name]
 
 
-def make_url(sort_order, limit, offset, base_url=None, environ=None):
+def make_url(sort_order, limit, offset, base_url=None, environ=None, after=None, before=None):
     if base_url is None:
         environ = environ or os.environ
         base_url = urllib.parse.urljoin(f'https://{environ["SERVER_NAME"]}', environ["SCRIPT_NAME"])
     params = list((k, v) for k, v in itertools.chain(
         (('limit', limit),
-         ('offset', offset)),
+         ('offset', offset),
+         ('after', keyset_key_to_str(after)),
+         ('before', keyset_key_to_str(before))),
         (('sort_order', s) for s in sort_order))
                   if v is not None)
     split_result = urllib.parse.urlsplit(base_url)
@@ -75,10 +78,10 @@ def make_url(sort_order, limit, offset, base_url=None, environ=None):
         split_result.fragment))
 
 
-def make_navigation_a_elt(sort_order, limit, offset, text):
+def make_navigation_a_elt(sort_order, limit, offset, text, after=None, before=None):
     return (('a',
              'class', 'navigation',
-             'href', make_url(sort_order, limit, offset)),
+             'href', make_url(sort_order, limit, offset, after=after, before=before)),
             text)
 
 
@@ -133,7 +136,10 @@ if __name__ == '__main__':
         redirect_to_event()
 
     CONFIGURATION = config.get_configuration()
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+
+    from create_tickets import ul_for_menu_data
+    import pricing
 
     MAIN_STARTER = CONFIGURATION["main_starter_name"]
     MAIN_STARTER_SHORT = CONFIGURATION["main_starter_short"]
@@ -158,12 +164,16 @@ if __name__ == '__main__':
     INFO_EMAIL = CONFIGURATION["info_email"]
 
     try:
-        params = cgi.parse()
+        params = urllib.parse.parse_qs(os.getenv('QUERY_STRING', ''))
         sort_order = params.get('sort_order', '')
         try:
             limit = min(int(get_first(params, 'limit') or DEFAULT_LIMIT), MAX_LIMIT)
         except Exception:
             limit = DEFAULT_LIMIT
+        # With a sort key to seek to, `offset' is only the position of the
+        # page in the list.
+        after = keyset_key_from_str(get_first(params, 'after'), Reservation.keyset_ordering(sort_order))
+        before = None if after is not None else keyset_key_from_str(get_first(params, 'before'), Reservation.keyset_ordering(sort_order))
         try:
             offset = max(int(get_first(params, 'offset')), 0)
         except Exception:
@@ -171,6 +181,11 @@ if __name__ == '__main__':
         connection = create_db(CONFIGURATION)
         csrf_token = Csrf.get_by_user_and_ip(
             connection, os.getenv('REMOTE_USER'), os.getenv('REMOTE_ADDR'))
+        # The lists are refreshed constantly on event night
+        versions, last_modified = data_version(connection, (Reservation, Payment))
+        validators = conditional_get(
+            (os.getenv('QUERY_STRING'), os.getenv('SCRIPT_NAME'), os.getenv('SERVER_NAME'), csrf_token.token, versions),
+            last_modified)
 
         COLUMNS = [('name', 'Nom'), ('email', 'Email'), ('extra_comment', 'Commentaire'),
                    ('places', 'Places'),
@@ -198,18 +213,25 @@ if __name__ == '__main__':
          total_main_dessert,
          total_extra_dessert) = Reservation.count_menu_data(connection)
         reservation_summary = Reservation.summary_by_date(connection)
+        page = Reservation.select_page(connection,
+                                       filtering=[('active', '1')],
+                                       order_columns=sort_order,
+                                       limit=limit,
+                                       after=after,
+                                       before=before,
+                                       offset=offset)
         pagination_links = tuple((
             x for x in
             [('li', make_navigation_a_elt(sort_order, limit, 0, 'Début'))
-             if offset > 0
+             if page.has_previous
              else None,
              ('li',
-              make_navigation_a_elt(sort_order, limit, offset - limit, 'Précédent'))
-             if offset > limit else
+              make_navigation_a_elt(sort_order, limit, max(offset - limit, 0), 'Précédent', before=page.first_key))
+             if page.has_previous and offset > limit else
              None,
              ('li',
-              make_navigation_a_elt(sort_order, limit, offset + limit, 'Suivant'))
-             if offset + limit < active_reservations else
+              make_navigation_a_elt(sort_order, limit, offset + limit, 'Suivant', after=page.last_key))
+             if page.has_next else
              None]
             if x is not None))
         respond_html(html_document(
@@ -241,7 +263,10 @@ if __name__ == '__main__':
               (('input', 'type', 'submit', 'value', 'Rafraichir la page'),),
               *((('input', 'id', 'sort_order', 'name', 'sort_order', 'type', 'hidden', 'value', v),)
                 for v in sort_order),
-              (('input', 'id', 'offset', 'name', 'offset', 'type', 'hidden', 'value', str(offset)),)),
+              (('input', 'id', 'offset', 'name', 'offset', 'type', 'hidden', 'value', str(offset)),),
+              *((('input', 'id', name, 'name', name, 'type', 'hidden', 'value', keyset_key_to_str(key)),)
+                for name, key in (('after', after), ('before', before))
+                if key is not None)),
              (('ul', 'class', 'navbar'), *pagination_links) if pagination_links else '',
              (('table', 'class', 'list'),
               ('tr', *table_header_row),
@@ -263,11 +288,7 @@ if __name__ == '__main__':
                       ('td', format_bank_id(r.bank_id)),
                       ('td', r.date),
                       ('td', time.strftime('%d/%m/%Y %H:%M', time.gmtime(r.timestamp))))
-                     for r in Reservation.select(connection,
-                                                 filtering=[('active', '1')],
-                                                 order_columns=sort_order,
-                                                 limit=limit,
-                                                 offset=offset))),
+                     for r in page.items)),
              ('hr',),
              ('p',
               # name is a fake parameter to encourage clients to believe Excel
@@ -473,8 +494,10 @@ if __name__ == '__main__':
              ('hr',),
              ('ul',
               ('li', (('a', 'href', 'list_payments.cgi'), 'Gérer les paiements')),
-              ('li', (('a', 'href', 'generate_tickets.cgi'), 'Générer les tickets nourriture pour impression'))))))
+              ('li', (('a', 'href', 'generate_tickets.cgi'), 'Générer les tickets nourriture pour impression'))))),
+            headers=validators,
+            contains_secret=True)
     except Exception:
         if print_content_type('text/html; charset=utf-8'):
             print()
-        cgitb.handler()
+        cgitb_handler()
@@ -4,24 +4,13 @@ from htmlgen import (cents_to_euro)
 import config
 from storage import Reservation
 
-_CONFIGURATION = config.get_configuration()
-
-MAIN_STARTER_SHORT = _CONFIGURATION["main_starter_short"]
-EXTRA_STARTER_SHORT = _CONFIGURATION["extra_starter_short"]
-MAIN_DISH_SHORT = _CONFIGURATION["main_dish_short"]
-EXTRA_DISH_SHORT = _CONFIGURATION["extra_dish_short"]
-THIRD_DISH_SHORT = _CONFIGURATION["third_dish_short"]
-KIDS_MAIN_DISH_SHORT = _CONFIGURATION["kids_main_dish_short"]
-KIDS_EXTRA_DISH_SHORT = _CONFIGURATION["kids_extra_dish_short"]
-KIDS_THIRD_DISH_SHORT = _CONFIGURATION["kids_third_dish_short"]
-MAIN_DESSERT_SHORT = _CONFIGURATION["main_dessert_short"]
-EXTRA_DESSERT_SHORT = _CONFIGURATION["extra_dessert_short"]
 
 def write_column_header_rows(writer):
-    PLATS = (MAIN_STARTER_SHORT, EXTRA_STARTER_SHORT, MAIN_DISH_SHORT, EXTRA_DISH_SHORT, THIRD_DISH_SHORT, MAIN_DESSERT_SHORT, EXTRA_DESSERT_SHORT)
+    dishes = config.get_dishes()
+    PLATS = tuple(dishes[key].short for key in ('main_starter', 'extra_starter', 'main_dish', 'extra_dish', 'third_dish', 'main_dessert', 'extra_dessert'))
     # Wrap iterator in `tuple' because we want to traverse it twice!
     DOTS = tuple(itertools.repeat('...', len(PLATS) - 1))
-    KIDS_PLATS = (KIDS_MAIN_DISH_SHORT, KIDS_EXTRA_DISH_SHORT, KIDS_THIRD_DISH_SHORT, MAIN_DESSERT_SHORT, EXTRA_DESSERT_SHORT,)
+    KIDS_PLATS = tuple(dishes[key].short for key in ('kids_main_dish', 'kids_extra_dish', 'kids_third_dish', 'main_dessert', 'extra_dessert'))
     KIDS_DOTS = tuple(itertools.repeat('...', len(KIDS_PLATS) - 1))
     row1 = ('','',
          'Menu', *DOTS,
@@ -1,13 +1,13 @@
-import cgi
-import csv
 import io
+import itertools
+import operator
 import sqlite3
 import os
 import time
-from typing import Any, Callable, Iterable, Optional, Union
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional, Union
 from urllib.parse import urlencode, urljoin, urlunsplit
 
-from storage import Csrf, Payment, Reservation
+from storage import Csrf, Payment, Reservation, is_unique_constraint_error, write_transaction
 from htmlgen import (
     cents_to_euro,
     format_bank_id,
@@ -21,6 +21,7 @@ from lib_post_reservation import (
 )
 
 def get_parameters_for_GET() -> tuple[Optional[str], Optional[int], Optional[int]]:
+    import cgi
     params = cgi.parse()
     filtering = params.get("filtering")
 
@@ -51,6 +52,25 @@ def _normalize_header(s: str) -> str:
     s = s.strip()
     return s[1:] if s.startswith('\ufeff') else s
 
+def bank_statement_date_to_timestamp(date: str) -> float:
+    '''Noon (local time) of a bank statement date (DD/MM/YYYY)'''
+    return time.mktime(time.strptime(f"{date}T12:00+01:00", "%d/%m/%YT%H:%M%z"))
+
+
+def amount_to_cents(amount: str) -> int:
+    '''Convert a bank statement amount (e.g. `-50,34' or `18') to cents without rounding errors'''
+    text = amount.strip().replace(",", ".")
+    digits = text.lstrip("+-")
+    whole, _, fraction = digits.partition(".")
+    if (len(text) - len(digits) <= 1
+        and (whole.isdecimal() or (not whole and fraction))
+        and (not fraction or (fraction.isdecimal() and len(fraction) <= 2))):
+        cents = int(whole or 0) * 100 + int(fraction.ljust(2, "0"))
+        return -cents if text.startswith("-") else cents
+    # Exponents, more than 2 decimals, etc.
+    return round(float(text) * 100)
+
+
 def make_payment_builder(header_row: list[str]) -> Callable[[list[str], Optional[Payment]], Payment]:
     col_name_to_idx = {_normalize_header(col_name): col_idx for col_idx, col_name in enumerate(header_row)}
     columns = {}
@@ -62,56 +82,152 @@ def make_payment_builder(header_row: list[str]) -> Callable[[list[str], Optional
     if not columns:
         raise RuntimeError("Unable to map header row to Payment class definition")
 
+    get_fields = operator.itemgetter(*(columns[attr_name] for attr_name in (
+        'src_id', 'timestamp', 'amount_in_cents', 'comment', 'other_account', 'other_name', 'status')))
+    # Statements have many rows for few dates and strptime is slow
+    timestamps = {}
+
     def payment_builder(row: list[str], proto: Optional[Payment]=None) -> Payment:
-        amount_in_cents = round(float(row[columns["amount_in_cents"]].replace(",", ".")) * 100)
-        return Payment(
-            None,
-            timestamp=time.mktime(time.strptime(f"{row[columns['timestamp']]}T12:00+01:00", "%d/%m/%YT%H:%M%z")),
-            amount_in_cents=amount_in_cents,
-            comment=row[columns['comment']],
-            uuid=None,
-            src_id=row[columns['src_id']],
-            other_account=row[columns['other_account']],
-            other_name=row[columns['other_name']],
-            status=row[columns['status']],
-            user=None if proto is None else proto.user,
-            ip=None if proto is None else proto.ip,
-            confirmation_timestamp=None if proto is None else proto.confirmation_timestamp,
-            active=True if proto is None else proto.active,
-        )
+        src_id, date, amount, comment, other_account, other_name, status = get_fields(row)
+        try:
+            timestamp = timestamps[date]
+        except KeyError:
+            timestamp = timestamps[date] = bank_statement_date_to_timestamp(date)
+        if proto is None:
+            return Payment(None, timestamp, amount_to_cents(amount), comment, None, src_id, other_account, other_name, status,
+                           None, None, None, True)
+        return Payment(None, timestamp, amount_to_cents(amount), comment, None, src_id, other_account, other_name, status,
+                       proto.user, proto.ip, proto.confirmation_timestamp, proto.active)
 
     return payment_builder
 
 
-def import_bank_statements(connection, bank_statements_csv: str, user:str, ip: str) -> list[tuple[Exception, Payment]]:
-    csv_reader = csv.reader(io.StringIO(bank_statements_csv), delimiter=';')
-    builder = make_payment_builder(next(csv_reader))
+MULTIPART_MAX_LINE_LENGTH = 64 * 1024
+# Limit of `cgi.maxlen' before uploads were streamed
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+
+
+def iter_multipart_form(stream: BinaryIO, content_type: str, content_length: Optional[int] = None) -> Iterator[tuple[str, Iterator[bytes]]]:
+    '''Parse a multipart/form-data request body while reading it
+
+    Yields (field name, lines of the field's value) for each part in the
+    order of the form.  The lines are read from `stream' while they are
+    consumed; the lines left unconsumed are skipped when the next part is
+    requested.  Lines keep their line ending except the last one of each
+    part (the line break before a boundary belongs to the boundary).'''
+    import cgi
+    mime_type, options = cgi.parse_header(content_type)
+    if mime_type != 'multipart/form-data' or not options.get('boundary'):
+        raise ValueError(f"Not a multipart/form-data request: {content_type!r}")
+    delimiter = b'--' + options['boundary'].encode('ascii')
+    remaining = content_length
+    # The delimiter line ending the last part read, b'' when the body ends
+    # without closing delimiter.
+    last_delimiter = b''
+
+    def readline() -> bytes:
+        nonlocal remaining
+        if remaining is not None and remaining <= 0:
+            return b''
+        line = stream.readline(MULTIPART_MAX_LINE_LENGTH if remaining is None else min(remaining, MULTIPART_MAX_LINE_LENGTH))
+        if remaining is not None:
+            remaining -= len(line)
+        if len(line) == MULTIPART_MAX_LINE_LENGTH and not line.endswith(b'\n'):
+            raise ValueError(f"Line longer than {MULTIPART_MAX_LINE_LENGTH} bytes in multipart/form-data")
+        return line
+
+    def is_delimiter(line: bytes) -> bool:
+        return line.startswith(delimiter) and line.rstrip() in (delimiter, delimiter + b'--')
+
+    def body() -> Iterator[bytes]:
+        nonlocal last_delimiter
+        previous = b''
+        while line := readline():
+            if is_delimiter(line):
+                last_delimiter = line.rstrip()
+                previous = previous[:-2] if previous.endswith(b'\r\n') else previous[:-1] if previous.endswith(b'\n') else previous
+                break
+            if previous:
+                yield previous
+            previous = line
+        else:
+            last_delimiter = b''
+        if previous:
+            yield previous
+
+    # Skip the preamble
+    while line := readline():
+        if is_delimiter(line):
+            last_delimiter = line.rstrip()
+            break
+    while last_delimiter == delimiter:
+        name = None
+        while (line := readline()).strip():
+            header, _, value = line.decode('latin1').partition(':')
+            if header.strip().lower() == 'content-disposition':
+                name = cgi.parse_header(value.strip())[1].get('name')
+        lines = body()
+        yield name, lines
+        for _ in lines:
+            pass
+
+
+def decode_lines(lines: Iterable[bytes]) -> Iterator[str]:
+    '''Decode `lines' as UTF-8 until one isn't, then as latin1'''
+    encoding = 'utf-8'
+    for line in lines:
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError:
+            encoding = 'latin1'
+            yield line.decode(encoding)
+
+
+IMPORT_BATCH_SIZE = 200
+
+
+def iter_import_bank_statements(connection, bank_statements_csv: Union[str, Iterable[str]], user: str, ip: str) -> Iterator[tuple[Optional[Exception], Payment]]:
+    '''`import_bank_statements' yielding the results of each batch once it is committed
+
+    Rows are read while importing: a streamed upload is committed by batches
+    of IMPORT_BATCH_SIZE before it has been read entirely and only one batch
+    is held in memory.'''
+    import csv
+    if isinstance(bank_statements_csv, str):
+        bank_statements_csv = io.StringIO(bank_statements_csv)
+    csv_reader = (row for row in csv.reader(bank_statements_csv, delimiter=';') if row)
+    header_row = next(csv_reader, None)
+    if header_row is None:
+        return
+    builder = make_payment_builder(header_row)
     proto = Payment(
         rowid=None, timestamp=None, amount_in_cents=None, comment=None, uuid=None, src_id=None, other_account=None, other_name=None, status=None, user=user, ip=ip, confirmation_timestamp=None, active=True,
     )
-    exceptions = []
     src_id_limit = time.strftime("%Y-000")
-    with connection:
-        for row in csv_reader:
-            pmnt = builder(row, proto)
+    # Commit every IMPORT_BATCH_SIZE rows to let other writers through
+    while True:
+        batch = list(itertools.islice(csv_reader, IMPORT_BATCH_SIZE))
+        if not batch:
+            return
+        payments = [builder(row, proto) for row in batch]
+        with write_transaction(connection):
+            inserted = iter(Payment.insert_many(
+                connection,
+                (pmnt for pmnt in payments if pmnt.src_id and pmnt.src_id >= src_id_limit),
+                IMPORT_BATCH_SIZE))
+        for pmnt in payments:
             if not pmnt.src_id or pmnt.src_id < src_id_limit:
-                exceptions.append((RuntimeError(f"Bank statement {pmnt.src_id!r} is too old"), pmnt))
+                yield RuntimeError(f"Bank statement {pmnt.src_id!r} is too old"), pmnt
                 continue
-            try:
-                pmnt.insert_data(connection)
-            except sqlite3.IntegrityError as exc:
-                # My python versions and their shipped sqlite3 modules differ between my dev system and my deployment system :sad:
-                old_style_unique_constraint_error = exc.args and isinstance(exc.args[0], str) and exc.args[0].startswith('UNIQUE ')
-                new_style_unique_constraint_error = hasattr(exc, 'sqlite_errorname') and exc.sqlite_errorname == 'SQLITE_CONSTRAINT_UNIQUE'
-                if old_style_unique_constraint_error or new_style_unique_constraint_error:
-                    exceptions.append((None, pmnt))
-                else:
-                    exceptions.append((exc, pmnt))
-            except Exception as exc:
-                exceptions.append((exc, pmnt))
-            else:
-                exceptions.append((None, pmnt))
-    return exceptions
+            exc, pmnt = next(inserted)
+            # Payments that are already known are not an error
+            if isinstance(exc, sqlite3.IntegrityError) and is_unique_constraint_error(exc):
+                exc = None
+            yield exc, pmnt
+
+
+def import_bank_statements(connection, bank_statements_csv: Union[str, Iterable[str]], user:str, ip: str) -> list[tuple[Exception, Payment]]:
+    return list(iter_import_bank_statements(connection, bank_statements_csv, user, ip))
 
 
 def get_list_payments_row(
@@ -120,7 +236,14 @@ def get_list_payments_row(
         res: Optional[Reservation],
         server_name: str,
         script_name: str,
-        csrf_token: str) -> Iterable[tuple[Union[str, Iterable[str]], Any]]:
+        csrf_token: str,
+        reconciliation: Optional["PaymentReconciliation"]=None) -> Iterable[tuple[Union[str, Iterable[str]], Any]]:
+    '''Table cells of a payment in `list_payments.cgi'
+
+    `reconciliation' should be shared by all rows of the page, see
+    `PaymentReconciliation'.'''
+    if reconciliation is None:
+        reconciliation = PaymentReconciliation(connection, ((pmnt, res),))
     return (('td', pmnt.src_id),
             ('td', time.strftime('%d/%m/%Y', time.gmtime(pmnt.timestamp))),
             ('td', pmnt.other_account),
@@ -128,7 +251,7 @@ def get_list_payments_row(
             ('td' if pmnt.money_received() else ('td', 'class', 'payment-not-ok'), pmnt.status),
             ('td', pmnt.comment),
             ('td' if pmnt.money_received() else ('td', 'class', 'payment-not-ok'), cents_to_euro(pmnt.amount_in_cents)),
-            ('td', maybe_link_to_reservation(connection, pmnt, res, server_name, script_name, csrf_token)))
+            ('td', maybe_link_to_reservation(reconciliation, pmnt, res, server_name, script_name, csrf_token)))
 
 
 def _concat_name_and_mail(res: Reservation) -> str:
@@ -138,8 +261,91 @@ def _concat_name_and_mail(res: Reservation) -> str:
         return res.name + ' ' + res.email
 
 
+def payment_bank_id(pmnt: Payment) -> Optional[str]:
+    '''Structured communication of a payment (i.e. a `Reservation.bank_id') or None'''
+    bank_id = pmnt.comment.strip().replace("+", "").replace("/", "")
+    return bank_id if len(bank_id) == 12 and all(ch.isdigit() for ch in bank_id) else None
+
+
+LINK_RESERVATION_LIST_ID = 'reservations-for-linking'
+LINK_RESERVATION_SELECT_CLASS = 'link-reservation'
+
+
+class PaymentReconciliation:
+    '''Reservations to offer for linking with a page of payments
+
+    Resolves the structured communications of all the page's unlinked
+    payments with one query and loads the active reservations once for the
+    whole page instead of once per payment.
+
+    The `option' of every active reservation is rendered once, into a
+    `datalist' (see `page_elements').  The payments without a matching
+    reservation get a text input using that list: the browser suggests the
+    reservations and the structured communication of a reservation can be
+    typed too, without JavaScript.  The `select' elements of the payments
+    with a matching reservation only hold that reservation: the browser
+    copies the other options into a `select' when it is first used, so
+    picking another reservation than the matching one needs JavaScript.'''
+    __slots__ = ('by_bank_id', '_connection', '_candidates', '_list_used')
+
+    def __init__(self, connection: Union[sqlite3.Cursor, sqlite3.Connection], items: Iterable[tuple[Payment, Optional[Reservation]]]):
+        self._connection = connection
+        self._candidates = None
+        self._list_used = False
+        bank_ids = {bank_id
+                    for pmnt, res in items
+                    if res is None and (bank_id := payment_bank_id(pmnt)) is not None}
+        self.by_bank_id = Reservation.find_by_bank_ids(connection, bank_ids) if bank_ids else {}
+
+    def candidates(self) -> list[Reservation]:
+        '''Active reservations ordered by name'''
+        if self._candidates is None:
+            self._candidates = Reservation.list_reservations_for_linking_with_payments(self._connection, '')
+        return self._candidates
+
+    def select(self, preselected_option: Iterable[Any]) -> Iterable[Any]:
+        '''`select' element for `reservation_uuid' (completed by the browser, see `page_elements')'''
+        self._list_used = True
+        return (('select', 'name', 'reservation_uuid', 'class', LINK_RESERVATION_SELECT_CLASS), preselected_option)
+
+    def input(self) -> Iterable[Any]:
+        '''Text input for `reservation_uuid' suggesting the reservations of the page'''
+        self._list_used = True
+        return (('input', 'type', 'text', 'name', 'reservation_uuid', 'list', LINK_RESERVATION_LIST_ID,
+                 'required', 'required', 'placeholder', 'Nom ou communication de la réservation'),)
+
+    def page_elements(self) -> tuple[Any, ...]:
+        '''Elements to add once to the page after all the rows'''
+        if not self._list_used:
+            return ()
+        return ((('datalist', 'id', LINK_RESERVATION_LIST_ID),
+                 *(_maybe_link__make_option(res) for res in self.candidates())),
+                ('script',
+                 ('raw',
+                  f"""(function () {{
+    // Copy the options into a select only when it is about to be used
+    function completeSelect(event) {{
+        const select = event.target;
+        if (!(select instanceof HTMLSelectElement)
+            || !select.classList.contains('{LINK_RESERVATION_SELECT_CLASS}')
+            || select.dataset.completed) {{
+            return;
+        }}
+        select.dataset.completed = 'completed';
+        const preselected = select.value;
+        document.getElementById('{LINK_RESERVATION_LIST_ID}').querySelectorAll('option').forEach(function (option) {{
+            if (option.value !== preselected) {{
+                select.appendChild(option.cloneNode(true));
+            }}
+        }});
+    }}
+    document.addEventListener('pointerdown', completeSelect, true);
+    document.addEventListener('focusin', completeSelect);
+}})();""")))
+
+
 def maybe_link_to_reservation(
-        connection: Union[sqlite3.Cursor, sqlite3.Connection],
+        reconciliation: PaymentReconciliation,
         pmnt: Payment,
         res: Optional[Reservation],
         server_name: str,
@@ -169,13 +375,10 @@ def maybe_link_to_reservation(
                     ''))),
                  '🖄' if pmnt.confirmation_timestamp is None else 'send again?'))
 
-    bank_id = pmnt.comment.strip().replace("+", "").replace("/", "")
-    if len(bank_id) != 12 or not all(ch.isdigit() for ch in bank_id):
-        return _maybe_link__make_form_when_no_reservation_matches_well(connection, pmnt, csrf_token, script_dir)
-
-    matching_reservation = Reservation.find_by_bank_id(connection, bank_id)
+    bank_id = payment_bank_id(pmnt)
+    matching_reservation = None if bank_id is None else reconciliation.by_bank_id.get(bank_id)
     if matching_reservation is None:
-        return _maybe_link__make_form_when_no_reservation_matches_well(connection, pmnt, csrf_token, script_dir)
+        return _maybe_link__make_form_when_no_reservation_matches_well(reconciliation, pmnt, csrf_token, script_dir)
 
     return _maybe_add_hide_button(
         pmnt,
@@ -184,9 +387,7 @@ def maybe_link_to_reservation(
         (('form', 'style', 'display: inline', 'method', 'POST', 'action', os.path.join(script_dir, 'link_payment_and_reservation.cgi')),
          (('input', 'type', 'hidden', 'name', 'csrf_token', 'value', csrf_token),),
          (('input', 'type', 'hidden', 'name', 'src_id', 'value', pmnt.src_id),),
-         (('select', 'name', 'reservation_uuid'),
-          _maybe_link__make_option(matching_reservation, bank_id),
-          *(_maybe_link__make_option(res) for res in Reservation.list_reservations_for_linking_with_payments(connection, matching_reservation.uuid))),
+         reconciliation.select(_maybe_link__make_option(matching_reservation, bank_id)),
          (('input', 'type', 'submit', 'value', 'OK'),)))
 
 
@@ -194,8 +395,7 @@ def _maybe_link__make_option(res: Reservation, bank_id: Union[str, None]=None) -
     return (('option', 'value', res.uuid, *(() if bank_id is None else ('selected', 'selected'))), format_bank_id(res.bank_id), ' ', _concat_name_and_mail(res))
 
 
-def _maybe_link__make_form_when_no_reservation_matches_well(connection, pmnt: Payment, csrf_token: str, script_dir: str) -> Union[str, Iterable[Any]]:
-    options = [_maybe_link__make_option(res) for res in Reservation.list_reservations_for_linking_with_payments(connection, '')]
+def _maybe_link__make_form_when_no_reservation_matches_well(reconciliation: PaymentReconciliation, pmnt: Payment, csrf_token: str, script_dir: str) -> Union[str, Iterable[Any]]:
     return _maybe_add_hide_button(
         pmnt,
         csrf_token,
@@ -203,11 +403,9 @@ def _maybe_link__make_form_when_no_reservation_matches_well(connection, pmnt: Pa
         (('form', 'style', 'display: inline', 'method', 'POST', 'action', os.path.join(script_dir, 'link_payment_and_reservation.cgi')),
          (('input', 'type', 'hidden', 'name', 'csrf_token', 'value', csrf_token),),
          (('input', 'type', 'hidden', 'name', 'src_id', 'value', pmnt.src_id),),
-         (('select', 'name', 'reservation_uuid'),
-          (('option', 'value', ''), '--- Choisir la réservation correspondante ---'),
-          *options),
+         reconciliation.input(),
          (('input', 'type', 'submit', 'value', 'OK'),))
-            if options
+            if reconciliation.candidates()
             else "#N/A")
 
 
@@ -239,7 +437,17 @@ def respond_link_payment_and_reservation_error(error_title, error_html, list_pay
                       ('p', (('a', 'href', list_payments),
                              'Retour à la liste des paiements')))))
 
+def find_reservation_to_link(db_connection, value: str) -> Optional[Reservation]:
+    '''Reservation whose uuid or structured communication is `value' (a form field)'''
+    value = value.strip()
+    if all(ch.isdigit() or ch in '+/ ' for ch in value):
+        bank_id = ''.join(ch for ch in value if ch.isdigit())
+        return Reservation.find_by_bank_id(db_connection, bank_id) if len(bank_id) == 12 else None
+    return Reservation.find_by_uuid(db_connection, value)
+
+
 def link_payment_and_reservation(db_connection, server_name: str, script_name: str, user: str, ip: str) -> None:
+    import cgi
     list_payments = f"https://{server_name}{os.path.join(os.path.dirname(script_name), 'list_payments.cgi')}"
     # Get form data
     form = cgi.FieldStorage()
@@ -261,6 +469,17 @@ def link_payment_and_reservation(db_connection, server_name: str, script_name: s
         respond_link_payment_and_reservation_error('Formulaire incomplet', (('p', "Il n'y avait pas de ", ("code", "src_id"), " dans le formulaire."), ), list_payments)
         return
 
+    if reservation_uuid:
+        # Typed in the text input of an unmatched payment (see `PaymentReconciliation.input')
+        reservation = find_reservation_to_link(db_connection, reservation_uuid)
+        if reservation is None:
+            respond_link_payment_and_reservation_error(
+                "Réservation inconnue",
+                (('p', "La réservation '", reservation_uuid, "' n'a pas été retrouvée."),),
+                list_payments)
+            return
+        reservation_uuid = reservation.uuid
+
     try:
         payment = Payment.find_by_src_id(db_connection, src_id)
     except Exception as exc:
@@ -297,6 +516,7 @@ def link_payment_and_reservation(db_connection, server_name: str, script_name: s
 
 
 def hide_payment(db_connection, server_name: str, script_name: str, user: str, ip: str) -> None:
+    import cgi
     list_payments = f"https://{server_name}{os.path.join(os.path.dirname(script_name), 'list_payments.cgi')}"
     # Get form data
     form = cgi.FieldStorage()
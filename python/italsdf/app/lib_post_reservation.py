@@ -1,27 +1,26 @@
 # -*- coding: utf-8 -*-
-import cgitb
 import os
 import re
+import sqlite3
 import time
 from typing import Any, Optional
 from urllib.parse import urlunsplit, urljoin, urlencode
-import uuid
 
 from htmlgen import (
     cents_to_euro,
+    cgitb_handler,
     html_document,
     redirect,
     respond_html,
 )
-from pricing import (
-    price_in_cents,
-)
 from storage import(
     FullMealCount,
     KidMealCount,
     MenuCount,
     Reservation,
     ensure_connection,
+    is_unique_constraint_error,
+    write_transaction,
 )
 
 
@@ -149,20 +148,25 @@ def normalize_data(
             gdpr_accepts_use)
 
 
+# A clash of bank_ids (see `generate_bank_id') is retried with a new timestamp
+BANK_ID_ATTEMPTS = 3
+
+
 def save_data_sqlite3(name, email, extra_comment, places, date,
                       outside_main_starter, outside_extra_starter, outside_main_dish, outside_extra_dish, outside_third_dish, outside_main_dessert, outside_extra_dessert,
                       inside_main_starter, inside_extra_starter, inside_main_dish, inside_extra_dish, inside_third_dish, inside_main_dessert, inside_extra_dessert,
                       kids_main_dish, kids_extra_dish, kids_third_dish, kids_main_dessert, kids_extra_dessert,
-                      gdpr_accepts_use, origin, connection_or_root_dir) -> Optional[Reservation]:
+                      gdpr_accepts_use, origin, connection_or_root_dir) -> Reservation:
+    import uuid
+    from pricing import price_in_cents
     connection = ensure_connection(connection_or_root_dir)
-    process_id = os.getpid()
-    retries = 3
-    while retries > 0:
-        uuid_hex = uuid.uuid4().hex
-        retries -= 1
-        timestamp = time.time()
-        bank_id = generate_bank_id(timestamp, Reservation.length(connection), process_id)
-        try:
+    # The bank_id depends on the number of reservations: count them while
+    # holding the write lock so that concurrent requests get different ones.
+    with write_transaction(connection):
+        reservations_count = Reservation.length(connection)
+        for attempt in range(BANK_ID_ATTEMPTS):
+            timestamp = time.time()
+            bank_id = generate_bank_id(timestamp, reservations_count, os.getpid())
             new_row = Reservation(
                 name=name,
                 email=email,
@@ -186,20 +190,21 @@ def save_data_sqlite3(name, email, extra_comment, places, date,
                 gdpr_accepts_use=gdpr_accepts_use,
                 cents_due=-1, # To be fixed once the object is initialized
                 bank_id=append_bank_id_control_number(bank_id),
-                uuid=uuid_hex,
+                uuid=uuid.uuid4().hex,
                 time=timestamp,
                 active=True,
                 origin=origin)
             new_row.cents_due = price_in_cents(new_row)
-            with connection:
+            try:
                 new_row.insert_data(connection)
-            return new_row
-        except Exception:
-            if retries > 0:
+            except sqlite3.IntegrityError as exc:
+                if attempt + 1 == BANK_ID_ATTEMPTS or not is_unique_constraint_error(exc):
+                    raise
+                # Same bank_id as an older reservation: its timestamp bits
+                # change every 10ms
                 time.sleep(0.011)
-                pass
             else:
-                raise
+                return new_row
 
 
 def generate_bank_id(time_time, number_of_previous_calls, process_id):
@@ -270,7 +275,7 @@ def respond_with_reservation_confirmation(
                          os.path.dirname(os.environ["SCRIPT_NAME"])))
     except Exception:
         respond_with_reservation_failed(configuration)
-        cgitb.handler()
+        cgitb_handler()
     else:
         redirect(redirection_url)
 
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''QR codes as inline SVG, cached on disk
+
+The SVG is written directly from the modules of the QR code: neither an
+image factory nor PIL is involved.  The codes are cached in the `qr_codes'
+folder of `dbdir', keyed by a hash of their content, and the least recently
+used ones are evicted when the folder grows beyond `qr_cache_max_bytes'.  A
+cached code is served without even importing `qrcode'.'''
+import hashlib
+import itertools
+import os
+from typing import Any, Optional, Sequence
+
+
+CACHE_FOLDER = 'qr_codes'
+
+# Part of the cache key: change it when `matrix_to_svg' changes its output.
+SVG_FORMAT = 1
+
+
+def matrix_to_svg(matrix: Sequence[Sequence[bool]]) -> str:
+    '''SVG drawing the dark modules of `matrix' (quiet zone included)
+
+    Each run of dark modules of a row is a rectangle of one path.  A module
+    is 1mm wide, like with `qrcode.image.svg.SvgPathFillImage'.'''
+    size = len(matrix)
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        for dark, run in itertools.groupby(row):
+            length = sum(1 for _ in run)
+            if dark:
+                path.append(f'M{x} {y}h{length}v1h-{length}z')
+            x += length
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}mm" height="{size}mm"'
+            f' viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+            f'<rect width="{size}" height="{size}" fill="#fff"/>'
+            f'<path d="{"".join(path)}" fill="#000"/></svg>')
+
+
+def make_svg(content: str) -> str:
+    import qrcode
+    # Same defaults as `qrcode.make'
+    qr = qrcode.QRCode()
+    qr.add_data(content)
+    qr.make(fit=True)
+    return matrix_to_svg(qr.get_matrix())
+
+
+def cache_folder(configuration: dict[str, Any]) -> Optional[str]:
+    db_dir = configuration['dbdir']
+    return None if db_dir == ':memory:' else os.path.join(db_dir, CACHE_FOLDER)
+
+
+def cache_key(content: str) -> str:
+    return hashlib.sha256(f'{SVG_FORMAT}\n{content}'.encode('utf-8')).hexdigest()
+
+
+def _store(folder: str, path: str, svg: str) -> None:
+    import tempfile
+    os.makedirs(folder, exist_ok=True)
+    # Concurrent requests may render the same code: readers must never see
+    # a partially written file.
+    fd, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(svg)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def evict(folder: str, max_bytes: int) -> None:
+    '''Delete the least recently used codes until `folder' holds at most `max_bytes' '''
+    entries = []
+    total = 0
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.name.endswith('.svg'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        if total <= max_bytes:
+            break
+
+
+def svg_qr_code(content: str, configuration: dict[str, Any]) -> str:
+    '''Inline SVG of the QR code of `content' '''
+    folder = cache_folder(configuration)
+    if folder is None:
+        return make_svg(content)
+    path = os.path.join(folder, f'{cache_key(content)}.svg')
+    try:
+        with open(path, encoding='utf-8') as f:
+            svg = f.read()
+    except FileNotFoundError:
+        pass
+    else:
+        # The modification time is the `recently used' of the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return svg
+    svg = make_svg(content)
+    try:
+        _store(folder, path, svg)
+        evict(folder, int(configuration['qr_cache_max_bytes']))
+    except OSError:
+        # Without a writable cache, the codes are rendered every time
+        pass
+    return svg
@@ -4,13 +4,12 @@
 # Test with
 #
 # echo | (cd app && script_name=post_reservation.cgi && env REQUEST_METHOD=POST 'QUERY_STRING=name=test&email=i%40example.com&extraComment=commentaire&places=1&insidemainstarter=2&insideextrastarter=1&insidemaindish=0&insideextradish=3&kidsmaindish=1&kidsextradish=3&outsidemainstarter=9&outsideextrastarter=5&outsidemaindish=6&outsideextradish=7&outsidedessert=8&gdpr_accepts_use=true&date=2099-01-01' SERVER_NAME=example.com SCRIPT_NAME=$script_name python3 $script_name)
-import cgi
-import cgitb
 import os
 import sys
 
 import config
 from htmlgen import (
+    enable_cgitb,
     html_document,
     print_content_type,
     redirect_to_event,
@@ -47,7 +46,7 @@ if __name__ == '__main__':
         redirect_to_event()
     CONFIGURATION = config.get_configuration()
 
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
         if CONFIGURATION.get('disabled', False):
@@ -56,6 +55,7 @@ if __name__ == '__main__':
 
         db_connection = create_db(CONFIGURATION)
 
+        import cgi
         # Get form data
         form = cgi.FieldStorage()
         name = form.getfirst('name', default='')
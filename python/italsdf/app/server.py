@@ -0,0 +1,266 @@
+#!/usr/pkg/bin/python3
+# -*- coding: utf-8 -*-
+'''Serve the CGI scripts from one long-running process.
+
+Each `*.cgi' script is compiled once and executed in-process for every
+request with the CGI environment, stdin and stdout it would normally get from
+the web server.  Imports, the configuration and the SQLite connections stay
+warm between requests.
+
+Run a small prefork pool of WSGI servers behind a reverse proxy that takes
+care of authenticating `gestion/' and passes the user name in an
+`X-Remote-User' header
+
+    python3 server.py --port 8000 --workers 4 --trust-remote-user-header
+
+or let the web server talk FastCGI to it (needs `pip install flup')
+
+    python3 server.py --fastcgi /path/to/socket
+
+`kill -HUP' the first process (the one started) to make every worker read
+`configuration.json' again.
+'''
+import argparse
+import builtins
+import cgitb
+import http
+import io
+import mimetypes
+import os
+import signal
+import sys
+from typing import Any, Callable, Iterable, Optional
+
+
+APP_DIR = os.path.dirname(os.path.realpath(__file__))
+
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+import config
+import htmlgen
+import storage
+
+# Environment variables forwarded from the WSGI environ to the CGI scripts.
+CGI_VARIABLES = (
+    'REQUEST_METHOD', 'QUERY_STRING', 'CONTENT_TYPE', 'CONTENT_LENGTH',
+    'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'REMOTE_ADDR',
+    'REMOTE_USER', 'AUTH_TYPE', 'HTTPS',
+)
+
+# Static files the scripts link to (the web server serves them in CGI mode).
+STATIC_EXTENSIONS = ('.css', '.png', '.jpg', '.js', '.html')
+
+
+class CgiScript:
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime: Optional[float] = None
+        self.code: Any = None
+
+    def get_code(self) -> Any:
+        mtime = os.stat(self.path).st_mtime
+        if self.code is None or mtime != self.mtime:
+            with open(self.path, 'rb') as f:
+                self.code = compile(f.read(), self.path, 'exec')
+            self.mtime = mtime
+        return self.code
+
+    def run(self) -> None:
+        exec(self.get_code(), {'__name__': '__main__',
+                               '__file__': self.path,
+                               '__builtins__': builtins})
+
+
+# Workers forked by `serve_prefork': the parent forwards them its SIGHUP
+_PREFORK_CHILDREN: list[int] = []
+
+
+def _reload_configuration(*_args) -> None:
+    config.forget_configuration()
+    htmlgen.forget_compression_level()
+    for pid in _PREFORK_CHILDREN:
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError:
+            pass
+
+
+def warm_up(app_dir: str) -> dict[str, CgiScript]:
+    '''Import the libraries and compile every CGI script below `app_dir'.'''
+    storage.enable_connection_pool()
+    for module_name in ('lib_payments', 'lib_post_reservation', 'lib_payment_confirmation',
+                        'lib_export_csv', 'create_tickets', 'pricing', 'lib_qr_codes', 'qrcode',
+                        # imported by the scripts where they need them
+                        'cgi', 'cgitb', 'csv', 'email.utils', 'tempfile', 'uuid'):
+        try:
+            __import__(module_name)
+        except ImportError:
+            pass
+    scripts = {}
+    for dir_path, _, file_names in os.walk(app_dir):
+        for file_name in file_names:
+            if file_name.endswith('.cgi'):
+                path = os.path.join(dir_path, file_name)
+                script = CgiScript(path)
+                script.get_code()
+                scripts['/' + os.path.relpath(path, app_dir).replace(os.sep, '/')] = script
+    return scripts
+
+
+def split_cgi_response(output: bytes) -> tuple[str, list[tuple[str, str]], bytes]:
+    head, separator, body = output.partition(b'\n\n')
+    if not separator:
+        return '500 Internal Server Error', [('Content-Type', 'text/plain; charset=utf-8')], output
+    status = '200 OK'
+    headers = []
+    for line in head.decode('latin1').splitlines():
+        name, _, value = line.partition(':')
+        name, value = name.strip(), value.strip()
+        if name.lower() == 'status':
+            code = int(value.split()[0])
+            try:
+                status = f'{code} {http.HTTPStatus(code).phrase}'
+            except ValueError:
+                status = value
+        elif name:
+            headers.append((name, value))
+    return status, headers, body
+
+
+def run_cgi_script(script: CgiScript, cgi_environ: dict[str, str], stdin: bytes) -> bytes:
+    saved_environ = dict(os.environ)
+    saved_path = list(sys.path)
+    saved_streams = sys.stdin, sys.stdout
+    saved_excepthook = sys.excepthook
+    saved_cgitb_handler = cgitb.handler
+    saved_cwd = os.getcwd()
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+    try:
+        os.environ.clear()
+        os.environ.update(cgi_environ)
+        sys.stdin = io.TextIOWrapper(io.BytesIO(stdin), encoding='utf-8')
+        sys.stdout = stdout
+        # `cgitb.handler' is bound to the stdout of the server at import time
+        cgitb.handler = cgitb.Hook(file=stdout).handle
+        htmlgen._html_gen_printed_header = False
+        # The scripts `sys.path.append('..')' to reach the libraries:
+        os.chdir(os.path.dirname(script.path))
+        try:
+            script.run()
+        except SystemExit:
+            pass
+        except Exception:
+            if sys.excepthook is saved_excepthook:
+                cgitb.handler()
+            else:
+                # cgitb.enable() installed its display/logdir settings
+                sys.excepthook(*sys.exc_info())
+        stdout.flush()
+        return stdout.buffer.getvalue()
+    finally:
+        storage.release_pooled_connections()
+        os.chdir(saved_cwd)
+        sys.excepthook = saved_excepthook
+        cgitb.handler = saved_cgitb_handler
+        sys.stdin, sys.stdout = saved_streams
+        sys.path[:] = saved_path
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+
+def make_application(app_dir: str = APP_DIR, trust_remote_user_header: bool = False) -> Callable[[dict[str, Any], Callable], Iterable[bytes]]:
+    app_dir = os.path.realpath(app_dir)
+    scripts = warm_up(app_dir)
+    base_environ = dict(os.environ)
+
+    def application(environ: dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        path_info = environ.get('PATH_INFO') or '/'
+        script = scripts.get(path_info)
+        if script is None:
+            return serve_static(app_dir, path_info, start_response)
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        stdin = environ['wsgi.input'].read(content_length) if content_length > 0 else b''
+        cgi_environ = dict(base_environ)
+        cgi_environ.update((k, str(environ[k])) for k in CGI_VARIABLES if k in environ)
+        cgi_environ.update((k, str(v)) for k, v in environ.items() if k.startswith('HTTP_'))
+        if trust_remote_user_header and environ.get('HTTP_X_REMOTE_USER'):
+            cgi_environ['REMOTE_USER'] = environ['HTTP_X_REMOTE_USER']
+        cgi_environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '').rstrip('/') + path_info
+        cgi_environ['GATEWAY_INTERFACE'] = 'CGI/1.1'
+        status, headers, body = split_cgi_response(run_cgi_script(script, cgi_environ, stdin))
+        # `htmlgen.Response' may have sent one already
+        headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        start_response(status, headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+    return application
+
+
+def serve_static(app_dir: str, path_info: str, start_response: Callable) -> Iterable[bytes]:
+    path = os.path.realpath(os.path.join(app_dir, path_info.lstrip('/')))
+    if (not path.startswith(app_dir + os.sep)
+            or not path.endswith(STATIC_EXTENSIONS)
+            or not os.path.isfile(path)):
+        start_response('404 Not Found', [('Content-Type', 'text/plain; charset=utf-8')])
+        return [b'Not Found']
+    with open(path, 'rb') as f:
+        body = f.read()
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    start_response('200 OK', [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def serve_prefork(application, host: str, port: int, workers: int) -> None:
+    from wsgiref.simple_server import make_server
+    httpd = make_server(host, port, application)
+    children = _PREFORK_CHILDREN
+    for _ in range(max(workers, 1) - 1):
+        pid = os.fork()
+        if pid == 0:
+            children.clear()
+            break
+        children.append(pid)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def serve_fastcgi(application, bind_address: str) -> None:
+    try:
+        from flup.server.fcgi import WSGIServer
+    except ImportError:
+        sys.exit('FastCGI mode needs the `flup\' package: pip install flup')
+    WSGIServer(application, bindAddress=bind_address).run()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Serve the CGI scripts from one long-running process')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='size of the prefork pool')
+    parser.add_argument('--fastcgi', metavar='SOCKET', help='serve FastCGI on this UNIX socket instead of HTTP')
+    parser.add_argument('--trust-remote-user-header', action='store_true',
+                        help='take REMOTE_USER from the X-Remote-User header set by the reverse proxy')
+    args = parser.parse_args(argv)
+    application = make_application(trust_remote_user_header=args.trust_remote_user_header)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, _reload_configuration)
+    if args.fastcgi:
+        serve_fastcgi(application, args.fastcgi)
+    else:
+        serve_prefork(application, args.host, args.port, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,17 +5,15 @@
 #
 # uuid_hex=00112233445566778899aabbccddeeff
 # (cd app && env QUERY_STRING=uuid_hex=$uuid_hex REQUEST_METHOD=GET SERVER_NAME=localhost SCRIPT_NAME=show_reservation.cgi python3 show_reservation.cgi)
-import cgi
-import cgitb
 import os
 import time
 from urllib.parse import ParseResult
-import qrcode
-from qrcode.image.svg import SvgPathFillImage
 
 import config
 from htmlgen import (
     cents_to_euro,
+    conditional_get,
+    enable_cgitb,
     format_bank_id,
     html_document,
     pluriel_naif,
@@ -24,10 +22,12 @@ from htmlgen import (
     respond_html,
 )
 from lib_post_reservation import generate_payment_QR_code_content, make_show_reservation_url
+from lib_qr_codes import svg_qr_code
 from storage import(
     Payment,
     Reservation,
     create_db,
+    data_version,
 )
 
 
@@ -49,7 +49,7 @@ if __name__ == '__main__':
         redirect_to_event()
     CONFIGURATION = config.get_configuration()
 
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     MAIN_STARTER_NAME = CONFIGURATION["main_starter_name"]
     MAIN_STARTER_NAME_PLURAL = CONFIGURATION["main_starter_name_plural"]
@@ -75,6 +75,7 @@ if __name__ == '__main__':
     ORGANIZER_NAME = CONFIGURATION["organizer_name"]
 
     try:
+        import cgi
         # Get form data
         form = cgi.FieldStorage()
         uuid_hex = form.getfirst('uuid_hex', default='')
@@ -83,15 +84,14 @@ if __name__ == '__main__':
             assert uuid_hex
 
         db_connection = create_db(CONFIGURATION)
+        # Guests reload this page to see whether their transfer arrived
+        versions, last_modified = data_version(db_connection, (Reservation, Payment))
+        validators = conditional_get((uuid_hex, SCRIPT_NAME, SERVER_NAME, versions), last_modified)
         reservation = Reservation.find_by_uuid(db_connection, uuid_hex)
         if not reservation:
             redirect_to_event()
             assert reservation is not None
 
-        if print_content_type('text/html; charset=utf-8'):
-            print('Content-Language: en')
-            print()
-
         human_date = '/'.join(reversed(reservation.date.split('-')))
         commandes_data = [
             x for x in (commande('Entrée',
@@ -137,9 +137,8 @@ if __name__ == '__main__':
                     "structurée ", ("code", format_bank_id(reservation.bank_id)), " sur le compte ",
                     BANK_ACCOUNT, " (bénéficiaire '", ORGANIZER_NAME, "') pour votre réservation, p.ex. en scannant ce code QR avec votre application bancaire mobile (testé avec Argenta, Belfius Mobile et BNP Paribas Fortis Easy Banking; incompatible avec Payconiq): ",
                     ('br',),
-                    ('raw', qrcode.make(generate_payment_QR_code_content(remaining_due, reservation.bank_id, CONFIGURATION),
-                                        image_factory=SvgPathFillImage
-                                        ).to_string().decode('utf8')),
+                    ('raw', svg_qr_code(generate_payment_QR_code_content(remaining_due, reservation.bank_id, CONFIGURATION),
+                                        CONFIGURATION)),
                     ('br',),
                     last_payment_update,
                 )
@@ -165,7 +164,8 @@ if __name__ == '__main__':
              ('p',
               'Ajoutez ', (('a', 'href', self_url), 'cette page'), " à vos favoris ou scannez ce code QR pour suivre l'état actuel de votre réservation:",
               ("br",),
-              ('raw', qrcode.make(self_url, image_factory=SvgPathFillImage).to_string().decode('utf8'))))))
+              ('raw', svg_qr_code(self_url, CONFIGURATION))))),
+            headers=validators)
     except Exception:
         # cgitb needs the content-type header
         if print_content_type('text/html; charset=utf-8'):
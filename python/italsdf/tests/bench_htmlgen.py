@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+'''Compare `htmlgen.html_document' with the recursive renderer it replaced
+
+Renders the `list_reservations.cgi' and `generate_tickets.cgi' pages of a
+synthetic event with both renderers, checks that they produce the same HTML
+and prints their timings:
+
+    python3 bench_htmlgen.py [reservations [repetitions]]
+'''
+import contextlib
+import html
+import io
+import os
+import runpy
+import sys
+import tempfile
+import time
+
+import sys_path_hack
+from conftest import make_reservation
+
+
+def legacy_html_gen(data):
+    def is_tuple(x):
+        return type(x) is tuple
+    if is_tuple(data) and len(data) == 2 and data[0] == 'raw':
+        yield data[1]
+    elif is_tuple(data):
+        tag_name = None
+        empty_elt = len(data) == 1
+        for elt in data:
+            if tag_name is None:
+                tag = elt
+                if is_tuple(tag):
+                    tag_name = str(tag[0])
+                    attr_values = []
+                    for idx in range(1, len(tag), 2):
+                        attr_values.append((tag[idx], html.escape(tag[idx + 1], quote=True)))
+                    yield '<' + tag_name + ' ' + ' '.join(f'{x}="{y}"' for (x, y) in attr_values) + '>'
+                else:
+                    tag_name = str(tag)
+                    yield f'<{tag_name}>'
+                empty_elt = tag_name.lower() in (
+                    'area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                    'input', 'keygen', 'link', 'meta', 'param', 'source',
+                    'track', 'wbr',)
+            else:
+                for x in legacy_html_gen(elt):
+                    yield x
+        if not empty_elt:
+            yield f'</{tag_name}>'
+    else:
+        yield html.escape(str(data), quote=False)
+
+
+def legacy_html_document(title, body, with_banner=True):
+    yield '<!DOCTYPE HTML>'
+    for x in legacy_html_gen((('html', 'lang', 'fr'),
+                              ('head',
+                               (('meta', 'charset', 'utf-8'),),
+                               (('meta', 'name', 'viewport', 'content', 'width=device-width, initial-scale=1.0'),),
+                               ('title', title),
+                               (('link', 'rel', 'stylesheet', 'href', 'styles.css'),),
+                               (('link',
+                                 'rel', 'stylesheet',
+                                 'href', 'https://cdn.jsdelivr.net/npm/bootstrap@3.4.1/dist/css/bootstrap.min.css',
+                                 'integrity', "sha384-HSMxcRTRxnN+Bdg0JdbxYKrThecOKuH5zCYotlSAcp1+c8xmyTe9GYg1l9a69psu",
+                                 'crossorigin', "anonymous"),)),
+                              ('body',
+                               ((('div', 'id', 'branding', 'role', 'banner'),
+                                 (('h1', 'id', 'site-title'),
+                                  "Société Royale d'Harmonie de Braine-l'Alleud"),
+                                 (('img', 'src', 'https://www.srhbraine.be/wp-content/uploads/2019/10/site-en-tete.jpg', 'width', "940", "height", "198", "alt", ""),))
+                                if with_banner else
+                                ''),
+                               *body,
+                               ('hr', ),
+                               ('p',
+                                'Retour au ',
+                                (('a', 'href', 'https://www.srhbraine.be/'),
+                                 "site de la Société Royale d'Harmonie de Braine-l'Alleud"),
+                                '.')))):
+        yield x
+
+
+def capture_page(htmlgen, script: str, environment: dict[str, str]) -> tuple[str, list, dict]:
+    '''Run a CGI script and return the arguments it passed to `html_document' '''
+    captured = []
+
+    def capturing_html_document(title, body, **kwargs):
+        captured.append((title, list(body), kwargs))
+        return iter(())
+
+    script_dir, script_name = os.path.split(script)
+    cwd = os.getcwd()
+    original = htmlgen.html_document, os.environ.copy()
+    htmlgen.html_document = capturing_html_document
+    os.environ.update(environment, SCRIPT_NAME=script_name)
+    try:
+        os.chdir(script_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path(script_name, run_name='__main__')
+    finally:
+        os.chdir(cwd)
+        htmlgen.html_document = original[0]
+        os.environ.clear()
+        os.environ.update(original[1])
+    return captured[0]
+
+
+def timing(render, title, body, kwargs, repetitions: int) -> tuple[float, str]:
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        result = ''.join(render(title, body, **kwargs))
+    return (time.perf_counter() - start) / repetitions, result
+
+
+def main(reservations: int=300, repetitions: int=20) -> int:
+    with tempfile.TemporaryDirectory() as dbdir:
+        os.environ['TEMP'] = dbdir
+        with sys_path_hack.app_in_path():
+            import create_tickets
+            import htmlgen
+            import storage
+        app_dir = os.path.dirname(os.path.abspath(htmlgen.__file__))
+        connection = storage.create_db({'dbdir': dbdir})
+        with connection:
+            for idx in range(reservations):
+                make_reservation(name=f'Name {idx}', email=f'mail{idx}@example.com', places=4, uuid=f'uuid{idx}',
+                                 bank_id=f'{idx:012}', date=('2024-03-23', '2024-03-24')[idx % 2],
+                                 outside_main_starter=2, inside_extra_starter=2, inside_main_dish=2,
+                                 inside_third_dish=1, kids_main_dish=1, inside_main_dessert=2,
+                                 kids_main_dessert=1).insert_data(connection)
+        environment = {'REQUEST_METHOD': 'GET', 'REMOTE_USER': 'bench', 'REMOTE_ADDR': '127.0.0.1',
+                       'SERVER_NAME': 'localhost', 'QUERY_STRING': f'limit={reservations}'}
+        pages = {
+            'list_reservations': capture_page(
+                htmlgen, os.path.join(app_dir, 'gestion', 'list_reservations.cgi'), environment),
+            # Same tree as `generate_tickets.cgi' builds for a POST request
+            'generate_tickets': (
+                'Liste des tickets à imprimer',
+                list(create_tickets.create_full_ticket_list(
+                    connection,
+                    storage.Reservation.with_paid_cents(
+                        connection,
+                        storage.Reservation.select(connection, filtering=[('active', True)], order_columns=['date', 'name', 'email'])),
+                    **{key: 10 * reservations for key in ('main_starter', 'extra_starter', 'main_dish', 'extra_dish',
+                                                          'third_dish', 'kids_main_dish', 'kids_extra_dish',
+                                                          'kids_third_dish', 'main_dessert', 'extra_dessert')})),
+                {'with_banner': False}),
+        }
+        mismatches = 0
+        for name, (title, body, kwargs) in pages.items():
+            before, expected = timing(legacy_html_document, title, body, kwargs, repetitions)
+            after, actual = timing(htmlgen.html_document, title, body, kwargs, repetitions)
+            mismatches += expected != actual
+            print(f'{name}: {len(actual):,} characters, before {before * 1000:.1f} ms, after {after * 1000:.1f} ms'
+                  f' ({before / after:.1f}x){"" if expected == actual else ", MISMATCH"}')
+        return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*map(int, sys.argv[1:])))
+
+# Local Variables:
+# compile-command: "python3 bench_htmlgen.py"
+# End:
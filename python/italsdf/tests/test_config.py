@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import sys_path_hack
+
+with sys_path_hack.app_in_path():
+    import config
+
+
+class GetConfiguration(unittest.TestCase):
+    def setUp(self):
+        self.script_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.script_dir.name, 'configuration.json')
+        self.patcher = patch.object(config, 'SCRIPT_DIR', self.script_dir.name)
+        self.patcher.start()
+        config.forget_configuration()
+
+    def tearDown(self):
+        config.forget_configuration()
+        self.patcher.stop()
+        self.script_dir.cleanup()
+
+    def write(self, configuration, mtime_ns):
+        with open(self.path, 'w') as f:
+            json.dump(configuration, f)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_file_is_parsed_once_while_unchanged(self):
+        self.write({'info_email': 'a@example.com'}, 10**18)
+        with patch.object(config, 'load_configuration', wraps=config.load_configuration) as load:
+            first = config.get_configuration()
+            second = config.get_configuration()
+        self.assertIs(first, second)
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(first['info_email'], 'a@example.com')
+        self.assertEqual(first['main_dish_short'], 'Bolo')
+
+    def test_changed_file_is_parsed_again(self):
+        self.write({'info_email': 'a@example.com'}, 10**18)
+        first = config.get_configuration()
+        self.write({'info_email': 'b@example.com'}, 10**18 + 1)
+        self.assertEqual(config.get_configuration()['info_email'], 'b@example.com')
+        os.unlink(self.path)
+        self.assertEqual(config.get_configuration()['info_email'], 'nobody@example.com')
+        self.assertEqual(first['info_email'], 'a@example.com')
+
+    def test_configuration_is_read_only(self):
+        with self.assertRaises(TypeError):
+            config.get_configuration()['dbdir'] = ':memory:'
+
+    def test_dishes(self):
+        self.write({'main_dish_name': 'Lasagne', 'main_dish_ticket': 'Lasagne (ticket)'}, 10**18)
+        dishes = config.get_dishes()
+        self.assertEqual(tuple(dishes), config.DISH_KEYS)
+        self.assertEqual(dishes['main_dish'], config.Dish(
+            name='Lasagne', name_plural='Spaghettis bolognaise', short='Bolo',
+            ticket='Lasagne (ticket)', image='ticket-image.png'))
+        self.assertEqual(dishes['extra_dish'].ticket, 'Spaghetti aux scampis')
+        self.assertIs(config.get_dishes(), dishes)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "python3 test_config.py"
+# End:
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import io
+import json
+import os
+import tempfile
 import unittest
+import zipfile
 from unittest.mock import patch
 
 import sys_path_hack
 from conftest import make_reservation
 
 with sys_path_hack.app_in_path():
+    import config
     import create_tickets
+    import htmlgen
     import storage
 
 
@@ -50,6 +57,11 @@ EXTRA_DESSERT = ((('div', 'class', 'ticket-left-col'),
                   ('div', 'table n°'), ('div', 'serveur'), ('div', 'dessert:'), ('div', 'extra_dessert_ticket')),
                  ('div', (('img', 'src', 'extra_dessert_image'),)))
 
+# Each distinct ticket is rendered once and its HTML repeated
+(EXTRA_STARTER, MAIN_STARTER, MAIN_DISH, EXTRA_DISH, THIRD_DISH, KIDS_MAIN_DISH, MAIN_DESSERT, EXTRA_DESSERT) = (
+    (('raw', ''.join(htmlgen.render(div) for div in ticket)),)
+    for ticket in (EXTRA_STARTER, MAIN_STARTER, MAIN_DISH, EXTRA_DISH, THIRD_DISH, KIDS_MAIN_DISH, MAIN_DESSERT, EXTRA_DESSERT))
+
 
 def expected_result_1(expected_price='210.00 €'):
     return [(('div', 'class', 'no-print-page-break'),
@@ -70,58 +82,32 @@ def expected_result_1(expected_price='210.00 €'):
              *EXTRA_DESSERT)]
 
 
+TEST_DISHES = config.make_dishes({
+    f'{key}_{field}': value
+    for key in config.DISH_KEYS
+    for field, value in (('name', 'bolo' if key == 'main_dish' else key),
+                         ('name_plural', f'{key}_plural'),
+                         ('short', f'{key}_short'),
+                         ('ticket', 'bolo_ticket' if key == 'main_dish' else f'{key}_ticket'),
+                         ('image', f'{key}_image'))})
+
+
 class ConfiguredTestCase(unittest.TestCase):
     patched_payments = None
+    patched_dishes = None
 
     @classmethod
     def setUpClass(cls):
         cls.maxDiff = None
-        create_tickets.MAIN_STARTER_NAME = "main_starter"
-        create_tickets.MAIN_STARTER_TICKET = "main_starter_ticket"
-        create_tickets.MAIN_STARTER_NAME_PLURAL = "main_starter_plural"
-        create_tickets.EXTRA_STARTER_NAME = "extra_starter"
-        create_tickets.EXTRA_STARTER_TICKET = "extra_starter_ticket"
-        create_tickets.EXTRA_STARTER_NAME_PLURAL = "extra_starter_plural"
-        create_tickets.MAIN_DISH_NAME = "bolo"
-        create_tickets.MAIN_DISH_TICKET = "bolo_ticket"
-        create_tickets.MAIN_DISH_NAME_PLURAL = "main_dish_plural"
-        create_tickets.EXTRA_DISH_NAME = "extra_dish"
-        create_tickets.EXTRA_DISH_TICKET = "extra_dish_ticket"
-        create_tickets.EXTRA_DISH_NAME_PLURAL = "extra_dish_plural"
-        create_tickets.THIRD_DISH_NAME = "third_dish"
-        create_tickets.THIRD_DISH_TICKET = "third_dish_ticket"
-        create_tickets.THIRD_DISH_NAME_PLURAL = "third_dish_plural"
-        create_tickets.MAIN_DESSERT_NAME = "main_dessert"
-        create_tickets.MAIN_DESSERT_TICKET = "main_dessert_ticket"
-        create_tickets.MAIN_DESSERT_NAME_PLURAL = "main_dessert_plural"
-        create_tickets.EXTRA_DESSERT_NAME = "extra_dessert"
-        create_tickets.EXTRA_DESSERT_TICKET = "extra_dessert_ticket"
-        create_tickets.EXTRA_DESSERT_NAME_PLURAL = "extra_dessert_plural"
-        create_tickets.KIDS_MAIN_DISH_NAME = "kids_main_dish"
-        create_tickets.KIDS_MAIN_DISH_TICKET = "kids_main_dish_ticket"
-        create_tickets.KIDS_MAIN_DISH_NAME_PLURAL = "kids_main_dish_plural"
-        create_tickets.KIDS_EXTRA_DISH_NAME = "kids_extra_dish"
-        create_tickets.KIDS_EXTRA_DISH_TICKET = "kids_extra_dish_ticket"
-        create_tickets.KIDS_EXTRA_DISH_NAME_PLURAL = "kids_extra_dish_plural"
-        create_tickets.KIDS_THIRD_DISH_NAME = "kids_third_dish"
-        create_tickets.KIDS_THIRD_DISH_TICKET = "kids_third_dish_ticket"
-        create_tickets.KIDS_THIRD_DISH_NAME_PLURAL = "kids_third_dish_plural"
-        create_tickets.MAIN_STARTER_IMAGE = "main_starter_image"
-        create_tickets.EXTRA_STARTER_IMAGE = "extra_starter_image"
-        create_tickets.MAIN_DISH_IMAGE = "main_dish_image"
-        create_tickets.EXTRA_DISH_IMAGE = "extra_dish_image"
-        create_tickets.THIRD_DISH_IMAGE = "third_dish_image"
-        create_tickets.MAIN_DESSERT_IMAGE = "main_dessert_image"
-        create_tickets.EXTRA_DESSERT_IMAGE = "extra_dessert_image"
-        create_tickets.KIDS_MAIN_DISH_IMAGE = "kids_main_dish_image"
-        create_tickets.KIDS_EXTRA_DISH_IMAGE = "kids_extra_dish_image"
-        create_tickets.KIDS_THIRD_DISH_IMAGE = "kids_third_dish_image"
+        cls.patched_dishes = patch.object(config, 'get_dishes', return_value=TEST_DISHES)
+        cls.patched_dishes.__enter__()
         cls.patched_payments = patch("storage.Payment")
         cls.patched_payments.__enter__().sum_payments.return_value = 0
 
     @classmethod
     def tearDownClass(cls):
         cls.patched_payments.__exit__(None, None, None)
+        cls.patched_dishes.__exit__(None, None, None)
 
 
 class TestOneReservation(ConfiguredTestCase):
@@ -269,39 +255,165 @@ class TestFullTicketList(ConfiguredTestCase):
               *MAIN_DESSERT, *EXTRA_DESSERT)])
     
 
-class UlForMenuDataTests(unittest.TestCase):
-    @classmethod
-    def setUpClass(cls):
-        cls.maxDiff = None
-        create_tickets.MAIN_STARTER_NAME = "main_starter"
-        create_tickets.MAIN_STARTER_TICKET = "main_starter_ticket"
-        create_tickets.MAIN_STARTER_NAME_PLURAL = "main_starter_plural"
-        create_tickets.EXTRA_STARTER_NAME = "extra_starter"
-        create_tickets.EXTRA_STARTER_TICKET = "extra_starter_ticket"
-        create_tickets.EXTRA_STARTER_NAME_PLURAL = "extra_starter_plural"
-        create_tickets.MAIN_DISH_NAME = "bolo"
-        create_tickets.MAIN_DISH_TICKET = "bolo_ticket"
-        create_tickets.MAIN_DISH_NAME_PLURAL = "main_dish_plural"
-        create_tickets.EXTRA_DISH_NAME = "extra_dish"
-        create_tickets.EXTRA_DISH_TICKET = "extra_dish_ticket"
-        create_tickets.EXTRA_DISH_NAME_PLURAL = "extra_dish_plural"
-        create_tickets.EXTRA_DESSERT_NAME = "extra_dessert"
-        create_tickets.EXTRA_DESSERT_TICKET = "extra_dessert_ticket"
-        create_tickets.EXTRA_DESSERT_NAME_PLURAL = "extra_dessert_plural"
-        create_tickets.KIDS_MAIN_DISH_NAME = "kids_main_dish"
-        create_tickets.KIDS_MAIN_DISH_TICKET = "kids_main_dish_ticket"
-        create_tickets.KIDS_MAIN_DISH_NAME_PLURAL = "kids_main_dish_plural"
-        create_tickets.KIDS_EXTRA_DISH_NAME = "kids_extra_dish"
-        create_tickets.KIDS_EXTRA_DISH_TICKET = "kids_extra_dish_ticket"
-        create_tickets.KIDS_EXTRA_DISH_NAME_PLURAL = "kids_extra_dish_plural"
-        create_tickets.MAIN_STARTER_IMAGE = "main_starter_image"
-        create_tickets.EXTRA_STARTER_IMAGE = "extra_starter_image"
-        create_tickets.MAIN_DISH_IMAGE = "main_dish_image"
-        create_tickets.EXTRA_DISH_IMAGE = "extra_dish_image"
-        create_tickets.EXTRA_DESSERT_IMAGE = "extra_dessert_image"
-        create_tickets.KIDS_MAIN_DISH_IMAGE = "kids_main_dish_image"
-        create_tickets.KIDS_EXTRA_DISH_IMAGE = "kids_extra_dish_image"
-
+class TestTicketSheets(unittest.TestCase):
+    POOLS = {'main_starter': 5, 'extra_starter': 3, 'main_dish': 6, 'extra_dish': 9, 'third_dish': 3,
+             'kids_main_dish': 3, 'kids_extra_dish': 0, 'kids_third_dish': 0, 'main_dessert': 11, 'extra_dessert': 11}
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.configuration = {'dbdir': self.db_dir.name}
+        connection = storage.create_db(self.configuration)
+        with connection:
+            make_reservation(
+                places=8, cents_due=21000,
+                outside_extra_starter=1, outside_main_starter=2,
+                outside_main_dish=2, outside_extra_dish=4, outside_third_dish=1,
+                outside_main_dessert=4, outside_extra_dessert=7).insert_data(connection)
+            make_reservation(
+                name='other', date='2022-03-20', places=4, cents_due=9550, bank_id='other', uuid='other',
+                outside_extra_starter=1, outside_main_starter=2, outside_main_dish=1, outside_extra_dish=1,
+                inside_extra_starter=1, inside_main_dish=1, inside_main_dessert=1,
+                kids_main_dish=1, kids_extra_dessert=1).insert_data(connection)
+            make_reservation(name='cancelled', places=1, kids_main_dish=1, bank_id='cancelled', uuid='cancelled',
+                             active=False).insert_data(connection)
+        self.connection = storage.create_db(self.configuration)
+
+    def tearDown(self):
+        self.connection.close()
+        self.db_dir.cleanup()
+
+    def test_split_ticket_pools(self):
+        self.assertEqual(
+            create_tickets.split_ticket_pools(
+                self.POOLS,
+                [('2022-03-19', (1, 2, 1, 2, 4, 1, 0, 0, 0, 4, 7)),
+                 ('2022-03-20', (1, 2, 2, 2, 1, 0, 1, 0, 0, 1, 1))]),
+            [('2022-03-19', {'main_starter': 3, 'extra_starter': 1, 'main_dish': 3, 'extra_dish': 6, 'third_dish': 2,
+                             'kids_main_dish': 1, 'kids_extra_dish': 0, 'kids_third_dish': 0, 'main_dessert': 7, 'extra_dessert': 9}),
+             ('2022-03-20', {'main_starter': 2, 'extra_starter': 2, 'main_dish': 3, 'extra_dish': 3, 'third_dish': 1,
+                             'kids_main_dish': 2, 'kids_extra_dish': 0, 'kids_third_dish': 0, 'main_dessert': 4, 'extra_dessert': 2})])
+
+    def assert_one_sheet_per_date(self, archive: bytes):
+        with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+            self.assertEqual(zip_file.namelist(), ['tickets-2022-03-19.html', 'tickets-2022-03-20.html'])
+            first, second = (zip_file.read(name).decode('utf-8') for name in zip_file.namelist())
+        self.assertIn('testing: 8 places le 2022-03-19', first)
+        self.assertNotIn('other', first)
+        self.assertIn('other: 4 places le 2022-03-20', second)
+        self.assertNotIn('testing', second)
+
+    def test_create_ticket_sheets(self):
+        self.assert_one_sheet_per_date(
+            create_tickets.create_ticket_sheets(self.connection, self.configuration, self.POOLS, max_workers=1))
+
+    def test_small_events_are_rendered_in_process(self):
+        with patch('concurrent.futures.ProcessPoolExecutor') as executor:
+            self.assert_one_sheet_per_date(
+                create_tickets.create_ticket_sheets(self.connection, self.configuration, self.POOLS, max_workers=2))
+        executor.assert_not_called()
+
+    def test_create_ticket_sheets_in_worker_processes(self):
+        # The workers import `create_tickets' from the parent's `sys.path'
+        with sys_path_hack.app_in_path(), \
+             patch.object(create_tickets, 'SHEET_WORKER_MIN_RESERVATIONS', 1):
+            self.assert_one_sheet_per_date(
+                create_tickets.create_ticket_sheets(self.connection, self.configuration, self.POOLS, max_workers=2))
+
+    def test_not_enough_tickets(self):
+        with self.assertRaisesRegex(RuntimeError, 'Not enough tickets'):
+            create_tickets.create_ticket_sheets(
+                self.connection, self.configuration, dict(self.POOLS, main_dish=1), max_workers=1)
+
+
+class TestConfigurationChanges(unittest.TestCase):
+    def setUp(self):
+        self.script_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.script_dir.name, 'configuration.json')
+        self.patcher = patch.object(config, 'SCRIPT_DIR', self.script_dir.name)
+        self.patcher.start()
+        config.forget_configuration()
+
+    def tearDown(self):
+        config.forget_configuration()
+        self.patcher.stop()
+        self.script_dir.cleanup()
+
+    def write(self, configuration, mtime_ns):
+        with open(self.path, 'w') as f:
+            json.dump(configuration, f)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def ticket_list(self):
+        reservation = make_reservation(places=1, inside_main_starter=1, inside_main_dish=1)
+        reservation.paid_cents = 0
+        return ''.join(htmlgen.render(element) for element in create_tickets.create_full_ticket_list(
+            object(), [reservation], **dict.fromkeys(create_tickets.TICKET_POOLS, 2)))
+
+    def test_dishes_follow_configuration_json(self):
+        self.write({'main_dish_name': 'Lasagnes', 'main_dish_image': 'lasagnes.png'}, 10**18)
+        first = self.ticket_list()
+        self.write({'main_dish_name': 'Risotto', 'main_dish_image': 'risotto.png'}, 10**18 + 1)
+        second = self.ticket_list()
+        self.assertIn('Lasagnes', first)
+        self.assertIn('lasagnes.png', first)
+        self.assertNotIn('Lasagnes', second)
+        self.assertNotIn('lasagnes.png', second)
+        self.assertIn('1m+0c Risotto', second)
+        self.assertIn('<img src="risotto.png"', second)
+
+
+class TestStreamedTicketList(unittest.TestCase):
+    def setUp(self):
+        self.connection = storage.create_db({'dbdir': ':memory:'})
+        with self.connection:
+            # More than htmlgen.RESPONSE_CHUNK_SIZE of tickets before the last one
+            for idx in range(200):
+                make_reservation(
+                    name=f'name {idx:03}', places=4, bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}',
+                    outside_main_starter=4, outside_main_dish=4, outside_main_dessert=4).insert_data(self.connection)
+        self.pools = dict(zip(create_tickets.TICKET_POOLS, storage.Reservation.count_menu_data(self.connection)[1:]))
+        self.logdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.connection.close()
+        self.logdir.cleanup()
+
+    def respond_full_ticket_list(self, pools):
+        output = io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+        with patch.object(htmlgen, '_html_gen_printed_header', False), \
+             patch.dict(os.environ, {'HTTP_ACCEPT_ENCODING': ''}):
+            create_tickets.respond_full_ticket_list(self.connection, pools, logdir=self.logdir.name, file=output)
+        return output.buffer.getvalue()
+
+    def test_enough_tickets(self):
+        create_tickets.check_ticket_pools(self.connection, self.pools)
+        output = self.respond_full_ticket_list(self.pools)
+        self.assertIn(b'name 199', output)
+        self.assertTrue(output.endswith(b'</html>'))
+        self.assertEqual(os.listdir(self.logdir.name), [])
+
+    def test_not_enough_tickets_is_found_before_streaming(self):
+        with self.assertRaisesRegex(RuntimeError, 'Not enough tickets'):
+            create_tickets.check_ticket_pools(self.connection, dict(self.pools, main_dish=self.pools['main_dish'] - 1))
+
+    def test_shortage_after_the_first_chunk(self):
+        # e.g. a reservation made after `check_ticket_pools'
+        output = self.respond_full_ticket_list(dict(self.pools, main_dish=self.pools['main_dish'] - 1))
+        head, _, body = output.partition(b'\n\n')
+        self.assertIn(b'Content-Type: text/html; charset=utf-8', head)
+        self.assertGreaterEqual(len(body), htmlgen.RESPONSE_CHUNK_SIZE)
+        self.assertNotIn(b'Not enough tickets', body)
+        self.assertTrue(body.endswith(create_tickets.INCOMPLETE_SHEET_WARNING.encode('utf-8')))
+        (log_file,) = os.listdir(self.logdir.name)
+        with open(os.path.join(self.logdir.name, log_file)) as f:
+            self.assertIn('Not enough tickets', f.read())
+
+    def test_shortage_before_the_first_chunk(self):
+        with self.assertRaisesRegex(RuntimeError, 'Not enough tickets'):
+            self.respond_full_ticket_list(dict(self.pools, main_dish=0))
+
+
+class UlForMenuDataTests(ConfiguredTestCase):
     def test_full_example(self):
         self.assertEqual(
             create_tickets.ul_for_menu_data(
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import os
+import tempfile
+import unittest
+import zlib
+from unittest.mock import patch
+
+import sys_path_hack
+
+with sys_path_hack.app_in_path():
+    import htmlgen
+
+
+class ResponseTest(unittest.TestCase):
+    @staticmethod
+    def make_output():
+        return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+
+    def test_gzip_when_accepted(self):
+        output = self.make_output()
+        body = 'Prénom,Nom\r\n' * 200
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/csv; charset=utf-8', file=output,
+                                        accept_encoding='deflate;q=0.5, gzip', compression_level=9)
+            response.write(body)
+            response.finish()
+        head, _, compressed = output.buffer.getvalue().partition(b'\n\n')
+        self.assertEqual(head.decode('latin1').splitlines(), [
+            'Content-Type: text/csv; charset=utf-8',
+            'Vary: Accept-Encoding',
+            'Content-Encoding: gzip',
+            f'Content-Length: {len(compressed)}'])
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS).decode('utf-8'), body)
+
+    def test_small_body_is_not_compressed(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/plain', file=output, accept_encoding='gzip', compression_level=6)
+            response.write('short')
+            response.finish()
+        self.assertEqual(output.buffer.getvalue(),
+                         b'Content-Type: text/plain\nVary: Accept-Encoding\nContent-Length: 5\n\nshort')
+
+    def test_streaming_deflate(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/plain', file=output, streaming=True, chunk_size=3,
+                                        accept_encoding='deflate', compression_level=6)
+            response.write_all(('abc', 'def', 'g'))
+            head, _, compressed = output.buffer.getvalue().partition(b'\n\n')
+            self.assertEqual(head, b'Content-Type: text/plain\nVary: Accept-Encoding\nContent-Encoding: deflate')
+            # Every chunk sent so far can be decoded already
+            self.assertEqual(zlib.decompressobj().decompress(compressed), b'abcdef')
+            response.finish()
+        self.assertEqual(zlib.decompress(output.buffer.getvalue().partition(b'\n\n')[2]), b'abcdefg')
+
+    def test_secret_is_not_compressed(self):
+        output = self.make_output()
+        body = '<input type="hidden" name="csrf_token" value="0123abcd">' * 100
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/html', file=output, accept_encoding='gzip', compression_level=6,
+                                        contains_secret=True)
+            response.write(body)
+            response.finish()
+        self.assertEqual(output.buffer.getvalue(),
+                         f'Content-Type: text/html\nContent-Length: {len(body)}\n\n{body}'.encode('utf-8'))
+
+    def test_compression_level_is_read_once(self):
+        with patch.object(htmlgen, '_COMPRESSION_LEVEL', None), \
+             patch.object(htmlgen.config, 'get_configuration', return_value={'compression_level': 3}) as get_configuration:
+            for _ in range(3):
+                self.assertEqual(htmlgen.Response('text/plain', file=self.make_output()).compression_level, 3)
+            htmlgen.forget_compression_level()
+            self.assertEqual(htmlgen.Response('text/plain', file=self.make_output()).compression_level, 3)
+        self.assertEqual(get_configuration.call_count, 2)
+
+    def test_respond_bytes(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            print('printed first', file=output)
+            htmlgen.respond_bytes('application/zip', b'PK\x03\x04' * 300, file=output,
+                                  headers=(('Content-Disposition', 'attachment; filename="tickets.zip"'),))
+        self.assertEqual(output.buffer.getvalue(),
+                         b'printed first\n'
+                         b'Content-Type: application/zip\n'
+                         b'Content-Disposition: attachment; filename="tickets.zip"\n'
+                         b'Content-Length: 1200\n\n' + b'PK\x03\x04' * 300)
+
+    def test_no_bytes_after_print_content_type(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', True), \
+             self.assertRaises(RuntimeError):
+            htmlgen.respond_bytes('application/zip', b'PK\x03\x04', file=output)
+        self.assertEqual(output.buffer.getvalue(), b'')
+
+    def test_negotiate_content_encoding(self):
+        for accept_encoding, expected in (
+                ('', None),
+                ('gzip, deflate, br', 'gzip'),
+                ('deflate, gzip;q=0.5', 'deflate'),
+                ('x-gzip', 'gzip'),
+                ('*', 'gzip'),
+                ('*;q=0.3, gzip;q=0', 'deflate'),
+                ('br, *;q=0', None),
+                ('identity', None),
+                ('gzip;q=bogus', None)):
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(htmlgen.negotiate_content_encoding(accept_encoding), expected)
+
+
+class ResponseAbort(unittest.TestCase):
+    @staticmethod
+    def make_output():
+        return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+
+    @staticmethod
+    def rows():
+        for idx in range(10):
+            if idx == 5:
+                raise KeyError('the culprit')
+            yield (f'Prénom {idx}', idx)
+
+    def export_csv(self, logdir, trailer=None, **kwargs):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/csv; charset=utf-8', file=output, streaming=True, **kwargs)
+            writer = csv.writer(response, 'excel')
+            try:
+                for row in self.rows():
+                    writer.writerow(row)
+                response.finish()
+            except Exception:
+                aborted = response.abort(logdir, trailer)
+        return aborted, output.buffer.getvalue()
+
+    def test_error_before_headers_were_sent(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(logdir, compression_level=0)
+            self.assertEqual(os.listdir(logdir), [])
+        self.assertFalse(aborted)
+        self.assertEqual(output, b'')
+
+    def test_error_in_the_middle_of_the_rows(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(logdir, chunk_size=20, compression_level=0)
+            (log_file,) = os.listdir(logdir)
+            with open(os.path.join(logdir, log_file)) as f:
+                self.assertIn('the culprit', f.read())
+        self.assertTrue(aborted)
+        head, _, body = output.partition(b'\n\n')
+        self.assertEqual(head, b'Content-Type: text/csv; charset=utf-8')
+        self.assertTrue(body.startswith('Prénom 0,0\r\n'.encode('utf-8')))
+        self.assertNotIn(b'<', body)
+        self.assertNotIn('Prénom 5'.encode('utf-8'), body)
+
+    def test_error_in_the_middle_of_compressed_rows(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(
+                logdir, chunk_size=20, accept_encoding='deflate', compression_level=6)
+            self.assertEqual(len(os.listdir(logdir)), 1)
+        self.assertTrue(aborted)
+        compressed = output.partition(b'\n\n')[2]
+        # The rows sent are still readable, nothing follows them
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(compressed)
+        self.assertTrue(body.startswith('Prénom 0,0\r\n'.encode('utf-8')))
+        self.assertEqual(decompressor.unused_data, b'')
+        self.assertFalse(decompressor.eof)
+
+    def test_error_with_a_trailer(self):
+        trailer = '"ERREUR: export incomplet"\r\n'
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(
+                logdir, trailer, chunk_size=20, accept_encoding='deflate', compression_level=6)
+            self.assertEqual(len(os.listdir(logdir)), 1)
+        self.assertTrue(aborted)
+        compressed = output.partition(b'\n\n')[2]
+        # A complete stream whose last row tells the reader about the error
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(compressed)
+        self.assertTrue(decompressor.eof)
+        self.assertTrue(body.startswith('Prénom 0,0\r\n'.encode('utf-8')))
+        self.assertTrue(body.endswith(b'\r\n' + trailer.encode('utf-8')))
+        self.assertNotIn('Prénom 5'.encode('utf-8'), body)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "python3 test_htmlgen.py"
+# End:
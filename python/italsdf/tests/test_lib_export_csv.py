@@ -6,6 +6,7 @@ import sys_path_hack
 from conftest import make_reservation
 
 with sys_path_hack.app_in_path():
+    import config
     import lib_export_csv
     import storage
 
@@ -58,20 +59,28 @@ class ExportDataRow(unittest.TestCase):
                     patched_payments.sum_payments.assert_called_once_with(connection, reservation.uuid)
                 self.assertEqual(writer.last_row, expected)
 
+    def test_paid_cents_known_in_advance(self):
+        writer = FakeWriter()
+        reservation = make_reservation(cents_due=1500)
+        reservation.paid_cents = 1000
+        with patch("storage.Payment") as patched_payments:
+            lib_export_csv.export_reservation(writer, object(), reservation)
+            patched_payments.sum_payments.assert_not_called()
+        self.assertEqual(writer.last_row[22], '5.00 €')
+
 
 class ExportHeaders(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        lib_export_csv.MAIN_STARTER_SHORT = "main_starter_short"
-        lib_export_csv.EXTRA_STARTER_SHORT = "extra_starter_short"
-        lib_export_csv.MAIN_DISH_SHORT = "main_dish_short"
-        lib_export_csv.EXTRA_DISH_SHORT = "extra_dish_short"
-        lib_export_csv.THIRD_DISH_SHORT = "third_dish_short"
-        lib_export_csv.KIDS_MAIN_DISH_SHORT = "kids_main_dish_short"
-        lib_export_csv.KIDS_EXTRA_DISH_SHORT = "kids_extra_dish_short"
-        lib_export_csv.KIDS_THIRD_DISH_SHORT = "kids_third_dish_short"
-        lib_export_csv.MAIN_DESSERT_SHORT = "main_dessert_short"
-        lib_export_csv.EXTRA_DESSERT_SHORT = "extra_dessert_short"
+        dishes = config.make_dishes({
+            f'{key}_{field}': f'{key}_{field}' for key in config.DISH_KEYS
+            for field in ('name', 'name_plural', 'short', 'ticket', 'image')})
+        cls.patched_dishes = patch.object(config, 'get_dishes', return_value=dishes)
+        cls.patched_dishes.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patched_dishes.__exit__(None, None, None)
 
     def test_static_values(self):
         writer = FakeWriter()
@@ -67,80 +67,58 @@ class TestHtmlDocumentWithMailTemplate(_BaseTestCase):
 
     def test_generate_email_template_for_full_payment(self):
         connection, reservation, payment = self.setup_reservation_and_payment()
-        for with_prior_csrf_token in (False, True):
-            if with_prior_csrf_token:
-                existing_token = storage.Csrf.get_by_user_and_ip(connection, self.USER, self.IP)
-            else:
-                assert storage.Csrf.length(connection) == 0
-            with self.subTest(with_prior_csrf_token=with_prior_csrf_token):
-                document = lib_payment_confirmation.html_document_with_mail_template(
-                    connection,
-                    reservation,
-                    payment,
-                    {'full_payment_confirmation_template': 'Hello, you paid for your <a href="%reservation_url%">reservation</a>.',
-                     'partial_payment_confirmation_template': '',
-                     'organizer_name': 'The Organizer',
-                     'organizer_bic': 'GEBAGEBA',
-                     'bank_account': 'BE00 1234 5678 9012'},
-                    "example.com",
-                    "/italsdf/gestion/confirm_payment.cgi",
-                    self.USER,
-                    self.IP,
-                )
-                htmlgen.respond_html(document, file=self.output)
-                self.assertEqual(storage.Csrf.length(connection), 1)
-                tokens = list(storage.Csrf.select(connection))
-                if with_prior_csrf_token:
-                    self.assertEqual(tokens[0].token, existing_token.token)
-                else:
-                    self.assertEqual((tokens[0].user, tokens[0].ip), (self.USER, self.IP))
-                result = self.output.getvalue()
-                self.assertIn(f'<p>To: emile@example.com<br>Subject: Merci pour votre réservation et votre virement</p>', result)
-                self.assertIn(f'<form method="POST" action="https://example.com/italsdf/gestion/confirm_payment.cgi">', result)
-                self.assertIn(f'<input type="hidden" name="csrf_token" value="{tokens[0].token}">', result)
-                self.assertIn(f'<input type="hidden" name="src_id" value="{payment.src_id}">', result)
-                self.assertIn(f'<a href="https://example.com/italsdf/show_reservation.cgi?uuid_hex={reservation.uuid}">', result)
+        document = lib_payment_confirmation.html_document_with_mail_template(
+            connection,
+            reservation,
+            payment,
+            {'full_payment_confirmation_template': 'Hello, you paid for your <a href="%reservation_url%">reservation</a>.',
+             'partial_payment_confirmation_template': '',
+             'organizer_name': 'The Organizer',
+             'organizer_bic': 'GEBAGEBA',
+             'bank_account': 'BE00 1234 5678 9012'},
+            "example.com",
+            "/italsdf/gestion/confirm_payment.cgi",
+            self.USER,
+            self.IP,
+        )
+        htmlgen.respond_html(document, file=self.output)
+        token = storage.Csrf.get_by_user_and_ip(connection, self.USER, self.IP).token
+        result = self.output.getvalue()
+        self.assertIn(f'<p>To: emile@example.com<br>Subject: Merci pour votre réservation et votre virement</p>', result)
+        self.assertIn(f'<form method="POST" action="https://example.com/italsdf/gestion/confirm_payment.cgi">', result)
+        self.assertIn(f'<input type="hidden" name="csrf_token" value="{token}">', result)
+        self.assertIn(f'<input type="hidden" name="src_id" value="{payment.src_id}">', result)
+        self.assertIn(f'<a href="https://example.com/italsdf/show_reservation.cgi?uuid_hex={reservation.uuid}">', result)
 
     def test_generate_email_template_for_partial_payment(self):
         connection, reservation, payment = self.setup_reservation_and_payment(missing_cents=123)
-        for with_prior_csrf_token in (False, True):
-            if with_prior_csrf_token:
-                existing_token = storage.Csrf.get_by_user_and_ip(connection, self.USER, self.IP)
-            else:
-                assert storage.Csrf.length(connection) == 0
-            with self.subTest(with_prior_csrf_token=with_prior_csrf_token):
-                document = lib_payment_confirmation.html_document_with_mail_template(
-                    connection,
-                    reservation,
-                    payment,
-                    {'full_payment_confirmation_template': '',
-                     'partial_payment_confirmation_template': 'Hello, your payment for <a href="%reservation_url%">your reservation</a> was incomplete and you still owe us %remaining_amount_in_euro%. Please make a bank transfert to %organizer_name% %bank_account% %organizer_bic% %formatted_bank_id%',
-                     'organizer_name': 'The <Organizer>',
-                     'organizer_bic': 'GEBAGEBA',
-                     'bank_account': 'BE00 1234 5678 9012'},
-                    "example.com",
-                    "/italsdf/gestion/confirm_payment.cgi",
-                    self.USER,
-                    self.IP,
-                )
-                htmlgen.respond_html(document, file=self.output)
-                self.assertEqual(storage.Csrf.length(connection), 1)
-                tokens = list(storage.Csrf.select(connection))
-                if with_prior_csrf_token:
-                    self.assertEqual(tokens[0].token, existing_token.token)
-                else:
-                    self.assertEqual((tokens[0].user, tokens[0].ip), (self.USER, self.IP))
-                result = self.output.getvalue()
-                self.assertIn(f'<p>To: emile@example.com<br>Subject: Merci pour votre réservation et votre virement</p>', result)
-                self.assertIn(f'<form method="POST" action="https://example.com/italsdf/gestion/confirm_payment.cgi">', result)
-                self.assertIn(f'<input type="hidden" name="csrf_token" value="{tokens[0].token}">', result)
-                self.assertIn(f'<input type="hidden" name="src_id" value="{payment.src_id}">', result)
-                self.assertIn(f'<a href="https://example.com/italsdf/show_reservation.cgi?uuid_hex={reservation.uuid}">', result)
-                self.assertIn(' 1.23. ', result)
-                self.assertIn('The &lt;Organizer&gt;', result)
-                self.assertIn('BE00 1234 5678 9012', result)
-                self.assertIn('GEBAGEBA', result)
-                self.assertIn('+++483/5138/12577+++', result)
+        document = lib_payment_confirmation.html_document_with_mail_template(
+            connection,
+            reservation,
+            payment,
+            {'full_payment_confirmation_template': '',
+             'partial_payment_confirmation_template': 'Hello, your payment for <a href="%reservation_url%">your reservation</a> was incomplete and you still owe us %remaining_amount_in_euro%. Please make a bank transfert to %organizer_name% %bank_account% %organizer_bic% %formatted_bank_id%',
+             'organizer_name': 'The <Organizer>',
+             'organizer_bic': 'GEBAGEBA',
+             'bank_account': 'BE00 1234 5678 9012'},
+            "example.com",
+            "/italsdf/gestion/confirm_payment.cgi",
+            self.USER,
+            self.IP,
+        )
+        htmlgen.respond_html(document, file=self.output)
+        token = storage.Csrf.get_by_user_and_ip(connection, self.USER, self.IP).token
+        result = self.output.getvalue()
+        self.assertIn(f'<p>To: emile@example.com<br>Subject: Merci pour votre réservation et votre virement</p>', result)
+        self.assertIn(f'<form method="POST" action="https://example.com/italsdf/gestion/confirm_payment.cgi">', result)
+        self.assertIn(f'<input type="hidden" name="csrf_token" value="{token}">', result)
+        self.assertIn(f'<input type="hidden" name="src_id" value="{payment.src_id}">', result)
+        self.assertIn(f'<a href="https://example.com/italsdf/show_reservation.cgi?uuid_hex={reservation.uuid}">', result)
+        self.assertIn(' 1.23. ', result)
+        self.assertIn('The &lt;Organizer&gt;', result)
+        self.assertIn('BE00 1234 5678 9012', result)
+        self.assertIn('GEBAGEBA', result)
+        self.assertIn('+++483/5138/12577+++', result)
 
 
 class TestHtmlRedirectAfterUpdatingPayment(_BaseTestCase):
@@ -168,7 +146,7 @@ class TestHtmlRedirectAfterUpdatingPayment(_BaseTestCase):
         connection, payment = self.run_a_test(True)
 
         self.assertEqual(self.output.getvalue(),
-                         'Status: 302\nLocation: https://example.com/italsdf/gestion/list_payments.cgi\n\n')
+                         'Status: 302\nLocation: https://example.com/italsdf/gestion/list_payments.cgi\nContent-Length: 0\n\n')
         pmnt = storage.Payment.find_by_src_id(connection, payment.src_id)
         self.assertEqual(pmnt.confirmation_timestamp, 1234678.91)
 
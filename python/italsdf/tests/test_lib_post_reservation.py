@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+import sqlite3
 import unittest
+from unittest.mock import patch
 
 import sys_path_hack
 
 with sys_path_hack.app_in_path():
     import lib_post_reservation
+    # Imported by `save_data_sqlite3' when it runs, i.e. outside of `app_in_path'
+    import pricing
     import storage
 
 
@@ -289,6 +293,41 @@ class ValidateDate(unittest.TestCase):
         self.assertGreater(fetched_row.cents_due, 0)
 
         
+    def save_data(self, connection, **overrides):
+        return lib_post_reservation.save_data_sqlite3(**dict(dict(
+            name='name', email='email@example.com', extra_comment='', places=1, date='2099-12-31',
+            outside_main_starter=0, outside_extra_starter=0, outside_main_dish=1, outside_extra_dish=0, outside_third_dish=0, outside_main_dessert=0, outside_extra_dessert=0,
+            inside_main_starter=0, inside_extra_starter=0, inside_main_dish=0, inside_extra_dish=0, inside_third_dish=0, inside_main_dessert=0, inside_extra_dessert=0,
+            kids_main_dish=0, kids_extra_dish=0, kids_third_dish=0, kids_main_dessert=0, kids_extra_dessert=0,
+            gdpr_accepts_use=True, origin=None, connection_or_root_dir=connection), **overrides))
+
+    def test_save_data_sqlite3_retries_bank_id_clash(self):
+        connection = storage.ensure_connection({"dbdir": ":memory:"})
+        with patch.object(lib_post_reservation, 'generate_bank_id', side_effect=['0000000001', '0000000001', '0000000002']), \
+             patch.object(lib_post_reservation.time, 'sleep') as sleep:
+            first = self.save_data(connection)
+            second = self.save_data(connection, email='other@example.com')
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(first.bank_id, lib_post_reservation.append_bank_id_control_number('0000000001'))
+        self.assertEqual(second.bank_id, lib_post_reservation.append_bank_id_control_number('0000000002'))
+        self.assertEqual(storage.Reservation.find_by_bank_id(connection, second.bank_id).email, 'other@example.com')
+
+    def test_save_data_sqlite3_gives_up_after_some_bank_id_clashes(self):
+        connection = storage.ensure_connection({"dbdir": ":memory:"})
+        with patch.object(lib_post_reservation, 'generate_bank_id', return_value='0000000001'), \
+             patch.object(lib_post_reservation.time, 'sleep'):
+            self.save_data(connection)
+            with self.assertRaises(sqlite3.IntegrityError):
+                self.save_data(connection)
+        self.assertEqual(storage.Reservation.length(connection), 1)
+
+    def test_save_data_sqlite3_does_not_retry_other_errors(self):
+        connection = storage.ensure_connection({"dbdir": ":memory:"})
+        with patch.object(lib_post_reservation, 'generate_bank_id', return_value='0000000001') as generate_bank_id:
+            with self.assertRaises(sqlite3.IntegrityError):
+                self.save_data(connection, places=0)
+        generate_bank_id.assert_called_once()
+
 if __name__ == '__main__':
     unittest.main()
 
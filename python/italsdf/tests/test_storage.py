@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
 import sqlite3
+import tempfile
+import threading
 import time
 from typing import Optional
 import unittest
+from unittest.mock import patch
 
 import sys_path_hack
 from conftest import make_payment, make_reservation
@@ -136,6 +140,20 @@ class TestReservation(unittest.TestCase):
         self.assertEqual(reservation.active, True)
         self.assertEqual(reservation.origin, 'origin')
 
+    def test_parse_from_row_builds_meal_counts_lazily(self):
+        row = ['name', 'email@example.com', 'extra_comment', 333, '2024-03-23',
+               *range(1, 20), True, 100, 'bank_id', 'uuid', 3.1415, True, 'origin', 'tail']
+        reservation, tail = storage.Reservation.parse_from_row(row)
+        self.assertEqual(tail, ['tail'])
+        self.assertFalse(hasattr(reservation, '__dict__'))
+        self.assertIsNone(reservation._outside)
+        self.assertEqual(reservation.make_into_row(), row[:-1])
+        self.assertEqual(reservation.to_dict()['kids_main_dish'], 15)
+        self.assertIsNone(reservation._kids)
+        reservation.kids.main_dish = 0
+        self.assertEqual(reservation.to_dict()['kids_main_dish'], 0)
+        self.assertEqual(reservation.make_into_row(), [*row[:19], 0, *row[20:-1]])
+
     def test_only_main_dishes_are_allowed_for_kids(self):
         for extra_dish, third_dish in ((1, 0), (0, 1)):
             with self.subTest(extra_dish=extra_dish, third_dish=third_dish):
@@ -161,6 +179,295 @@ class TestReservation(unittest.TestCase):
                 reservation.kids.main_dish, reservation.kids.extra_dish, reservation.kids.third_dish = extra_dish + third_dish, 0, 0
                 reservation.insert_data(self.connection)
 
+class TestReservationTotals(unittest.TestCase):
+    def setUp(self):
+        self.connection = storage.create_db({'dbdir': ':memory:'})
+        with self.connection:
+            for idx, (date, places, active) in enumerate((('2024-03-23', 2, True),
+                                                          ('2024-03-23', 3, False),
+                                                          ('2024-03-24', 4, True),
+                                                          ('2024-03-23', 1, True))):
+                make_reservation(name=f'n{idx}', date=date, places=places, active=active,
+                                 bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}',
+                                 inside_main_starter=idx, inside_main_dish=idx, inside_main_dessert=idx,
+                                 outside_extra_dish=places, kids_main_dish=1, kids_extra_dessert=1,
+                                 ).insert_data(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def count_menu_data_from_reservations(self, date=None):
+        # The original query scanning all reservations (except that the
+        # totals are 0 instead of None when there are no active reservations)
+        return tuple(x or 0 for x in self.connection.execute(
+            f'''SELECT COUNT(*), SUM(outside_main_starter + inside_main_starter), SUM(outside_extra_starter + inside_extra_starter), SUM(outside_main_dish + inside_main_dish), SUM(outside_extra_dish + inside_extra_dish), SUM(outside_third_dish + inside_third_dish), SUM(kids_main_dish), SUM(kids_extra_dish), SUM(kids_third_dish), SUM(outside_main_dessert + inside_main_dessert + kids_main_dessert), SUM(outside_extra_dessert + inside_extra_dessert + kids_extra_dessert) FROM reservations
+                WHERE active != 0{'' if date is None else ' AND date = :date'}''',
+            {'date': date}).fetchone())
+
+    def assertTotalsMatchReservations(self):
+        self.assertEqual(storage.Reservation.count_menu_data(self.connection), self.count_menu_data_from_reservations())
+        for date in ('2024-03-23', '2024-03-24'):
+            with self.subTest(date=date):
+                self.assertEqual(storage.Reservation.count_menu_data(self.connection, date),
+                                 self.count_menu_data_from_reservations(date))
+        self.assertEqual(storage.Reservation.length(self.connection),
+                         self.connection.execute('SELECT COUNT(*) FROM reservations').fetchone()[0])
+        self.assertEqual(list(storage.Reservation.summary_by_date(self.connection)),
+                         self.connection.execute(
+                             '''SELECT date, SUM(places) FROM reservations
+                                WHERE active != 0 GROUP BY date ORDER BY date''').fetchall())
+
+    def test_after_inserts(self):
+        self.assertEqual(storage.Reservation.length(self.connection), 4)
+        self.assertEqual(list(storage.Reservation.summary_by_date(self.connection)),
+                         [('2024-03-23', 3), ('2024-03-24', 4)])
+        self.assertEqual(storage.Reservation.count_menu_data(self.connection, '2024-03-23'),
+                         (2, 3, 0, 3, 3, 0, 2, 0, 0, 3, 2))
+        self.assertTotalsMatchReservations()
+
+    def test_after_activation_changes(self):
+        for uuid, active in (('uuid_0', False), ('uuid_1', True), ('uuid_2', False)):
+            with self.subTest(uuid=uuid, active=active):
+                with self.connection:
+                    self.connection.execute('UPDATE reservations SET active = ? WHERE uuid = ?', (active, uuid))
+                self.assertTotalsMatchReservations()
+        self.assertEqual(list(storage.Reservation.summary_by_date(self.connection)), [('2024-03-23', 4)])
+
+    def test_after_other_changes(self):
+        with self.connection:
+            self.connection.execute("UPDATE reservations SET date = '2024-03-24', places = 7 WHERE uuid = 'uuid_3'")
+            self.connection.execute("DELETE FROM reservations WHERE uuid = 'uuid_0'")
+        self.assertTotalsMatchReservations()
+
+    def test_failed_insert_is_not_counted(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.connection:
+                make_reservation(places=1, uuid='uuid_0', bank_id='new').insert_data(self.connection)
+        self.assertTotalsMatchReservations()
+
+    def test_menu_data_by_date(self):
+        self.assertEqual(storage.Reservation.menu_data_by_date(self.connection),
+                         [('2024-03-23', storage.Reservation.count_menu_data(self.connection, '2024-03-23')),
+                          ('2024-03-24', storage.Reservation.count_menu_data(self.connection, '2024-03-24'))])
+
+
+class TestKeysetPagination(unittest.TestCase):
+    def setUp(self):
+        self.connection = storage.create_db({'dbdir': ':memory:'})
+        with self.connection:
+            for idx in range(23):
+                make_reservation(name=f'n{idx % 4}', places=1 + idx % 3, date=f'2024-03-2{3 + idx % 2}',
+                                 origin=None if idx % 5 == 0 else f'o{idx % 2}',
+                                 bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}',
+                                 ).insert_data(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def expected_uuids(self, order_columns):
+        # The tiebreaker follows the direction of the last column
+        return [row[0] for row in self.connection.execute(
+            'SELECT uuid FROM reservations ORDER BY ' + ','.join(
+                [storage.Reservation.column_ordering_clause(col) for col in order_columns]
+                + ['rowid DESC' if order_columns and order_columns[-1].isupper() else 'rowid']))]
+
+    def test_walk_forward_and_back(self):
+        for order_columns in ([], ['name'], ['NAME'], ['origin', 'PLACES'], ['ORIGIN', 'date'], ['unknown', 'places']):
+            expected = self.expected_uuids([col for col in order_columns if col != 'unknown'])
+            for limit in (1, 5, 23, 30):
+                with self.subTest(order_columns=order_columns, limit=limit):
+                    pages = [storage.Reservation.select_page(self.connection, order_columns=order_columns, limit=limit)]
+                    self.assertFalse(pages[0].has_previous)
+                    while pages[-1].has_next:
+                        pages.append(storage.Reservation.select_page(
+                            self.connection, order_columns=order_columns, limit=limit, after=pages[-1].last_key))
+                        self.assertTrue(pages[-1].has_previous)
+                    self.assertEqual([r.uuid for page in pages for r in page.items], expected)
+                    self.assertEqual(len(pages), (len(expected) + limit - 1) // limit)
+                    backwards = [pages[-1]]
+                    while backwards[-1].has_previous:
+                        backwards.append(storage.Reservation.select_page(
+                            self.connection, order_columns=order_columns, limit=limit, before=backwards[-1].first_key))
+                        self.assertTrue(backwards[-1].has_next)
+                    self.assertEqual([[r.uuid for r in page.items] for page in reversed(backwards)],
+                                     [[r.uuid for r in page.items] for page in pages])
+                    self.assertEqual(
+                        [r.uuid for r in storage.Reservation.select(
+                            self.connection, order_columns=order_columns, limit=limit, after=pages[0].last_key)],
+                        expected[limit:2 * limit])
+
+    def test_filtering(self):
+        page = storage.Reservation.select_page(self.connection, filtering=[('name', 'n1')], order_columns=['PLACES'], limit=4)
+        self.assertEqual([r.uuid for r in page.items], ['uuid_17', 'uuid_5', 'uuid_13', 'uuid_1'])
+        page = storage.Reservation.select_page(
+            self.connection, filtering=[('name', 'n1')], order_columns=['PLACES'], limit=4, after=page.last_key)
+        self.assertEqual([r.uuid for r in page.items], ['uuid_21', 'uuid_9'])
+        self.assertFalse(page.has_next)
+
+    def test_offset_without_key(self):
+        page = storage.Reservation.select_page(self.connection, order_columns=['name'], limit=5, offset=3)
+        self.assertEqual([r.uuid for r in page.items], self.expected_uuids(['name'])[3:8])
+        self.assertTrue(page.has_previous)
+        self.assertTrue(page.has_next)
+
+    def query_plan(self, table, **kwargs):
+        query, params, _ = table.keyset_query(
+            kwargs.get('filtering', [('active', True)]), kwargs.get('order_columns', []), 5,
+            kwargs.get('after'), kwargs.get('before'))
+        return ' '.join(row[-1] for row in self.connection.execute('EXPLAIN QUERY PLAN ' + query, params))
+
+    def test_declared_indexes(self):
+        self.assertIn('index_name_reservations',
+                      [row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")])
+        for order_columns, key in ((['name'], ['n1', 4]), (['NAME'], ['n1', 4]), (['places'], [2, 4]), (['date'], ['2024-03-23', 4])):
+            for cursor in ('after', 'before'):
+                with self.subTest(order_columns=order_columns, cursor=cursor):
+                    plan = self.query_plan(storage.Reservation, order_columns=order_columns, **{cursor: key})
+                    self.assertIn(f'USING INDEX index_{order_columns[0].lower()}_reservations', plan)
+                    self.assertNotIn('TEMP B-TREE', plan)
+        # Ascending walks seek in the index directly
+        self.assertIn('SEARCH reservations USING INDEX index_name_reservations',
+                      self.query_plan(storage.Reservation, order_columns=['name'], after=['n1', 4]))
+        self.assertIn('SEARCH reservations USING INDEX index_name_reservations',
+                      self.query_plan(storage.Reservation, order_columns=['NAME'], before=['n1', 4]))
+        # Descending walks too when the column is NOT NULL
+        self.assertIn('SEARCH payments USING INDEX index_src_id_payments',
+                      self.query_plan(storage.Payment, order_columns=['SRC_ID'], after=['src_9', 9]))
+        self.assertIn('SEARCH payments USING INDEX index_amount_in_cents_payments',
+                      self.query_plan(storage.Payment, order_columns=['AMOUNT_IN_CENTS'], after=[1000, 9]))
+        # The partial index is only for active rows
+        self.assertNotIn('index_name_reservations',
+                         self.query_plan(storage.Reservation, filtering=[('active', False)], order_columns=['name']))
+
+    def test_empty_table(self):
+        page = storage.Payment.select_page(self.connection, limit=10)
+        self.assertEqual(page, storage.Page(items=[], first_key=None, last_key=None, has_previous=False, has_next=False))
+
+    def test_key_from_str(self):
+        for value, expected in (('["a",1,null,2.5]', ['a', 1, None, 2.5]),
+                                (storage.keyset_key_to_str(['é', 3]), ['é', 3]),
+                                (None, None),
+                                ('', None),
+                                ('{"a": 1}', None),
+                                ('[[1]]', None),
+                                ('[1', None)):
+            with self.subTest(value=value):
+                self.assertEqual(storage.keyset_key_from_str(value), expected)
+        ordering = storage.Reservation.keyset_ordering(['NAME'])
+        self.assertEqual(storage.keyset_key_from_str('["n1",3]', ordering), ['n1', 3])
+        self.assertIsNone(storage.keyset_key_from_str('[3]', ordering))
+
+
+class TestFullTextSearch(unittest.TestCase):
+    def setUp(self):
+        self.connection = storage.create_db({'dbdir': ':memory:'})
+        with self.connection:
+            for idx, (name, email, extra_comment) in enumerate((
+                    ('Jean Dupont', 'jean@example.com', 'table près de la fenêtre'),
+                    ('Marie DUPONT', 'marie_d@example.org', ''),
+                    ('Bob "Tables"', '0475/12.34.56', 'avec Jean'),
+                    ('Émile', 'emile@example.com', '100% végétarien'))):
+                make_reservation(name=name, email=email, extra_comment=extra_comment, places=1,
+                                 bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}').insert_data(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def search(self, col, val):
+        return sorted(r.uuid for r in storage.Reservation.select(self.connection, filtering=[(col, val)]))
+
+    def search_with_like(self, col, val):
+        return sorted(row[0] for row in self.connection.execute(
+            f'SELECT uuid FROM reservations WHERE LOWER({col}) LIKE :val',
+            {'val': storage.MiniOrm.maybe_add_wildcards(val.lower())}))
+
+    def test_same_results_as_like(self):
+        for col, val in (('name', 'dupont'), ('name', 'DUP'), ('name', 'du'), ('name', 'j'),
+                         ('name', '"Tables"'), ('name', 'jean%pont'), ('name', 'zzz'),
+                         ('email', 'example.com'), ('email', '@'), ('email', 'marie_d'), ('email', '12.34'),
+                         ('extra_comment', 'jean'), ('extra_comment', '100%')):
+            with self.subTest(col=col, val=val):
+                self.assertEqual(self.search(col, val), self.search_with_like(col, val))
+
+    def test_index_is_used(self):
+        query, params, _ = storage.Reservation.keyset_query([('name', 'dupont')], [], 10, None, None)
+        plan = ' '.join(row[-1] for row in self.connection.execute(f'EXPLAIN QUERY PLAN {query}', params))
+        self.assertIn('SEARCH reservations USING INDEX index_search_rowid_reservations', plan)
+        self.assertIn('VIRTUAL TABLE INDEX', plan)
+
+    def test_short_searches_do_not_use_the_index(self):
+        for val in ('du', 'jean%pont'):
+            with self.subTest(val=val):
+                query, params, _ = storage.Reservation.keyset_query([('name', val)], [], 10, None, None)
+                plan = ' '.join(row[-1] for row in self.connection.execute(f'EXPLAIN QUERY PLAN {query}', params))
+                self.assertNotIn('reservations_fts', plan)
+
+    def test_index_survives_vacuum(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM reservations WHERE uuid = 'uuid_1'")
+        self.connection.execute('VACUUM')
+        self.assertEqual(self.search('name', 'tables'), ['uuid_2'])
+        self.assertEqual(self.search('email', 'emile'), ['uuid_3'])
+        with self.connection:
+            make_reservation(name='Zoé Zorro', places=1, bank_id='bank_id_4', uuid='uuid_4').insert_data(self.connection)
+        self.assertEqual(self.search('name', 'zorro'), ['uuid_4'])
+        self.assertEqual(self.search('email', 'emile'), ['uuid_3'])
+
+    def test_index_follows_updates_and_deletes(self):
+        with self.connection:
+            self.connection.execute("UPDATE reservations SET name = 'Jeanne Durand' WHERE uuid = 'uuid_0'")
+            self.connection.execute("DELETE FROM reservations WHERE uuid = 'uuid_1'")
+            self.connection.execute("UPDATE reservations SET active = 0 WHERE uuid = 'uuid_2'")
+        self.assertEqual(self.search('name', 'dupont'), [])
+        self.assertEqual(self.search('name', 'durand'), ['uuid_0'])
+        self.assertEqual(self.search('name', 'tables'), ['uuid_2'])
+        self.assertEqual(
+            [r.uuid for r in storage.Reservation.select(self.connection, filtering=[('name', 'jean'), ('active', True)])],
+            ['uuid_0'])
+
+    def test_payments(self):
+        with self.connection:
+            for idx, (other_name, comment) in enumerate((('Dupont Jean', '+++123/4567/89012+++'),
+                                                         ('MARIE dupont', 'souper'),
+                                                         ('Bob', None))):
+                make_payment(rowid=None, src_id=f'src_{idx}', other_name=other_name, comment=comment,
+                             uuid=f'uuid_{idx}').insert_data(self.connection)
+        for filtering, expected in (([('other_name', 'dupont')], ['src_0', 'src_1']),
+                                    ([('other_name', 'dupont'), ('comment', '4567')], ['src_0']),
+                                    ([('comment', 'sou')], ['src_1'])):
+            with self.subTest(filtering=filtering):
+                self.assertEqual(sorted(p.src_id for p, _ in storage.Payment.join_reservations(self.connection, filtering=filtering)),
+                                 expected)
+
+
+class TestWithoutTrigramFts5(unittest.TestCase):
+    '''SQLite older than 3.34 or built without FTS5'''
+    FTS_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%fts' ORDER BY name"
+
+    def search(self, connection, val):
+        return [r.uuid for r in storage.Reservation.select(connection, filtering=[('name', val)])]
+
+    def test_like_until_the_index_can_be_created(self):
+        with patch.object(storage, 'has_trigram_fts5', return_value=False):
+            connection = storage.create_db({'dbdir': ':memory:'})
+            self.assertEqual(connection.execute(self.FTS_TABLES).fetchall(), [])
+            with connection:
+                for idx, name in enumerate(('Dupont', 'Durand')):
+                    make_reservation(name=name, places=1, bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}').insert_data(connection)
+            self.assertEqual(self.search(connection, 'dupo'), ['uuid_0'])
+            self.assertEqual(self.search(connection, 'd_'), ['uuid_0', 'uuid_1'])
+        try:
+            # The same database opened by an SQLite with trigram FTS5
+            storage.migrate_db(connection)
+            self.assertEqual([row[0] for row in connection.execute(self.FTS_TABLES)], ['payments_fts', 'reservations_fts'])
+            self.assertEqual(self.search(connection, 'dupo'), ['uuid_0'])
+            query, params, _ = storage.Reservation.keyset_query([('name', 'dupo')], [], 10, None, None)
+            self.assertIn('VIRTUAL TABLE INDEX',
+                          ' '.join(row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {query}', params)))
+        finally:
+            connection.close()
+
+
 class TestPayments(unittest.TestCase):
     CONNECTION: sqlite3.Connection
     CONFIGURATION = {}
@@ -238,6 +545,24 @@ class TestPayments(unittest.TestCase):
         if self.CONNECTION:
             self.CONNECTION.close()
 
+    def test_insert_many(self):
+        payments = [make_payment(src_id='src_id_0'), # already in the DB
+                    make_payment(src_id='bulk_1'),
+                    make_payment(src_id='bulk_2', status=None), # NOT NULL
+                    make_payment(src_id='bulk_1'), # duplicate of the 2nd one
+                    make_payment(src_id='bulk_4')]
+        length = storage.Payment.length(self.CONNECTION)
+        with storage.write_transaction(self.CONNECTION):
+            outcomes = storage.Payment.insert_many(self.CONNECTION, payments, chunk_size=3)
+        self.assertEqual([pmnt for _, pmnt in outcomes], payments)
+        self.assertEqual([exc is None for exc, _ in outcomes], [False, True, False, False, True])
+        self.assertEqual([storage.is_unique_constraint_error(outcomes[idx][0]) for idx in (0, 2, 3)], [True, False, True])
+        self.assertEqual(storage.Payment.length(self.CONNECTION), length + 2)
+        for pmnt in (payments[1], payments[4]):
+            self.assertEqual(
+                self.CONNECTION.execute('SELECT src_id FROM payments WHERE rowid = ?', (pmnt.rowid, )).fetchone(),
+                (pmnt.src_id, ))
+
     def test_sum_of_two_payments(self):
         self.assertEqual(storage.Payment.sum_payments(self.CONNECTION, self.UUID_WITH_TWO_PAYMENTS), 7)
 
@@ -256,6 +581,89 @@ class TestPayments(unittest.TestCase):
             with self.subTest(uuid=reservation.uuid):
                 self.assertEqual(reservation.remaining_amount_due_in_cents(self.CONNECTION), expected)
 
+    def test_paid_cents_is_maintained(self):
+        def paid_cents():
+            return storage.Reservation.paid_cents_by_uuid(self.CONNECTION)[self.UUID_WITH_TWO_PAYMENTS]
+
+        self.assertEqual(paid_cents(), 7)
+        with self.CONNECTION:
+            make_payment(src_id='new', amount_in_cents=100, uuid=self.UUID_WITH_TWO_PAYMENTS).insert_data(self.CONNECTION)
+        self.assertEqual(paid_cents(), 107)
+        p1 = storage.Payment.find_by_src_id(self.CONNECTION, "src_id_0")
+        with self.CONNECTION:
+            p1.update_uuid(self.CONNECTION, "beef12346789fedc", "unit-test-user", "1.2.3.6")
+        self.assertEqual(paid_cents(), 104)
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(self.CONNECTION, ["beef12346789fedc"]),
+                         {"beef12346789fedc": 7})
+        with self.CONNECTION:
+            p1.update_uuid(self.CONNECTION, None, "unit-test-user", "1.2.3.6")
+            p1.hide(self.CONNECTION, "unit-test-user", "1.2.3.6")
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(self.CONNECTION),
+                         {self.UUID_WITH_TWO_PAYMENTS: 104, "beef12346789fedc": 4})
+
+    def test_paid_cents_of_reservation_inserted_after_payment(self):
+        with self.CONNECTION:
+            make_payment(src_id='early', amount_in_cents=100, uuid='late').insert_data(self.CONNECTION)
+            make_reservation(places=1, bank_id='late', uuid='late').insert_data(self.CONNECTION)
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(self.CONNECTION, ['late', 'unknown']), {'late': 100})
+
+    def test_with_paid_cents(self):
+        with patch.object(storage.Payment, 'sum_payments') as sum_payments:
+            self.assertEqual(
+                [r.remaining_amount_due_in_cents(self.CONNECTION)
+                 for r in storage.Reservation.with_paid_cents(
+                         self.CONNECTION, storage.Reservation.select(self.CONNECTION, order_columns=['name']))],
+                [12345 - 7, 34512 - 4])
+            self.assertEqual(storage.Reservation.find_by_uuid(self.CONNECTION, "beef12346789fedc").remaining_amount_due_in_cents(self.CONNECTION),
+                             34512 - 4)
+            sum_payments.assert_not_called()
+
+    def test_select_for_export(self):
+        with patch.object(storage.Payment, 'sum_payments') as sum_payments:
+            self.assertEqual(
+                [(r.name, r.remaining_amount_due_in_cents(self.CONNECTION))
+                 for r in storage.Reservation.select_for_export(self.CONNECTION, batch_size=1)],
+                [('name1', 12345 - 7), ('name2', 34512 - 4)])
+            sum_payments.assert_not_called()
+
+    def test_select_for_export_changed_since(self):
+        def exported(changed_since):
+            return [r.name for r in storage.Reservation.select_for_export(self.CONNECTION, changed_since)]
+
+        def forget_changes():
+            with self.CONNECTION:
+                self.CONNECTION.execute('UPDATE reservations SET changed_at = 0')
+
+        self.assertEqual(exported(time.time() - 60), ['name1', 'name2'])
+        self.assertEqual(exported(time.time() + 60), [])
+        forget_changes()
+        self.assertEqual(exported(1), [])
+        p3 = storage.Payment.find_by_src_id(self.CONNECTION, 'src_id_2')
+        with self.CONNECTION:
+            p3.update_uuid(self.CONNECTION, self.UUID_WITH_TWO_PAYMENTS, 'unit-test-user', '1.2.3.6')
+        self.assertEqual(exported(1), ['name1', 'name2'])
+        forget_changes()
+        # Unlinking changes the reservation the payment was linked to
+        with self.CONNECTION:
+            p3.update_uuid(self.CONNECTION, None, 'unit-test-user', '1.2.3.6')
+        self.assertEqual(exported(1), ['name1'])
+        forget_changes()
+        with self.CONNECTION:
+            storage.Payment.find_by_src_id(self.CONNECTION, 'src_id_0').hide(self.CONNECTION, 'unit-test-user', '1.2.3.6')
+        self.assertEqual(exported(1), ['name1'])
+        forget_changes()
+        with self.CONNECTION:
+            self.CONNECTION.execute("UPDATE reservations SET active = 0 WHERE bank_id = 'bank_id_2'")
+        self.assertEqual(exported(1), ['name2'])
+        forget_changes()
+        with self.CONNECTION:
+            self.CONNECTION.execute("UPDATE reservations SET email = 'new@example.com' WHERE bank_id = 'bank_id_1'")
+        self.assertEqual(exported(1), ['name1'])
+        forget_changes()
+        with self.CONNECTION:
+            make_reservation(name='name0', places=1, bank_id='bank_id_0', uuid='recent').insert_data(self.CONNECTION)
+        self.assertEqual(exported(1), ['name0'])
+
     def test_join_payments_and_reservations(self):
         joined = list(storage.Payment.join_reservations(self.CONNECTION))
         self.assertEqual(len(joined), 13)
@@ -263,6 +671,23 @@ class TestPayments(unittest.TestCase):
         self.assertEqual(sum((res is not None and res.bank_id == "bank_id_1" for _, res in joined)), 2)
         self.assertEqual(sum((res is not None and res.bank_id == "bank_id_2" for _, res in joined)), 1)
 
+    def test_join_reservations_page(self):
+        # `timestamp' exists in both tables
+        expected = [row[0] for row in self.CONNECTION.execute(
+            'SELECT rowid FROM payments ORDER BY timestamp DESC, rowid')]
+        joined = dict((pmnt.rowid, res) for pmnt, res in storage.Payment.join_reservations(self.CONNECTION))
+        pages = [storage.Payment.join_reservations_page(self.CONNECTION, order_columns=['TIMESTAMP'], limit=4)]
+        while pages[-1].has_next:
+            pages.append(storage.Payment.join_reservations_page(
+                self.CONNECTION, order_columns=['TIMESTAMP'], limit=4, after=pages[-1].last_key))
+        self.assertEqual([pmnt.rowid for page in pages for pmnt, _ in page.items], expected)
+        for page in pages:
+            for pmnt, res in page.items:
+                self.assertEqual(None if res is None else res.uuid, None if joined[pmnt.rowid] is None else joined[pmnt.rowid].uuid)
+        previous = storage.Payment.join_reservations_page(
+            self.CONNECTION, order_columns=['TIMESTAMP'], limit=4, before=pages[-1].first_key)
+        self.assertEqual([pmnt.rowid for pmnt, _ in previous.items], [pmnt.rowid for pmnt, _ in pages[-2].items])
+
     def test_confirmation_timestamp(self):
         p1 = storage.Payment.find_by_src_id(self.CONNECTION, "src_id_0")
         self.assertEqual(p1.confirmation_timestamp, 864060.3)
@@ -364,6 +789,289 @@ class TestPayments_max_timestamp(unittest.TestCase):
                 self.assertLessEqual(reloaded.timestamp, after_save)
 
 
+class TestMigrations(unittest.TestCase):
+    def test_new_db_is_at_latest_version(self):
+        connection = storage.create_db({'dbdir': ':memory:'})
+        self.assertEqual(
+            connection.execute('PRAGMA user_version').fetchone()[0],
+            storage.schema_version((storage.Csrf, storage.Reservation, storage.Payment)))
+        self.assertEqual(storage.Reservation.length(connection), 0)
+
+    def test_db_created_before_versioning(self):
+        connection = sqlite3.connect(':memory:')
+        for table in (storage.Reservation, storage.Payment):
+            table.create_in_db(connection)
+        with connection:
+            make_payment().insert_data(connection)
+        storage.migrate_db(connection)
+        self.assertEqual(storage.Payment.length(connection), 1)
+        self.assertGreater(connection.execute('PRAGMA user_version').fetchone()[0], 0)
+
+    def test_csrf_table_is_dropped(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE csrfs (token TEXT NOT NULL PRIMARY KEY, timestamp REAL, user TEXT NOT NULL, ip TEXT NOT NULL)')
+        storage.migrate_db(connection)
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'csrfs'").fetchone()[0], 0)
+
+    def test_paid_cents_of_db_created_before_versioning(self):
+        connection = sqlite3.connect(':memory:')
+        for table in (storage.Reservation, storage.Payment):
+            table.create_in_db(connection)
+        with connection:
+            connection.execute(
+                f"INSERT INTO reservations VALUES ({','.join('?' * len(storage.Reservation.COLUMNS))})",
+                make_reservation(places=1, uuid='abc').make_into_row())
+            make_payment(uuid='abc', amount_in_cents=123).insert_data(connection)
+        storage.migrate_db(connection)
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(connection), {'abc': 123})
+
+    def test_totals_of_db_created_before_versioning(self):
+        connection = sqlite3.connect(':memory:')
+        for table in (storage.Reservation, storage.Payment):
+            table.create_in_db(connection)
+        with connection:
+            for idx, active in enumerate((True, False, True)):
+                connection.execute(
+                    f"INSERT INTO reservations VALUES ({','.join('?' * len(storage.Reservation.COLUMNS))})",
+                    make_reservation(places=2, inside_main_dish=1, active=active,
+                                     uuid=f'uuid_{idx}', bank_id=f'bank_id_{idx}').make_into_row())
+        storage.migrate_db(connection)
+        self.assertEqual(storage.Reservation.length(connection), 3)
+        self.assertEqual(list(storage.Reservation.summary_by_date(connection)), [('2022-03-19', 4)])
+        self.assertEqual(storage.Reservation.count_menu_data(connection)[:4], (2, 0, 0, 2))
+
+    def test_payment_indexes_cover_hidden_payments(self):
+        connection = storage.create_db({'dbdir': ':memory:'})
+        partial_indexes = {table: count for table, count in connection.execute(
+            "SELECT tbl_name, COUNT(*) FROM sqlite_master WHERE type = 'index' AND sql LIKE '%WHERE active != 0' GROUP BY tbl_name")}
+        self.assertNotIn('payments', partial_indexes)
+        self.assertIn('reservations', partial_indexes)
+        # list_payments.cgi does not filter on `active'
+        query, params, _ = storage.Payment.keyset_query(None, ['amount_in_cents'], 5, [1000, 9], None)
+        plan = ' '.join(row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + query, params))
+        self.assertIn('USING INDEX index_amount_in_cents_payments', plan)
+
+    def test_full_text_search_is_looked_for_once_per_database(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            configuration = {'dbdir': db_dir}
+            storage.create_db(configuration).close()
+            with patch.object(storage, 'missing_full_text_search', wraps=storage.missing_full_text_search) as missing:
+                for _ in range(3):
+                    storage.create_db(configuration).close()
+        self.assertEqual(missing.call_count, 1)
+
+    def test_new_steps_are_applied_once(self):
+        class Table(storage.MiniOrm):
+            TABLE_NAME = 'migration_test'
+            MIGRATIONS = {1: ['CREATE TABLE migration_test (a INTEGER)']}
+
+        connection = sqlite3.connect(':memory:')
+        self.assertEqual(storage.migrate_db(connection, [Table]), 1)
+        Table.MIGRATIONS = {**Table.MIGRATIONS,
+                            2: ['ALTER TABLE migration_test ADD COLUMN b TEXT'],
+                            3: ["INSERT INTO migration_test VALUES (3, 'x')"]}
+        for _ in range(2):
+            self.assertEqual(storage.migrate_db(connection, [Table]), 3)
+        self.assertEqual(connection.execute('SELECT * FROM migration_test').fetchall(), [(3, 'x')])
+
+    def test_failed_step_leaves_db_unchanged(self):
+        class Table(storage.MiniOrm):
+            TABLE_NAME = 'migration_test'
+            MIGRATIONS = {1: ['CREATE TABLE migration_test (a INTEGER)', 'NOT SQL']}
+
+        connection = sqlite3.connect(':memory:')
+        with self.assertRaises(sqlite3.OperationalError):
+            storage.migrate_db(connection, [Table])
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], 0)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0], 0)
+
+
+class TestDataVersion(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.connection = storage.create_db({'dbdir': self.db_dir.name})
+
+    def tearDown(self):
+        self.connection.close()
+        self.db_dir.cleanup()
+
+    def version(self, connection=None):
+        return storage.data_version(connection or self.connection, (storage.Reservation, storage.Payment))
+
+    def test_changes_are_counted(self):
+        (reservations, payments), _ = self.version()
+        with self.connection:
+            reservation = make_reservation(places=1, uuid='uuid-version', bank_id='000000000097')
+            reservation.insert_data(self.connection)
+        (reservations_after_insert, payments_after_insert), _ = self.version()
+        self.assertGreater(reservations_after_insert, reservations)
+        self.assertEqual(payments_after_insert, payments)
+        with self.connection:
+            make_payment(uuid='uuid-version').insert_data(self.connection)
+        (reservations_after_payment, payments_after_payment), _ = self.version()
+        # The trigger keeping `paid_cents' up to date changed the reservation
+        self.assertGreater(reservations_after_payment, reservations_after_insert)
+        self.assertGreater(payments_after_payment, payments_after_insert)
+        with self.connection:
+            self.connection.execute('DELETE FROM payments')
+        self.assertGreater(self.version()[0][1], payments_after_payment)
+
+    def test_same_for_every_connection(self):
+        with self.connection:
+            make_reservation(places=1, uuid='uuid-version', bank_id='000000000097').insert_data(self.connection)
+        other = storage.create_db({'dbdir': self.db_dir.name})
+        try:
+            self.assertEqual(self.version(other), self.version())
+        finally:
+            other.close()
+
+    def test_csrf_tokens_do_not_count(self):
+        before = self.version()
+        storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1')
+        self.assertEqual(self.version(), before)
+
+    def test_last_modified(self):
+        before = time.time()
+        with self.connection:
+            make_reservation(places=1, uuid='uuid-version', bank_id='000000000097').insert_data(self.connection)
+        self.assertLessEqual(int(before), self.version()[1])
+        self.assertLessEqual(self.version()[1], time.time())
+
+
+class TestCsrf(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.connection = storage.create_db({'dbdir': self.db_dir.name})
+
+    def tearDown(self):
+        self.connection.close()
+        self.db_dir.cleanup()
+
+    def test_token_is_validated_without_writing(self):
+        changes = self.connection.total_changes
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        self.assertEqual(storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token, token)
+        self.assertEqual(storage.Csrf.validate_and_update(self.connection, token, 'user', '127.0.0.1').token, token)
+        self.assertEqual(self.connection.total_changes, changes)
+        self.assertFalse(self.connection.in_transaction)
+
+    def test_invalid_tokens(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        for bad_token, user, ip in ((token, 'other', '127.0.0.1'),
+                                    (token, 'user', '10.0.0.1'),
+                                    (f'{int(token[:8], 16) + 1:08x}{token[8:]}', 'user', '127.0.0.1'),
+                                    (token[8:], 'user', '127.0.0.1'),
+                                    (token[:8] + 'é' * 64, 'user', '127.0.0.1'),
+                                    ('', 'user', '127.0.0.1')):
+            with self.subTest(token=bad_token, user=user, ip=ip):
+                self.assertRaises(KeyError, storage.Csrf.validate_and_update, self.connection, bad_token, user, ip)
+
+    def test_expired_token(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        with patch('time.time', return_value=time.time() + 2 * storage.Csrf.SESSION_IN_SECONDS):
+            self.assertRaises(KeyError, storage.Csrf.validate_and_update, self.connection, token, 'user', '127.0.0.1')
+
+    def test_key_is_shared_by_connections(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        self.assertTrue(os.path.exists(os.path.join(self.db_dir.name, storage.Csrf.SECRET_FILE_NAME)))
+        storage._CSRF_SECRETS.clear()
+        other = storage.create_db({'dbdir': self.db_dir.name})
+        try:
+            self.assertEqual(storage.Csrf.validate_and_update(other, token, 'user', '127.0.0.1').token, token)
+        finally:
+            other.close()
+
+    def test_configured_key(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        with patch('config.get_configuration', return_value={'csrf_secret': 'configured'}):
+            configured_token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+            self.assertNotEqual(configured_token, token)
+            self.assertRaises(KeyError, storage.Csrf.validate_and_update, self.connection, token, 'user', '127.0.0.1')
+
+
+class TestConnectionProfile(unittest.TestCase):
+    def test_defaults(self):
+        with tempfile.TemporaryDirectory() as dbdir:
+            connection = storage.create_db({'dbdir': dbdir})
+            try:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+                self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+            finally:
+                connection.close()
+
+    def test_configuration_overrides_defaults(self):
+        with tempfile.TemporaryDirectory() as dbdir:
+            connection = storage.create_db({'dbdir': dbdir,
+                                            'sqlite_journal_mode': 'DELETE',
+                                            'sqlite_busy_timeout': 250,
+                                            'sqlite_synchronous': 'full',
+                                            'sqlite_cache_size': -4000})
+            try:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+                self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone()[0], 250)
+                self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 2)
+                self.assertEqual(connection.execute('PRAGMA cache_size').fetchone()[0], -4000)
+            finally:
+                connection.close()
+
+    def test_invalid_values(self):
+        for key, value in (('sqlite_journal_mode', 'wal; DROP TABLE payments'),
+                           ('sqlite_synchronous', 'sometimes'),
+                           ('sqlite_mmap_size', 'big')):
+            with self.subTest(key=key):
+                with self.assertRaises(ValueError):
+                    storage.connection_profile({key: value})
+
+
+class TestWriteTransaction(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.TemporaryDirectory()
+        self.configuration = {'dbdir': self.dbdir.name, 'sqlite_busy_timeout': 0}
+        self.writer = storage.create_db(self.configuration)
+        # Another process, but released from a timer thread in some tests
+        self.other = storage.connect(os.path.join(self.dbdir.name, 'db.db'),
+                                     storage.connection_profile(self.configuration),
+                                     check_same_thread=False)
+
+    def tearDown(self):
+        self.writer.close()
+        self.other.close()
+        self.dbdir.cleanup()
+
+    def test_commit_and_rollback(self):
+        with storage.write_transaction(self.writer):
+            make_payment(src_id='committed').insert_data(self.writer)
+        with self.assertRaises(RuntimeError):
+            with storage.write_transaction(self.writer):
+                make_payment(src_id='rolled back').insert_data(self.writer)
+                raise RuntimeError('abort')
+        self.assertEqual([p.src_id for p in storage.Payment.select(self.other)], ['committed'])
+
+    def test_writers_wait_for_each_other(self):
+        self.other.execute('BEGIN IMMEDIATE')
+        timer = threading.Timer(0.05, self.other.rollback)
+        timer.start()
+        try:
+            with storage.write_transaction(self.writer, attempts=10):
+                make_payment().insert_data(self.writer)
+        finally:
+            timer.join()
+        self.assertEqual(storage.Payment.length(self.other), 1)
+
+    def test_gives_up_eventually(self):
+        self.other.execute('BEGIN IMMEDIATE')
+        with self.assertRaises(sqlite3.OperationalError):
+            with storage.write_transaction(self.writer, attempts=2, first_delay=0.001):
+                pass
+        self.assertFalse(self.writer.in_transaction)
+
+    def test_readers_do_not_wait_for_writer(self):
+        with storage.write_transaction(self.writer):
+            make_payment().insert_data(self.writer)
+            self.assertEqual(storage.Payment.length(self.other), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
 
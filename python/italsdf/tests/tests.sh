@@ -123,21 +123,18 @@ function count_reservations {
     sql_query "SELECT COUNT(*) FROM reservations;"
 }
 
-function count_csrfs {
-    sql_query "SELECT COUNT(*) FROM csrfs;"
-}
-
 function count_payments {
     sql_query "SELECT COUNT(*) FROM payments;"
 }
 
-function get_user_of_csrf_token {
-    sql_query "SELECT user FROM csrfs WHERE token='$1';"
-}
-
+# Token that the local CGI scripts issue to user $1 at address $2 (default
+# 1.2.3.4): the tokens are signed, not stored in the DB (see Csrf in
+# storage.py).
 function get_csrf_token_of_user {
-    # Ignores IP address... but there should be only one anyway.
-    sql_query "SELECT token FROM csrfs WHERE user='$1' ORDER BY timestamp DESC LIMIT 1;"
+    (cd "$app_dir" \
+         && env TEMP="$test_dir" CONFIGURATION_JSON_DIR="$test_dir" \
+                python3 -c 'import sys, config, storage; print(storage.Csrf.get_by_user_and_ip(storage.create_db(config.get_configuration()), *sys.argv[1:]).token)' \
+                "$1" "${2:-1.2.3.4}")
 }
 
 function get_bank_id_from_reservation_uuid {
@@ -189,9 +186,6 @@ function generic_test_valid_reservation_for_test_date
        ]; then
         die "test_$test_name: Wrong data saved in DB"
     fi
-    if [ "$(count_csrfs)" -gt "1" ]; then
-        die "test_$test_name: CSRF problem: new CSRF token created."
-    fi
     echo "test_$test_name: ok"
 }
 
@@ -391,7 +385,7 @@ function test_03_locally_display_existing_reservation
     # insert reservation for places without any food reservation, using the
     # opportunity to double-check on HTML escaping.
     test_name="test_03_locally_display_existing_reservation_2"
-    sql_query 'INSERT INTO reservations VALUES ("<name>", "email@domain.com", "<this> & </that>'\''""", 2, "2099-01-01", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, "", "'"$test_name"'", "'$(date +"%s")'", 1, "<a test&>")'
+    sql_query 'INSERT INTO reservations VALUES ("<name>", "email@domain.com", "<this> & </that>'\''""", 2, "2099-01-01", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, "", "'"$test_name"'", "'$(date +"%s")'", 1, "<a test&>", 0, 0, NULL)'
     test_output="$(capture_cgi_output "$test_name" GET show_reservation.cgi "uuid_hex=$test_name")"
     assert_html_response "$test_name" "$test_output" \
                          "La commande des repas se fera.*paiement mobile mais accepterons" \
@@ -686,8 +680,9 @@ function test_15_locally_list_4_payments
                          '<input type="file" id="csv_file" name="csv_file">' \
                          '<tr><td>src_id_0</td><td>01/01/1970</td><td>BE001100</td><td>realperson</td><td>Accepté</td><td>partial payment</td><td>3.50</td><td><div><form style="display: inline" method="POST" action="/gestion/link_payment_and_reservation.cgi"><a href="https://example.com/show_reservation.cgi?uuid_hex='"$uuid_hex_p1_and_p2"'">realperson i@gmail.com</a> <input type="hidden" name="csrf_token" value="'"$csrf_token"'"><input type="hidden" name="src_id" value="src_id_0"><input type="hidden" name="reservation_uuid" value=""><input type="submit" value="X"></form><a href=[^<>]*>[^<>]*</a></div></td></tr>' \
                          '<tr><td>src_id_1</td><td>02/01/1970</td><td>BE001100</td><td>realperson</td><td>Accepté</td><td>partial payment</td><td>64.50</td><td><div><form style="display: inline" method="POST" action="/gestion/link_payment_and_reservation.cgi"><a href="https://example.com/show_reservation.cgi?uuid_hex='"$uuid_hex_p1_and_p2"'">realperson i@gmail.com</a> <input type="hidden" name="csrf_token" value="'"$csrf_token"'"><input type="hidden" name="src_id" value="src_id_1"><input type="hidden" name="reservation_uuid" value=""><input type="submit" value="X"></form><a href=[^<>]*>[^<>]*</a></div></td></tr>' \
-                         "<tr><td>${year_prefix}-00127</td><td>28/03/2023</td><td>BE00020002000202</td><td>ccccc-ccccccccc</td><td>Accepté</td><td>reprise marchandise</td><td>18.00</td><td><div><form style=\"display: inline\" method=\"POST\" action=\"/gestion/link_payment_and_reservation.cgi\"><input type=\"hidden\" name=\"csrf_token\" value=\"$csrf_token\"><input type=\"hidden\" name=\"src_id\" value=\"${year_prefix}-00127\"><select name=\"reservation_uuid\"><option value=\"\">--- Choisir la réservation correspondante ---</option>.*</select>.*</form></div></td></tr><tr><td>${year_prefix}-00119</td>" \
-                         "<tr><td>${year_prefix}-00119</td><td>25/03/2023</td><td>BE100010001010</td><td>SSSSSS GGGGGGGG</td><td>Accepté</td><td>[0-9+/]*</td><td>27.00</td><td><div><form style=\"display: inline\" method=\"POST\" action=\"/gestion/link_payment_and_reservation.cgi\"><input type=\"hidden\" name=\"csrf_token\" value=\"$csrf_token\"><input type=\"hidden\" name=\"src_id\" value=\"${year_prefix}-00119\"><select name=\"reservation_uuid\"><option value=\"$uuid_hex_p4\" selected=\"selected\">[0-9+/]* test i@example.com</option><option value"
+                         "<tr><td>${year_prefix}-00127</td><td>28/03/2023</td><td>BE00020002000202</td><td>ccccc-ccccccccc</td><td>Accepté</td><td>reprise marchandise</td><td>18.00</td><td><div><form style=\"display: inline\" method=\"POST\" action=\"/gestion/link_payment_and_reservation.cgi\"><input type=\"hidden\" name=\"csrf_token\" value=\"$csrf_token\"><input type=\"hidden\" name=\"src_id\" value=\"${year_prefix}-00127\"><input type=\"text\" name=\"reservation_uuid\" list=\"reservations-for-linking\" required=\"required\" placeholder=\"Nom ou communication de la réservation\"><input type=\"submit\" value=\"OK\"></form>.*</div></td></tr><tr><td>${year_prefix}-00119</td>" \
+                         "<tr><td>${year_prefix}-00119</td><td>25/03/2023</td><td>BE100010001010</td><td>SSSSSS GGGGGGGG</td><td>Accepté</td><td>[0-9+/]*</td><td>27.00</td><td><div><form style=\"display: inline\" method=\"POST\" action=\"/gestion/link_payment_and_reservation.cgi\"><input type=\"hidden\" name=\"csrf_token\" value=\"$csrf_token\"><input type=\"hidden\" name=\"src_id\" value=\"${year_prefix}-00119\"><select name=\"reservation_uuid\" class=\"link-reservation\"><option value=\"$uuid_hex_p4\" selected=\"selected\">[0-9+/]* test i@example.com</option></select>" \
+                         "<datalist id=\"reservations-for-linking\">.*<option value=\"$uuid_hex_p4\">[0-9+/]* test i@example.com</option>"
 }
 
 function test_16_link_payment_and_reservation
@@ -729,7 +724,6 @@ $src_id
 
 # 01: List reservations when DB is still empty, then
 # - Verify output HTML
-# - Verify CSRF is in DB
 # - Verify reservations is empty
 function test_01_list_empty_reservations
 {
@@ -743,16 +737,12 @@ function test_01_list_empty_reservations
     if [ "$(count_reservations)" != "0" ]; then
         die "Reservations table is not empty."
     fi
-    if [ "$(count_csrfs)" -gt "1" -o "$(get_user_of_csrf_token "$csrf_token")" != "$admin_user" ]; then
-        die "CSRF problem."
-    fi
     echo "test_01_list_empty_reservations: ok"
 }
 
 # 02: Register for a test date
 # - Verify output HTML very lightly
 # - Verify reservations contains 1 row with correct information
-# - No new CSRF token
 function test_02_valid_reservation_for_test_date
 {
     generic_test_valid_reservation_for_test_date 02_valid_reservation_for_test_date \
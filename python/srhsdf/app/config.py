@@ -1,5 +1,6 @@
 import json
 import os
+from types import MappingProxyType
 
 SCRIPT_DIR = os.getenv('CONFIGURATION_JSON_DIR')
 if not SCRIPT_DIR:
@@ -9,11 +10,15 @@ if not SCRIPT_DIR:
         SCRIPT_DIR = os.path.realpath(os.getcwd())
 
 
-def get_configuration():
+def load_configuration():
+    '''Parse `configuration.json' and fill in the defaults, without caching'''
     CONFIGURATION_DEFAULTS = {
         'logdir': os.getenv('TEMP', SCRIPT_DIR),
         'dbdir': os.getenv('TEMP', SCRIPT_DIR),
         'cgitb_display': 1,
+        'compression_level': 6,
+        'qr_cache_max_bytes': 4 * 1024 * 1024,
+        'csrf_secret': '', # empty: a random key is generated next to the database
         'paying_seat_cents': 500,
         'bank_account': 'BExx XXXX YYYY ZZZZ',
         'organizer_name': "name of organizer's bank account",
@@ -30,3 +35,36 @@ def get_configuration():
     for k, v in CONFIGURATION_DEFAULTS.items():
         configuration.setdefault(k, v)
     return configuration
+
+
+# (stamp of `configuration.json', read-only view of the merged configuration)
+_SNAPSHOT = None
+
+
+def _stamp():
+    try:
+        stat = os.stat(os.path.join(SCRIPT_DIR, 'configuration.json'))
+    except OSError:
+        file_stamp = None
+    else:
+        file_stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    # `TEMP' provides the default `logdir' and `dbdir'
+    return file_stamp, os.getenv('TEMP')
+
+
+def get_configuration():
+    '''Merged configuration, shared by the whole process
+
+    `configuration.json' is parsed again only when a stat() of it shows that
+    it changed.  The result is a read-only mapping.'''
+    global _SNAPSHOT
+    stamp = _stamp()
+    if _SNAPSHOT is None or _SNAPSHOT[0] != stamp:
+        _SNAPSHOT = (stamp, MappingProxyType(load_configuration()))
+    return _SNAPSHOT[1]
+
+
+def forget_configuration():
+    '''Make the next `get_configuration' parse `configuration.json' again'''
+    global _SNAPSHOT
+    _SNAPSHOT = None
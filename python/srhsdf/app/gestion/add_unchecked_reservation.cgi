@@ -2,8 +2,6 @@
 # -*- coding: utf-8 -*-
 #
 # (export SCRIPT_NAME="$PWD/app/gestion/add_unchecked_reservation.cgi"; cd "$(dirname "$SCRIPT_NAME")" && echo | CONFIGURATION_JSON_DIR="$(dirname "$(ls -t /tmp/tmp.*/configuration.json | head -n 1)")" DB_DB="$CONFIGURATION_JSON_DIR/db.db" REQUEST_METHOD=POST REMOTE_USER="$(sqlite3 "$DB_DB" "select user from csrfs order by timestamp desc limit 1")" REMOTE_ADDR="$(sqlite3 "$DB_DB" "select ip from csrfs order by timestamp desc limit 1")" QUERY_STRING='csrf_token='"$(sqlite3 "$DB_DB" "select token from csrfs order by timestamp desc limit 1")"'&last_name=cmdlinename&comment=fromcmdline&date=2099-01-01&paying_seats=3&free_seats=4' SERVER_NAME=localhost python3 $SCRIPT_NAME)
-import cgi
-import cgitb
 import os
 import sys
 
@@ -12,6 +10,7 @@ sys.path.append('..')
 
 import config
 from htmlgen import (
+    enable_cgitb,
     print_content_type,
     redirect_to_event,
 )
@@ -38,11 +37,12 @@ if __name__ == '__main__':
 
     CONFIGURATION = config.get_configuration()
 
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
         db_connection = create_db(CONFIGURATION)
 
+        import cgi
         # Get form data
         form = cgi.FieldStorage()
         csrf_token = form.getfirst('csrf_token')
@@ -1,17 +1,19 @@
 #!/usr/pkg/bin/python3
 # -*- coding: utf-8 -*-
-import cgitb
-import csv
 import math
 import os
 import sys
+import urllib.parse
 
 # hack to get at my utilities:
 sys.path.append('..')
 import config
 from htmlgen import (
     cents_to_euro,
+    cgitb_handler,
+    enable_cgitb,
     format_bank_id,
+    Response,
     print_content_type,
     redirect_to_event,
 )
@@ -20,23 +22,35 @@ from storage import (
     create_db,
 )
 
+# Last row of a CSV cut short by an error (the traceback is in the logs)
+INCOMPLETE_EXPORT_ROW = '"ERREUR: export incomplet, voir le journal du serveur"\r\n'
+
 if __name__ == '__main__':
     if os.getenv('REQUEST_METHOD') != 'GET' or not os.getenv('REMOTE_USER'):
         redirect_to_event()
+    # Incremental export: only the reservations that changed since `since'
+    # (seconds since the epoch)
+    since = urllib.parse.parse_qs(os.getenv('QUERY_STRING', '')).get('since', [''])[0]
+    try:
+        changed_since = float(since) if since else None
+    except ValueError:
+        redirect_to_event()
+    if changed_since is not None and not math.isfinite(changed_since):
+        redirect_to_event()
 
     CONFIGURATION = config.get_configuration()
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
+    response = None
     try:
+        import csv
         connection = create_db(CONFIGURATION)
-        writer = csv.writer(sys.stdout, 'excel')
-        if print_content_type('text/csv; charset=utf-8'):
-            print()
+        response = Response('text/csv; charset=utf-8', streaming=True)
+        writer = csv.writer(response, 'excel')
         writer.writerow((
             'H/F', 'Nom', 'Prénom', 'Email', 'Date', 'Payants', 'Gratuits', 'Dû', 'Communication', 'Origine', 'Commentaire', 'Actif', 'Email RGPD'
         ))
-        for x in Reservation.select(connection,
-                                    order_columns=('ACTIVE', 'date', 'name')):
+        for x, paid_cents in Reservation.select_for_export(connection, changed_since):
             if x.origin:
                 comment = x.email
                 email = ''
@@ -47,11 +61,14 @@ if __name__ == '__main__':
                 gdpr_email = x.email if x.gdpr_accepts_use else ''
             euros_due = (''
                          if (x.cents_due is None or not math.isfinite(x.cents_due)) else
-                         cents_to_euro(x.remaining_amount_due_in_cents(connection)) + '€')
+                         cents_to_euro(x.cents_due - paid_cents) + '€')
             writer.writerow((
                 x.civility, x.last_name, x.first_name, email, x.date, x.paying_seats, x.free_seats, euros_due, format_bank_id(x.bank_id), x.origin, comment, x.active, gdpr_email
             ))
+        response.finish()
     except Exception:
-        if print_content_type('text/html; charset=utf-8'):
-            print()
-        cgitb.handler()
+        # Part of the CSV may be sent already: no error page then
+        if response is None or not response.abort(CONFIGURATION['logdir'], trailer=INCOMPLETE_EXPORT_ROW):
+            if print_content_type('text/html; charset=utf-8'):
+                print()
+            cgitb_handler()
@@ -1,13 +1,12 @@
 #!/usr/pkg/bin/python3
 # -*- coding: utf-8 -*-
-import cgitb
 import os
 import sys
 
 # hack to get at my utilities:
 sys.path.append('..')
 import config
-from htmlgen import print_content_type
+from htmlgen import enable_cgitb, print_content_type
 from storage import create_db
 from lib_payments import (
     hide_payment,
@@ -25,7 +24,7 @@ def main() -> None:
 
         CONFIGURATION = config.get_configuration()
 
-        cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+        enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
         if os.getenv('REQUEST_METHOD') == 'POST':
             server_name = os.getenv('SERVER_NAME')
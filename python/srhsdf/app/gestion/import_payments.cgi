@@ -1,7 +1,6 @@
 #!/usr/pkg/bin/python3
 # -*- coding: utf-8 -*-
-import cgi
-import cgitb
+import itertools
 import os
 import sys
 
@@ -9,6 +8,7 @@ import sys
 sys.path.append('..')
 import config
 from htmlgen import (
+    enable_cgitb,
     html_document,
     pluriel_naif,
     print_content_type,
@@ -21,27 +21,47 @@ from storage import (
     create_db,
 )
 from lib_payments import (
-    import_bank_statements,
+    UPLOAD_MAX_BYTES,
+    decode_lines,
+    iter_import_bank_statements,
+    iter_multipart_form,
 )
 
 
-def fail_import_payments():
-    redirect_to_event()
+# Errors listed on the result page, the others are only counted
+MAX_REPORTED_ERRORS = 100
 
 
-def decode_list(bs) -> list[str]:
-    try:
-        return [b.decode("utf-8") for b in bs]
-    except UnicodeDecodeError:
-        return [b.decode("latin1", errors='replace') for b in bs]
+def fail_import_payments():
+    redirect_to_event()
 
 
 def post_method(db_connection, server_name, script_name, user, ip):
     list_payments = f"https://{server_name}{os.path.join(os.path.dirname(script_name), 'list_payments.cgi')}"
-    # Get form data
-    cgi.maxlen = 10 * 1024 * 1024
-    form = cgi.FieldStorage()
-    csrf_token = form.getfirst('csrf_token')
+    # Get form data while it is uploaded: the form sends the CSRF token
+    # before the CSV file, which is imported as it is read.
+    try:
+        content_length = int(os.getenv('CONTENT_LENGTH'))
+    except Exception:
+        content_length = None
+    if content_length is not None and content_length > UPLOAD_MAX_BYTES:
+        respond_html(html_document(
+            'Fichier trop volumineux',
+            (('p', f"Le fichier CSV ne peut dépasser {UPLOAD_MAX_BYTES // (1024 * 1024)} Mo"),
+             ('p', (('a', 'href', list_payments), 'Retour à la liste des paiements')))))
+        return
+    csrf_token = None
+    csv_lines = None
+    try:
+        for name, lines in iter_multipart_form(
+                sys.stdin.buffer, os.getenv('CONTENT_TYPE', ''), UPLOAD_MAX_BYTES if content_length is None else content_length):
+            if name == 'csrf_token':
+                csrf_token = b''.join(lines).decode('utf-8', errors='replace')
+            elif name == 'csv_file' and csrf_token is not None:
+                csv_lines = lines
+                break
+    except ValueError:
+        pass
     if csrf_token is None:
         fail_import_payments()
     else:
@@ -50,18 +70,27 @@ def post_method(db_connection, server_name, script_name, user, ip):
         except KeyError:
             fail_import_payments()
 
-    csv_file = form['csv_file']
-    if not csv_file.file:
+    if csv_lines is not None:
+        # An upload of blank lines only is as empty as no upload at all
+        csv_lines = itertools.dropwhile(lambda line: not line.strip(), csv_lines)
+        first_line = next(csv_lines, None)
+        csv_lines = None if first_line is None else itertools.chain((first_line,), csv_lines)
+    if csv_lines is None:
         respond_html(html_document('No input data', (('p', 'No input data'), )))
         return
 
-    csv = "".join(decode_list(line for line in csv_file.file)).strip()
-    if not csv:
-        redirect(list_payments)
-        return
-
+    # The payments are imported batch by batch while the upload is read:
+    # only the first errors are kept.
+    payment_count = 0
+    error_count = 0
+    errors = []
     try:
-        import_result = import_bank_statements(db_connection, csv, user, ip)
+        for exc, pmnt in iter_import_bank_statements(db_connection, decode_lines(csv_lines), user, ip):
+            payment_count += 1
+            if exc is not None:
+                error_count += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append((exc, pmnt))
     except Exception as exc:
         respond_html(html_document(
             "Erreur d'import de fichier CSV",
@@ -69,12 +98,14 @@ def post_method(db_connection, server_name, script_name, user, ip):
              ('p', (('a', 'href', list_payments), 'Retour à la liste des paiements')))))
         return
 
-    exceptions = [(e, p) for e, p in import_result if e]
-    if exceptions:
+    if errors:
         respond_html(html_document(
-            f"{pluriel_naif(len(exceptions), 'Erreur')} lors de l'import de {pluriel_naif(len(import_result), 'paiements')}",
+            f"{pluriel_naif(error_count, 'Erreur')} lors de l'import de {pluriel_naif(payment_count, 'paiements')}",
             (('ul',
-              *(('li', str(e), ('br', ), repr(p)) for e, p in exceptions)), )))
+              *(('li', str(e), ('br', ), repr(p)) for e, p in errors),
+              ('li', f"et {pluriel_naif(error_count - len(errors), ('autre erreur', 'autres erreurs'))}")
+              if error_count > len(errors) else
+              ''), )))
         return
 
     redirect(list_payments)
@@ -90,7 +121,7 @@ if __name__ == '__main__':
 
         CONFIGURATION = config.get_configuration()
 
-        cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+        enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
         db_connection = create_db(CONFIGURATION)
 
@@ -2,8 +2,6 @@
 # -*- coding: utf-8 -*-
 #
 # (export SCRIPT_NAME="$PWD/app/gestion/list_reservations.cgi"; cd "$(dirname "$SCRIPT_NAME")" && CONFIGURATION_JSON_DIR="$(dirname "$(ls -t /tmp/tmp.*/configuration.json | head -n 1)")" REQUEST_METHOD=GET REMOTE_USER="secretaire" REMOTE_ADDR="1.2.3.4" QUERY_STRING="" SERVER_NAME=localhost python3 $SCRIPT_NAME)
-import cgi
-import cgitb
 import itertools
 import os
 import sys
@@ -14,6 +12,9 @@ import urllib.parse
 sys.path.append('..')
 import config
 from htmlgen import (
+    cgitb_handler,
+    conditional_get,
+    enable_cgitb,
     html_document,
     pluriel_naif,
     print_content_type,
@@ -22,8 +23,12 @@ from htmlgen import (
 )
 from storage import (
     Csrf,
+    Payment,
     Reservation,
     create_db,
+    data_version,
+    keyset_key_from_str,
+    keyset_key_to_str,
 )
 from lib_post_reservation import (
     make_show_reservation_url
@@ -42,13 +47,15 @@ def update_sort_order(new_col_name, sort_order):
         return [new_col_name]
 
 
-def make_url(sort_order, limit, offset, base_url=None, environ=None):
+def make_url(sort_order, limit, offset, base_url=None, environ=None, after=None, before=None):
     if base_url is None:
         environ = environ or os.environ
         base_url = f'https://{environ["SERVER_NAME"]}{environ["SCRIPT_NAME"]}'
     params = list((k, v) for k, v in itertools.chain(
         (('limit', limit),
-         ('offset', offset)),
+         ('offset', offset),
+         ('after', keyset_key_to_str(after)),
+         ('before', keyset_key_to_str(before))),
         (('sort_order', s) for s in sort_order))
                   if v is not None)
     split_result = urllib.parse.urlsplit(base_url)
@@ -60,10 +67,10 @@ def make_url(sort_order, limit, offset, base_url=None, environ=None):
         split_result.fragment))
 
 
-def make_navigation_a_elt(sort_order, limit, offset, text):
+def make_navigation_a_elt(sort_order, limit, offset, text, after=None, before=None):
     return (('a',
              'class', 'navigation',
-             'href', make_url(sort_order, limit, offset)),
+             'href', make_url(sort_order, limit, offset, after=after, before=before)),
             text)
 
 
@@ -99,21 +106,30 @@ if __name__ == '__main__':
     script_basename = os.path.basename(script_name)
 
     CONFIGURATION = config.get_configuration()
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
-        params = cgi.parse()
+        params = urllib.parse.parse_qs(os.getenv('QUERY_STRING', ''))
         sort_order = params.get('sort_order', '')
         try:
             limit = min(int(get_first(params, 'limit') or DEFAULT_LIMIT), MAX_LIMIT)
         except Exception:
             limit = DEFAULT_LIMIT
+        # With a sort key to seek to, `offset' is only the position of the
+        # page in the list.
+        after = keyset_key_from_str(get_first(params, 'after'), Reservation.keyset_ordering(sort_order))
+        before = None if after is not None else keyset_key_from_str(get_first(params, 'before'), Reservation.keyset_ordering(sort_order))
         try:
             offset = max(int(get_first(params, 'offset') or '0'), 0)
         except Exception:
             offset = 0
         connection = create_db(CONFIGURATION)
         csrf_token = Csrf.get_by_user_and_ip(connection, remote_user, remote_addr)
+        # The lists are refreshed constantly on event night
+        versions, last_modified = data_version(connection, (Reservation, Payment))
+        validators = conditional_get(
+            (os.getenv('QUERY_STRING'), os.getenv('SCRIPT_NAME'), os.getenv('SERVER_NAME'), csrf_token.token, versions),
+            last_modified)
 
         COLUMNS = [('name', 'Nom'), ('email', 'Email'), ('date', 'Date'),
                    ('paying_seats', 'Payant'), ('free_seats', 'Gratuit'),
@@ -124,20 +140,27 @@ if __name__ == '__main__':
                                          header + sort_direction(column, sort_order)))
             for column, header in COLUMNS)
         total_bookings = Reservation.length(connection)
-        active_reservations = Reservation.length(connection, [('active', 1)])
+        active_reservations = Reservation.count_active(connection)
         reservation_summary = Reservation.summary_by_date(connection)
+        page = Reservation.select_page(connection,
+                                       filtering=[('active', '1')],
+                                       order_columns=sort_order,
+                                       limit=limit,
+                                       after=after,
+                                       before=before,
+                                       offset=offset)
         pagination_links = tuple((
             x for x in
             [('li', make_navigation_a_elt(sort_order, limit, 0, 'Début'))
-             if offset > 0
+             if page.has_previous
              else None,
              ('li',
-              make_navigation_a_elt(sort_order, limit, offset - limit, 'Précédent'))
-             if offset > limit else
+              make_navigation_a_elt(sort_order, limit, max(offset - limit, 0), 'Précédent', before=page.first_key))
+             if page.has_previous and offset > limit else
              None,
              ('li',
-              make_navigation_a_elt(sort_order, limit, offset + limit, 'Suivant'))
-             if offset + limit < active_reservations else
+              make_navigation_a_elt(sort_order, limit, offset + limit, 'Suivant', after=page.last_key))
+             if page.has_next else
              None]
             if x is not None))
         respond_html(html_document(
@@ -156,7 +179,10 @@ if __name__ == '__main__':
               (('input', 'type', 'submit', 'value', 'Rafraichir la page'),),
               *((('input', 'id', 'sort_order', 'name', 'sort_order', 'type', 'hidden', 'value', v),)
                 for v in sort_order),
-              (('input', 'id', 'offset', 'name', 'offset', 'type', 'hidden', 'value', str(offset)),)),
+              (('input', 'id', 'offset', 'name', 'offset', 'type', 'hidden', 'value', str(offset)),),
+              *((('input', 'id', name, 'name', name, 'type', 'hidden', 'value', keyset_key_to_str(key)),)
+                for name, key in (('after', after), ('before', before))
+                if key is not None)),
              (('ul', 'class', 'navbar'), *pagination_links) if pagination_links else '',
              ('table',
               ('tr', *table_header_row),
@@ -171,11 +197,7 @@ if __name__ == '__main__':
                       ('td', r.origin if r.origin else (('span', 'class', 'null_value'),
                                                         'formulaire web')),
                       ('td', time.strftime('%d/%m/%Y %H:%M', time.gmtime(r.timestamp))))
-                     for r in Reservation.select(connection,
-                                                 filtering=[('active', '1')],
-                                                 order_columns=sort_order,
-                                                 limit=limit,
-                                                 offset=offset))),
+                     for r in page.items)),
              ('hr',),
              ('p',
               # name is a fake parameter to encourage clients to believe Excel
@@ -216,8 +238,10 @@ if __name__ == '__main__':
               ('br',),
               (('input', 'type', 'submit', 'value', 'Confirmer'),)),
              ('hr',),
-             ('ul', ('li', (('a', 'href', 'list_payments.cgi'), 'Liste des paiements')),))))
+             ('ul', ('li', (('a', 'href', 'list_payments.cgi'), 'Liste des paiements')),))),
+            headers=validators,
+            contains_secret=True)
     except Exception:
         if print_content_type('text/html; charset=utf-8'):
             print()
-        cgitb.handler()
+        cgitb_handler()
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 '''Very limited HTML generation utilities.'''
+import functools
+import hashlib
 import html
+import itertools
+import os
 import sys
-from typing import NoReturn
+import time
+import zlib
+from typing import Iterable, NoReturn, Optional
+
+import config
 
 
 _html_gen_printed_header = False
@@ -16,6 +24,22 @@ def print_content_type(content_type, file=None):
     return True
 
 
+def enable_cgitb(display=1, logdir=None) -> None:
+    '''`cgitb.enable' importing `cgitb' only once an exception reaches it
+
+    `cgitb' pulls `pydoc' and `inspect' in: too much for every request.'''
+    def excepthook(*exc_info):
+        import cgitb
+        cgitb.Hook(display=display, logdir=logdir).handle(exc_info)
+    sys.excepthook = excepthook
+
+
+def cgitb_handler() -> None:
+    '''`cgitb.handler()' for the `except' clauses, importing `cgitb' on demand'''
+    import cgitb
+    cgitb.handler()
+
+
 def format_bank_id(x):
     bank_id = ''.join(c for c in x if c.isdigit())
     if len(bank_id) != 12:
@@ -38,103 +62,472 @@ def cents_to_euro(cents):
     return f'{sign}{cents // 100}.{cents % 100:02}'
 
 
-def html_gen(data):
-    def is_tuple(x):
-        return type(x) is tuple
-    if is_tuple(data) and len(data) == 2 and data[0] == 'raw':
-        yield data[1]
-    elif is_tuple(data):
-        tag_name = None
-        empty_elt = len(data) == 1
-        for elt in data:
-            if tag_name is None:
-                tag = elt
-                if is_tuple(tag):
-                    tag_name = str(tag[0])
-                    attr_values = []
-                    for idx in range(1, len(tag), 2):
-                        attr_values.append((tag[idx], html.escape(tag[idx + 1], quote=True)))
-                    yield '<' + tag_name + ' ' + ' '.join(f'{x}="{y}"' for (x, y) in attr_values) + '>'
-                else:
-                    tag_name = str(tag)
-                    yield f'<{tag_name}>'
-                # https://developer.mozilla.org/en-US/docs/Glossary/Empty_element:
-                empty_elt = tag_name.lower() in (
-                    'area', 'base', 'br', 'col', 'embed', 'hr', 'img',
-                    'input', 'keygen', 'link', 'meta', 'param', 'source',
-                    'track', 'wbr',)
-            else:
-                for x in html_gen(elt):
-                    yield x
-        if not empty_elt:
-            yield f'</{tag_name}>'
+# https://developer.mozilla.org/en-US/docs/Glossary/Empty_element:
+_EMPTY_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+    'input', 'keygen', 'link', 'meta', 'param', 'source',
+    'track', 'wbr',))
+_NO_SIBLING = object()
+
+
+# Bounded memos of the HTML of text contents and of the (start tag, end
+# tag) of tags: both are mostly constants repeated on every row of a page.
+_MEMO_SIZE = 4096
+_escaped_texts = {}
+_tag_pairs = {}
+
+
+def _tag_pair(tag) -> tuple[str, Optional[str]]:
+    if type(tag) is tuple:
+        tag_name = str(tag[0])
+        start_tag = ('<' + tag_name + ' '
+                     + ' '.join(f'{tag[idx]}="{html.escape(tag[idx + 1], quote=True)}"' for idx in range(1, len(tag), 2))
+                     + '>')
     else:
-        yield html.escape(str(data), quote=False)
+        tag_name = str(tag)
+        start_tag = f'<{tag_name}>'
+    pair = start_tag, None if tag_name.lower() in _EMPTY_ELEMENTS else f'</{tag_name}>'
+    if len(_tag_pairs) >= _MEMO_SIZE:
+        _tag_pairs.clear()
+    _tag_pairs[tag] = pair
+    return pair
+
+
+def _escaped_text(text) -> str:
+    escaped = html.escape(str(text), quote=False)
+    if type(text) is str:
+        if len(_escaped_texts) >= _MEMO_SIZE:
+            _escaped_texts.clear()
+        _escaped_texts[text] = escaped
+    return escaped
+
+
+def _render_into(out: list, children) -> list:
+    '''Append the HTML of every element of `children' to `out'
+
+    See `render' for the format.  The tree is walked with an explicit stack.
+    A child that is the same object as one of its 2 previous siblings (e.g.
+    built with `itertools.repeat') is not rendered again: the fragments of
+    that sibling are copied instead.'''
+    append = out.append
+    escaped_texts = _escaped_texts
+    tag_pairs = _tag_pairs
+    stack = []
+    children = iter(children)
+    closing_tag = None
+    # The previous sibling starts at out[previous_start] and ends at the
+    # current end of `out', the one before it is out[older_start:older_end].
+    previous, previous_start = _NO_SIBLING, 0
+    older, older_start, older_end = _NO_SIBLING, 0, 0
+    while True:
+        for data in children:
+            start = len(out)
+            if data is previous:
+                out.extend(out[previous_start:start])
+                older, older_start, older_end = previous, previous_start, start
+                previous_start = start
+                continue
+            if data is older:
+                out.extend(out[older_start:older_end])
+                older, older_start, older_end = previous, previous_start, start
+                previous, previous_start = data, start
+                continue
+            older, older_start, older_end = previous, previous_start, start
+            previous, previous_start = data, start
+            if type(data) is not tuple:
+                try:
+                    append(escaped_texts[data])
+                except (KeyError, TypeError):
+                    append(_escaped_text(data))
+                continue
+            nb_children = len(data) - 1
+            if nb_children == 1 and data[0] == 'raw':
+                append(data[1])
+                continue
+            if nb_children < 0:
+                append('</None>')
+                continue
+            tag = data[0]
+            try:
+                start_tag, end_tag = tag_pairs[tag]
+            except KeyError:
+                start_tag, end_tag = _tag_pair(tag)
+            append(start_tag)
+            if nb_children == 0:
+                if end_tag is not None:
+                    append(end_tag)
+                continue
+            stack.append((children, closing_tag, previous, previous_start, older, older_start, older_end))
+            children = itertools.islice(data, 1, None)
+            closing_tag = end_tag
+            previous, older = _NO_SIBLING, _NO_SIBLING
+            break
+        else:
+            if closing_tag is not None:
+                append(closing_tag)
+            if not stack:
+                return out
+            children, closing_tag, previous, previous_start, older, older_start, older_end = stack.pop()
+
+
+def render(data) -> str:
+    '''Render nested tuples into HTML
+
+    - a string (or any other non-tuple) is text content and is escaped,
+    - ('raw', html) is inserted as-is,
+    - (tag, *children) is an element whose tag is either its name or a
+      tuple (name, attribute, value, attribute, value, ...).'''
+    return ''.join(_render_into([], (data,)))
+
+
+def html_gen(data):
+    yield render(data)
+
+
+_SHELL_HOLE = ('raw', '\0')
+
+
+@functools.lru_cache(maxsize=None)
+def _document_shell() -> tuple[str, str, str]:
+    '''Constant HTML of `html_document' before its title, before its body and after its body'''
+    shell = render((('html', 'lang', 'fr'),
+                    ('head',
+                     (('meta', 'charset', 'utf-8'),),
+                     (('meta', 'name', 'viewport', 'content', 'width=device-width, initial-scale=1.0'),),
+                     ('title', _SHELL_HOLE),
+                     (('link', 'rel', 'stylesheet', 'href', 'https://www.srhbraine.be/css/bootstrap.min.css'),),
+                     (('link', 'rel', 'stylesheet', 'href', 'https://cdn.jsdelivr.net/npm/remixicon@4.3.0/fonts/remixicon.css'),),
+                     (('link', 'rel', 'stylesheet', 'href', 'https://www.srhbraine.be/css/app.css'),),
+                     (('style',"""#home {background-image: url(https://www.srhbraine.be/images/fond-accueil--1.jpg); background-position: center; background-size: cover; filter: brightness(90%);}""")),),
+                    ('body',
+                     ("raw", '<!-- navbar -->'
+                      '<nav id="navbar" class="navbar navbar-expand-lg bg-light fixed-top">'
+                      '<div class="container">'
+                      '<a class="navbar-brand" href="https://www.srhbraine.be/index.php"><img src="https://www.srhbraine.be/images/logo-srh.png" style="width: 90px;" alt="Responsive image">&nbsp;SRH</a>'
+                      '<button class="navbar-toggler" type="button" data-bs-toggle="collapse" data-bs-target="#navbarNav" aria-controls="navbarNav" aria-expanded="false" aria-label="Toggle navigation"><span class="navbar-toggler-icon"></span></button>'
+                      '<div class="collapse navbar-collapse" id="navbarNav">'
+                      '<ul class="navbar-nav mx-auto">'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#home">Accueil</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#services">Qui sommes-nous ?</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#work">Galeries</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#sponsors">Sponsors</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/liens.php">Liens</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/agenda.php">Agenda</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#blog">Blog</a></li>'
+                      '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#contact">Contact</a></li>'
+                      '</ul>'
+                      '<ul class="navbar-nav flex-row">'
+                      '<li class="nav-item"><a class="social-icon" href="https://www.facebook.com/societeroyaleharmonie/" target="_blank"><i class="ri-facebook-line"></i></a></li>'
+                      '<li class="nav-item"><a class="social-icon" href="https://www.instagram.com/srh_braine/" target="_blank"><i class="ri-instagram-line"></i></a></li>'
+                      '<li class="nav-item"><a class="social-icon" href="https://www.youtube.com/@raphaeldagostino" target="_blank"><i class="ri-youtube-line"></i></a></li>'
+                      '</ul></div></div></nav>'),
+                     (('section', 'class', 'section-padding'),
+                      (('div', 'class', 'container'),
+                       (('div', 'class', 'row col-12'),
+                        _SHELL_HOLE))),
+                     (('section', 'class', 'section-padding row'),
+                      (('footer', 'class', 'footer-bottom'),
+                       (('div', 'class', 'container'),
+                        (('div', 'class', 'row col-12'),
+                         (('p', 'class', 'mb-0'),
+                          'Retour au ',
+                          (('a', 'href', 'https://www.srhbraine.be/'),
+                           "site de la Société Royale d'Harmonie de Braine-l'Alleud"),
+                          '.'))))))))
+    before_title, before_body, after_body = shell.split(_SHELL_HOLE[1])
+    return '<!DOCTYPE HTML>' + before_title, before_body, after_body
 
 
 def html_document(title, body):
-    yield '<!DOCTYPE HTML>'
-    for x in html_gen((('html', 'lang', 'fr'),
-                       ('head',
-                        (('meta', 'charset', 'utf-8'),),
-                        (('meta', 'name', 'viewport', 'content', 'width=device-width, initial-scale=1.0'),),
-                        ('title', title),
-                        (('link', 'rel', 'stylesheet', 'href', 'https://www.srhbraine.be/css/bootstrap.min.css'),),
-                        (('link', 'rel', 'stylesheet', 'href', 'https://cdn.jsdelivr.net/npm/remixicon@4.3.0/fonts/remixicon.css'),),
-                        (('link', 'rel', 'stylesheet', 'href', 'https://www.srhbraine.be/css/app.css'),),
-                        (('style',"""#home {background-image: url(https://www.srhbraine.be/images/fond-accueil--1.jpg); background-position: center; background-size: cover; filter: brightness(90%);}""")),),
-                       ('body',
-                        ("raw", '<!-- navbar -->'
-                         '<nav id="navbar" class="navbar navbar-expand-lg bg-light fixed-top">'
-                         '<div class="container">'
-                         '<a class="navbar-brand" href="https://www.srhbraine.be/index.php"><img src="https://www.srhbraine.be/images/logo-srh.png" style="width: 90px;" alt="Responsive image">&nbsp;SRH</a>'
-                         '<button class="navbar-toggler" type="button" data-bs-toggle="collapse" data-bs-target="#navbarNav" aria-controls="navbarNav" aria-expanded="false" aria-label="Toggle navigation"><span class="navbar-toggler-icon"></span></button>'
-                         '<div class="collapse navbar-collapse" id="navbarNav">'
-                         '<ul class="navbar-nav mx-auto">'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#home">Accueil</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#services">Qui sommes-nous ?</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#work">Galeries</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#sponsors">Sponsors</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/liens.php">Liens</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/agenda.php">Agenda</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#blog">Blog</a></li>'
-                         '<li class="nav-item"><a class="nav-link" href="https://www.srhbraine.be/index.php#contact">Contact</a></li>'
-                         '</ul>'
-                         '<ul class="navbar-nav flex-row">'
-                         '<li class="nav-item"><a class="social-icon" href="https://www.facebook.com/societeroyaleharmonie/" target="_blank"><i class="ri-facebook-line"></i></a></li>'
-                         '<li class="nav-item"><a class="social-icon" href="https://www.instagram.com/srh_braine/" target="_blank"><i class="ri-instagram-line"></i></a></li>'
-                         '<li class="nav-item"><a class="social-icon" href="https://www.youtube.com/@raphaeldagostino" target="_blank"><i class="ri-youtube-line"></i></a></li>'
-                         '</ul></div></div></nav>'),
-                        (('section', 'class', 'section-padding'),
-                         (('div', 'class', 'container'),
-                          (('div', 'class', 'row col-12'),
-                           *body))),
-                        (('section', 'class', 'section-padding row'),
-                         (('footer', 'class', 'footer-bottom'),
-                          (('div', 'class', 'container'),
-                           (('div', 'class', 'row col-12'),
-                            (('p', 'class', 'mb-0'),
-                             'Retour au ',
-                             (('a', 'href', 'https://www.srhbraine.be/'),
-                              "site de la Société Royale d'Harmonie de Braine-l'Alleud"),
-                             '.')))))))):
-        yield x
-
-
-def respond_html(data, file=None):
-    if print_content_type('text/html; charset=utf-8', file=file):
-        print('Content-Language: en, fr', file=file)
-        print(file=file)
-    for x in data:
-        print(x, end='', file=file)
+    before_title, before_body, after_body = _document_shell()
+    yield before_title
+    yield render(title)
+    yield before_body
+    # One element at a time: a long body (e.g. the ticket sheet) is streamed
+    # by `Response' instead of being held in memory.
+    for element in body:
+        yield render(element)
+    yield after_body
+
+
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# Smaller bodies are sent as they are: compressing them saves next to nothing.
+COMPRESSION_MIN_SIZE = 1024
+
+# `wbits' of `zlib.compressobj' for each supported Content-Encoding
+_CONTENT_ENCODING_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def negotiate_content_encoding(accept_encoding: str) -> Optional[str]:
+    '''Return `gzip', `deflate' or None for an Accept-Encoding header'''
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *parameters = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities['gzip' if coding == 'x-gzip' else coding] = quality
+    wildcard = qualities.get('*', 0.0)
+    # On equal quality, `gzip' wins because it sorts after `deflate'
+    quality, coding = max((qualities.get(coding, wildcard), coding)
+                          for coding in ('gzip', 'deflate'))
+    return coding if quality > 0 else None
+
+
+# `compression_level' of the configuration, read by the first `Response'
+_COMPRESSION_LEVEL: Optional[int] = None
+
+
+def configured_compression_level() -> int:
+    global _COMPRESSION_LEVEL
+    if _COMPRESSION_LEVEL is None:
+        _COMPRESSION_LEVEL = int(config.get_configuration()['compression_level'])
+    return _COMPRESSION_LEVEL
+
+
+def forget_compression_level() -> None:
+    '''Make the next `Response' read `compression_level' again'''
+    global _COMPRESSION_LEVEL
+    _COMPRESSION_LEVEL = None
+
+
+class Response:
+    '''CGI response whose body is buffered and sent as UTF-8 bytes
+
+    The body is given to `write' (e.g. by a `csv.writer') or `write_all'
+    and sent by `finish' in a single write, after the headers and a
+    Content-Length.  With `streaming', the body is sent each time
+    `chunk_size' characters are buffered and there is no Content-Length.
+
+    The body is compressed when the client accepts gzip or deflate (see
+    `HTTP_ACCEPT_ENCODING') and `compression_level' (defaults to the
+    configuration's) is not 0.  Bodies that `contains_secret' (e.g. a CSRF
+    token) are never compressed: next to reflected query parameters, their
+    compressed length would leak the secret (BREACH).
+
+    The headers are not sent if `print_content_type' was called before:
+    the caller printed them already.'''
+    def __init__(self, content_type: Optional[str], headers: Iterable[tuple[str, str]] = (), file=None,
+                 streaming: bool = False, chunk_size: int = RESPONSE_CHUNK_SIZE,
+                 accept_encoding: Optional[str] = None, compression_level: Optional[int] = None,
+                 contains_secret: bool = False):
+        self.content_type = content_type
+        self.headers = list(headers)
+        self.file = file
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        if content_type is None or contains_secret:
+            # No body to compress (e.g. a redirection) or one not to compress
+            self.compression_level = 0
+        elif compression_level is None:
+            self.compression_level = configured_compression_level()
+        else:
+            self.compression_level = compression_level
+        if self.compression_level > 0:
+            self.content_encoding = negotiate_content_encoding(
+                os.getenv('HTTP_ACCEPT_ENCODING', '') if accept_encoding is None else accept_encoding)
+        else:
+            self.content_encoding = None
+        self._compressor = None
+        self._fragments = []
+        self._buffered = 0
+        self._headers_sent = False
+
+    def write(self, text: str) -> int:
+        self._fragments.append(text)
+        if self.streaming:
+            self._buffered += len(text)
+            if self._buffered >= self.chunk_size:
+                self.flush()
+        return len(text)
+
+    def write_all(self, fragments: Iterable[str]):
+        if self.streaming:
+            for text in fragments:
+                self.write(text)
+        else:
+            self._fragments.extend(fragments)
+
+    def flush(self):
+        if self.streaming:
+            self._send_buffered(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        self._send_buffered(zlib.Z_FINISH)
+
+    def abort(self, logdir=None, trailer: Optional[str] = None) -> bool:
+        '''Drop the body because of the exception being handled
+
+        Returns False when nothing was sent yet: the caller can still respond
+        with an error page.  Otherwise the traceback is only logged in
+        `logdir' (`cgitb' would write HTML into the middle of the body, maybe
+        of a compressed stream) and the body ends with `trailer', e.g. a
+        marker telling the reader that it is incomplete.'''
+        self._fragments.clear()
+        self._buffered = 0
+        if not self._headers_sent:
+            return False
+        import cgitb
+        import io
+        cgitb.Hook(display=0, logdir=logdir, file=io.StringIO()).handle()
+        if trailer is not None:
+            self.write(trailer)
+            self.finish()
+        return True
+
+    def _send_buffered(self, compressor_mode: int):
+        body = ''.join(self._fragments).encode('utf-8')
+        self._fragments.clear()
+        self._buffered = 0
+        if self._headers_sent:
+            head = None
+        else:
+            self._headers_sent = True
+            head = not _html_gen_printed_header
+            if (head
+                    and self.content_encoding is not None
+                    and (self.streaming or len(body) >= COMPRESSION_MIN_SIZE)):
+                self._compressor = zlib.compressobj(
+                    self.compression_level, zlib.DEFLATED, _CONTENT_ENCODING_WBITS[self.content_encoding])
+            else:
+                self.content_encoding = None
+        if self._compressor is not None:
+            body = self._compressor.compress(body) + self._compressor.flush(compressor_mode)
+        if head:
+            body = self._head(None if self.streaming else len(body)) + body
+        self._send(body)
+
+    def _head(self, content_length: Optional[int]) -> bytes:
+        global _html_gen_printed_header
+        _html_gen_printed_header = True
+        lines = [] if self.content_type is None else [f'Content-Type: {self.content_type}']
+        lines.extend(f'{name}: {value}' for name, value in self.headers)
+        if self.compression_level > 0:
+            lines.append('Vary: Accept-Encoding')
+        if self.content_encoding is not None:
+            lines.append(f'Content-Encoding: {self.content_encoding}')
+        if content_length is not None:
+            lines.append(f'Content-Length: {content_length}')
+        return ''.join(f'{line}\n' for line in lines).encode('latin1') + b'\n'
+
+    def _send(self, data: bytes):
+        file = sys.stdout if self.file is None else self.file
+        binary = getattr(file, 'buffer', None)
+        if binary is None:
+            file.write(data.decode('utf-8'))
+            return
+        # What was `print'ed before must come first
+        file.flush()
+        binary.write(data)
+        binary.flush()
+
+
+def respond_html(data, file=None, headers=(), streaming=False, contains_secret=False):
+    response = Response('text/html; charset=utf-8', (('Content-Language', 'en, fr'), *headers), file=file,
+                        streaming=streaming, contains_secret=contains_secret)
+    response.write_all(data)
+    response.finish()
 
 
 def redirect(new_url, and_exit=True, file=None):
-    print('Status: 302', file=file)
-    print(f'Location: {new_url}', file=file)
-    print(file=file)
+    global _html_gen_printed_header
+    # A redirection is a response on its own
+    _html_gen_printed_header = False
+    Response(None, (('Status', '302'), ('Location', new_url)), file=file).finish()
+    if and_exit:
+        sys.exit(0)
+
+
+APP_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def deployment_stamp() -> int:
+    '''Latest modification time (in ns) of the scripts, the libraries and the
+    configuration: they change the pages as much as the data does.'''
+    stamp = 0
+    for directory in (APP_DIR, os.path.join(APP_DIR, 'gestion')):
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.endswith(('.py', '.cgi')) or entry.name == 'configuration.json':
+                    stamp = max(stamp, entry.stat().st_mtime_ns)
+    return stamp
+
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(seconds) -> str:
+    '''`email.utils.formatdate(seconds, usegmt=True)' without importing `email' '''
+    t = time.gmtime(seconds)
+    return (f'{_WEEKDAYS[t.tm_wday]}, {t.tm_mday:02d} {_MONTHS[t.tm_mon - 1]} {t.tm_year:04d}'
+            f' {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} GMT')
+
+
+def _client_copy_is_fresh(etag: str, last_modified: int) -> bool:
+    if_none_match = os.getenv('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present.  The
+        # weak comparison applies (RFC 9110, section 13.1.2).
+        if if_none_match.strip() == '*':
+            return True
+        opaque_tag = etag.removeprefix('W/')
+        return any(tag.strip().removeprefix('W/') == opaque_tag for tag in if_none_match.split(','))
+    if_modified_since = os.getenv('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is None:
+        return False
+    try:
+        import email.utils
+        return last_modified <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def conditional_get(version, last_modified: int = 0, and_exit=True, file=None) -> Optional[tuple[tuple[str, str], ...]]:
+    '''Answer `304 Not Modified' if the browser's copy of the page is current
+
+    `version' is any value (with a stable `repr') that changes whenever the
+    page changes, except for the code and the configuration: they are
+    accounted for.  `last_modified' is the time (in seconds since the epoch)
+    of the last change of the data.
+
+    Call this before doing the work the page needs.  Unless the copy is
+    current, return the validators to give to `respond_html'.  Otherwise,
+    exit after answering or return None if `and_exit' is false.'''
+    global _html_gen_printed_header
+    stamp = deployment_stamp()
+    digest = hashlib.blake2b(repr((stamp, version)).encode('utf-8'), digest_size=12).hexdigest()
+    # Weak: the bytes differ with the Content-Encoding
+    etag = f'W/"{digest}"'
+    last_modified = max(int(last_modified), stamp // 1_000_000_000)
+    headers = (('Cache-Control', 'no-cache'),
+               ('ETag', etag),
+               ('Last-Modified', http_date(last_modified)))
+    if not _client_copy_is_fresh(etag, last_modified):
+        return headers
+    _html_gen_printed_header = False
+    if configured_compression_level() > 0:
+        headers += (('Vary', 'Accept-Encoding'),)
+    # `streaming' leaves Content-Length out: a 304 has no body but the
+    # Content-Length would be the one of the page.
+    Response(None, (('Status', '304'), *headers), file=file, streaming=True).finish()
     if and_exit:
         sys.exit(0)
+    return None
+
 
 def redirect_to_event(suffix=None) -> NoReturn:
     suffix = f"#{suffix}" if suffix else ''
@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
-import cgitb
 import os
 import re
 import time
 from typing import Any, Union
-import urllib
-import uuid
+import urllib.parse
 import sqlite3
 
 from htmlgen import (
     cents_to_euro,
+    cgitb_handler,
     html_document,
     redirect,
     respond_html,
@@ -17,6 +16,8 @@ from htmlgen import (
 from storage import(
     Reservation,
     ensure_connection,
+    is_unique_constraint_error,
+    write_transaction,
 )
 
 
@@ -86,19 +87,23 @@ def validate_data(civility: str, first_name: str, last_name, email, date, paying
     return (civility, first_name, last_name, email, date, paying_seats, free_seats, gdpr_accepts_use)
 
 
+# A clash of bank_ids (see `generate_bank_id') is retried with a new timestamp
+BANK_ID_ATTEMPTS = 3
+
+
 def save_data_sqlite3(
         civility: str, first_name: str, last_name: str, email: str, date: str, paying_seats: int, free_seats: int, gdpr_accepts_use: bool,
         cents_due: int, origin: Union[str, None], connection_or_root_dir: Union[sqlite3.Connection, dict[str, Any]]
 ) -> Reservation:
+    import uuid
     connection = ensure_connection(connection_or_root_dir)
-    process_id = os.getpid()
-    uuid_hex = uuid.uuid4().hex
-    retries = 3
-    while retries > 0:
-        retries -= 1
-        timestamp = time.time()
-        bank_id = generate_bank_id(timestamp, Reservation.length(connection), process_id)
-        try:
+    # The bank_id depends on the number of reservations: count them while
+    # holding the write lock so that concurrent requests get different ones.
+    with write_transaction(connection):
+        reservations_count = Reservation.length(connection)
+        for attempt in range(BANK_ID_ATTEMPTS):
+            timestamp = time.time()
+            bank_id = generate_bank_id(timestamp, reservations_count, os.getpid())
             new_row = Reservation(civility=civility,
                                   first_name=first_name,
                                   last_name=last_name,
@@ -109,20 +114,20 @@ def save_data_sqlite3(
                                   gdpr_accepts_use=gdpr_accepts_use,
                                   cents_due=cents_due,
                                   bank_id=append_bank_id_control_number(bank_id),
-                                  uuid=uuid_hex,
+                                  uuid=uuid.uuid4().hex,
                                   timestamp=timestamp,
                                   active=True,
                                   origin=origin)
-            with connection:
+            try:
                 new_row.insert_data(connection)
-            return new_row
-        except Exception:
-            if retries > 0:
+            except sqlite3.IntegrityError as exc:
+                if attempt + 1 == BANK_ID_ATTEMPTS or not is_unique_constraint_error(exc):
+                    raise
+                # Same bank_id as an older reservation: its timestamp bits
+                # change every 10ms
                 time.sleep(0.011)
-                pass
             else:
-                raise
-    raise RuntimeError(f"Unable to save Reservation for {civility} {first_name} {last_name} {email}")
+                return new_row
 
 
 def to_bits(n):
@@ -192,7 +197,7 @@ def respond_with_reservation_confirmation(
             civility, first_name, last_name, email, date, paying_seats, free_seats, gdpr_accepts_use, cents_due, origin, connection)
     except Exception:
         respond_with_reservation_failed(configuration)
-        cgitb.handler()
+        cgitb_handler()
     else:
         redirect(make_show_reservation_url(
             new_row.bank_id,
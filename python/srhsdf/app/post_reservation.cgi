@@ -4,12 +4,11 @@
 # Test with
 #
 # echo | (cd app && script_name=post_reservation.cgi && env REQUEST_METHOD=POST 'QUERY_STRING=civility=mlle&first_name=Jean&last_name=test&email=i%40example.com&paying_seats=3&free_seats=2&gdpr_accepts_use=true&date=2099-01-01' SERVER_NAME=example.com SCRIPT_NAME=$script_name python3 $script_name)
-import cgi
-import cgitb
 import os
 
 import config
 from htmlgen import (
+    enable_cgitb,
     html_document,
     print_content_type,
     redirect_to_event,
@@ -45,11 +44,12 @@ if __name__ == '__main__':
         redirect_to_event()
     CONFIGURATION = config.get_configuration()
 
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
     try:
         db_connection = create_db(CONFIGURATION)
 
+        import cgi
         # Get form data
         form = cgi.FieldStorage()
         civility = form.getfirst('civility', default='')
@@ -2,20 +2,16 @@
 # -*- coding: utf-8 -*-
 #
 # (export SCRIPT_NAME="$PWD/app/show_reservation.cgi"; cd "$(dirname "$SCRIPT_NAME")" && CONFIGURATION_JSON_DIR="$(dirname "$(ls -t /tmp/tmp.*/configuration.json | head -n 1)")" DB_DB="$CONFIGURATION_JSON_DIR/db.db" REQUEST_METHOD=GET REMOTE_USER="" REMOTE_ADDR="127.0.0.1" QUERY_STRING='bank_id='"$(sqlite3 "$DB_DB" 'select bank_id from reservations order by timestamp desc limit 1')"'&uuid_hex='"$(sqlite3 "$DB_DB" "select uuid from reservations order by timestamp desc limit 1")" SERVER_NAME=localhost python3 $SCRIPT_NAME)
-import cgi
-import cgitb
 import os
 import time
 
-import qrcode
-from qrcode.image.svg import SvgPathFillImage
-
 import config
 from htmlgen import (
     cents_to_euro,
+    enable_cgitb,
     format_bank_id,
+    conditional_get,
     html_document,
-    print_content_type,
     respond_html,
     redirect_to_event,
 )
@@ -23,10 +19,12 @@ from lib_post_reservation import (
     generate_payment_QR_code_content,
     make_show_reservation_url,
 )
+from lib_qr_codes import svg_qr_code
 from storage import(
     Payment,
     Reservation,
     create_db,
+    data_version,
 )
 
 
@@ -43,29 +41,25 @@ if __name__ == '__main__':
     BANK_ACCOUNT = CONFIGURATION["bank_account"]
     ORGANIZER_NAME = CONFIGURATION["organizer_name"]
 
-    cgitb.enable(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
+    enable_cgitb(display=CONFIGURATION['cgitb_display'], logdir=CONFIGURATION['logdir'])
 
+    import cgi
     # Get form data
     form = cgi.FieldStorage()
     bank_id = form.getfirst('bank_id', default='')
     uuid_hex = form.getfirst('uuid_hex', default='')
 
     db_connection = create_db(CONFIGURATION)
+    # Guests reload this page to see whether their transfer arrived
+    versions, last_modified = data_version(db_connection, (Reservation, Payment))
+    validators = conditional_get((bank_id, uuid_hex, SCRIPT_NAME, SERVER_NAME, versions), last_modified)
 
-    try:
-        reservation = next(Reservation.select(
-            db_connection,
-            filtering=[('bank_id', bank_id), ('uuid', uuid_hex)],
-            limit=1))
-    except StopIteration:
+    # Along with its `paid_cents', unlike `Reservation.select'
+    reservation = Reservation.find_by_uuid(db_connection, uuid_hex)
+    if reservation is None or reservation.bank_id != bank_id:
         redirect_to_event()
-        reservation = None
     assert reservation is not None
 
-    if print_content_type('text/html; charset=utf-8'):
-        print('Content-Language: en')
-        print()
-
     places = (' pour ',)
     due_amount_info = ()
     if reservation.paying_seats > 0:
@@ -92,10 +86,9 @@ if __name__ == '__main__':
                 "structurée ", ("code", format_bank_id(reservation.bank_id)), " sur le compte ",
                 BANK_ACCOUNT, " (bénéficiaire '", ORGANIZER_NAME, "') pour votre réservation, p.ex. en scannant ce code QR avec votre application bancaire mobile (testé avec Argenta, Belfius Mobile et BNP Paribas Fortis Easy Banking; incompatible avec Payconiq): ",
                 ('br',),
-                ('raw', qrcode.make(
+                ('raw', svg_qr_code(
                     generate_payment_QR_code_content(remaining_due, reservation.bank_id, CONFIGURATION),
-                    image_factory=SvgPathFillImage
-                ).to_string().decode('utf8')),
+                    CONFIGURATION)),
                 ('br',),
                 last_payment_update,
             )
@@ -123,4 +116,5 @@ if __name__ == '__main__':
          ('p',
           'Ajoutez ', (('a', 'href', self_url), 'cette page'), " à vos favoris ou scannez ce code QR pour suivre l'état actuel de votre réservation:",
           ("br",),
-          ('raw', qrcode.make(self_url, image_factory=SvgPathFillImage).to_string().decode('utf8'))))))
+          ('raw', svg_qr_code(self_url, CONFIGURATION))))),
+        headers=validators)
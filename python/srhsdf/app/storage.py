@@ -1,23 +1,234 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import functools
+import hashlib
+import hmac
+import itertools
+import json
 import os
+import random
 import sqlite3
 import time
-from typing import Any, Callable, Generator, Iterable, Iterator, Optional, TypeVar, Union
-import uuid
+from typing import Any, Callable, Generator, Iterable, Iterator, NamedTuple, Optional, TypeVar, Union
+
+import config
+
+
+class PooledConnection(sqlite3.Connection):
+    # The CGI scripts close their connection when they are done.  When they
+    # run inside the long-running server (see server.py), the connection is
+    # kept open for the next request instead.
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+
+# Maps (process id, database path) to an open connection once
+# `enable_connection_pool' was called, `None' means no pooling (CGI mode).
+_CONNECTION_POOL: Optional[dict[tuple[int, str], PooledConnection]] = None
+
+
+def enable_connection_pool() -> None:
+    global _CONNECTION_POOL
+    if _CONNECTION_POOL is None:
+        _CONNECTION_POOL = {}
+
+
+def release_pooled_connections() -> None:
+    '''Roll back whatever a request left uncommitted in the pooled connections'''
+    if _CONNECTION_POOL is None:
+        return
+    for connection in _CONNECTION_POOL.values():
+        connection.close()
+
+
+# Connection settings, each can be overridden in configuration.json
+CONNECTION_PROFILE_DEFAULTS = {
+    'sqlite_journal_mode': 'wal', # readers do not wait for the writer
+    'sqlite_busy_timeout': 5000, # milliseconds to wait for a lock
+    'sqlite_synchronous': 'normal', # enough for durability in WAL mode
+    'sqlite_cache_size': -2000, # negative: KiB, positive: pages
+    'sqlite_mmap_size': 0, # bytes
+}
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+
+def connection_profile(configuration: dict[str, Any]) -> dict[str, Any]:
+    profile = {key: configuration.get(key, default)
+               for key, default in CONNECTION_PROFILE_DEFAULTS.items()}
+    for key, allowed in (('sqlite_journal_mode', JOURNAL_MODES),
+                         ('sqlite_synchronous', SYNCHRONOUS_LEVELS)):
+        profile[key] = str(profile[key]).lower()
+        if profile[key] not in allowed:
+            raise ValueError(f"{key} should be one of {', '.join(allowed)}, not {profile[key]!r}")
+    for key in ('sqlite_busy_timeout', 'sqlite_cache_size', 'sqlite_mmap_size'):
+        profile[key] = int(profile[key])
+    return profile
+
+
+def connect(db_path: str, profile: dict[str, Any], **kwargs) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_path, timeout=profile['sqlite_busy_timeout'] / 1000.0, **kwargs)
+    # PRAGMA does not support parameter binding, the values were validated
+    # by `connection_profile':
+    connection.execute(f"PRAGMA journal_mode = {profile['sqlite_journal_mode']}")
+    connection.execute(f"PRAGMA synchronous = {profile['sqlite_synchronous']}")
+    connection.execute(f"PRAGMA cache_size = {profile['sqlite_cache_size']}")
+    connection.execute(f"PRAGMA mmap_size = {profile['sqlite_mmap_size']}")
+    return connection
 
 
 def create_db(configuration: dict[str, Any]) -> sqlite3.Connection:
     root_dir = configuration['dbdir']
-    connection = sqlite3.connect(
-        root_dir if root_dir == ':memory:' else os.path.join(root_dir, 'db.db'))
-    for table in (Csrf, Reservation, Payment):
+    db_path = root_dir if root_dir == ':memory:' else os.path.join(root_dir, 'db.db')
+    if _CONNECTION_POOL is None or db_path == ':memory:':
+        connection = connect(db_path, connection_profile(configuration))
+    else:
+        pool_key = (os.getpid(), db_path)
         try:
-            connection.execute(f'SELECT COUNT(*) FROM {table.TABLE_NAME}')
-        except Exception:
-            table.create_in_db(connection)
+            return _CONNECTION_POOL[pool_key]
+        except KeyError:
+            connection = _CONNECTION_POOL[pool_key] = connect(
+                db_path, connection_profile(configuration), factory=PooledConnection)
+    migrate_db(connection, db_path=None if db_path == ':memory:' else db_path)
     return connection
 
 
+def is_busy_error(exc: sqlite3.OperationalError) -> bool:
+    # Older sqlite3 modules do not have `sqlite_errorname'
+    errorname = getattr(exc, 'sqlite_errorname', None)
+    if errorname is not None:
+        return errorname.startswith(('SQLITE_BUSY', 'SQLITE_LOCKED'))
+    return bool(exc.args) and 'database is locked' in str(exc.args[0])
+
+
+def is_unique_constraint_error(exc: sqlite3.IntegrityError) -> bool:
+    # My python versions and their shipped sqlite3 modules differ between my dev system and my deployment system :sad:
+    errorname = getattr(exc, 'sqlite_errorname', None)
+    if errorname is not None:
+        return errorname == 'SQLITE_CONSTRAINT_UNIQUE'
+    return bool(exc.args) and isinstance(exc.args[0], str) and exc.args[0].startswith('UNIQUE ')
+
+
+@contextlib.contextmanager
+def write_transaction(connection: sqlite3.Connection, attempts: int = 6, first_delay: float = 0.01) -> Iterator[sqlite3.Connection]:
+    '''Run the body of the `with' statement as the only writer of the database
+
+    The write lock is taken when the transaction starts (BEGIN IMMEDIATE) so
+    that concurrent writers queue up instead of failing when they try to
+    upgrade their read lock.  SQLite waits for `sqlite_busy_timeout'
+    milliseconds for the lock, then the lock is requested again after an
+    exponentially growing, randomized delay.  Commits if the body succeeds,
+    rolls back otherwise.  Inside an already open transaction, the body just
+    becomes part of it.
+    '''
+    if connection.in_transaction:
+        yield connection
+        return
+    delay = first_delay
+    for attempt in range(attempts):
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as exc:
+            if attempt + 1 >= attempts or not is_busy_error(exc):
+                raise
+        time.sleep(delay * random.uniform(1.0, 2.0))
+        delay *= 2
+    try:
+        yield connection
+    except BaseException:
+        connection.rollback()
+        raise
+    else:
+        connection.commit()
+
+
+def schema_version(tables: Iterable[type["MiniOrm"]]) -> int:
+    return max(version for table in tables for version in table.MIGRATIONS)
+
+
+# Paths of the databases whose full text search indexes this process has
+# already looked for, see `migrate_db'
+_FULL_TEXT_SEARCH_CHECKED: set[str] = set()
+
+
+def migrate_db(connection: sqlite3.Connection, tables: Optional[Iterable[type["MiniOrm"]]] = None, db_path: Optional[str] = None) -> int:
+    '''Bring the schema to the latest version and return that version
+
+    The schema version is stored in `PRAGMA user_version'.  Each MiniOrm
+    subclass declares its migration steps in `MIGRATIONS', a mapping from
+    schema version to SQL statements (or to a function of the subclass
+    returning them).  Version 1 creates the tables as they
+    were before versioning existed: databases created back then have a
+    `user_version' of 0 and their tables are not created again.
+
+    With the `db_path' of the database file, its full text search indexes
+    are looked for once per process only.
+    '''
+    tables = (Csrf, Reservation, Payment) if tables is None else tuple(tables)
+    target = schema_version(tables)
+    if connection.execute('PRAGMA user_version').fetchone()[0] >= target:
+        if db_path in _FULL_TEXT_SEARCH_CHECKED:
+            return target
+        # Indexes skipped when an SQLite without trigram FTS5 migrated the database
+        if missing_full_text_search(connection, tables):
+            with write_transaction(connection):
+                for table in missing_full_text_search(connection, tables):
+                    for statement in full_text_search_migration(table, table.FULL_TEXT_SEARCH_KEY):
+                        connection.execute(statement)
+        if db_path is not None:
+            _FULL_TEXT_SEARCH_CHECKED.add(db_path)
+        return target
+    # Look at the version again once holding the write lock: another process
+    # may have migrated the database in the meantime.
+    with write_transaction(connection):
+        current = connection.execute('PRAGMA user_version').fetchone()[0]
+        if current == 0:
+            existing = {row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        else:
+            existing = set()
+        for version in range(current + 1, target + 1):
+            for table in tables:
+                if version == 1 and table.TABLE_NAME in existing:
+                    continue
+                statements = table.MIGRATIONS.get(version, ())
+                for statement in (statements(table) if callable(statements) else statements):
+                    connection.execute(statement)
+        # PRAGMA does not support parameter binding, `target' is an int:
+        connection.execute(f'PRAGMA user_version = {target}')
+    return target
+
+
+# Maps the path of a database (empty for in-memory ones) to the key of the
+# CSRF tokens, see `Csrf.secret'.
+_CSRF_SECRETS: dict[str, bytes] = {}
+
+
+def _read_or_create_secret(path: str) -> bytes:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    # Concurrent requests may create the key: only the first one is linked
+    # into place and all of them use it.
+    import tempfile
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(temporary_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(temporary_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
 def ensure_connection(connection_or_root_dir: Union[sqlite3.Connection, dict[str, Any]]) -> sqlite3.Connection:
     return (connection_or_root_dir
             if isinstance(connection_or_root_dir, sqlite3.Connection) else
@@ -29,6 +240,202 @@ def default_creation_statement(table_name: str, columns: Iterable[tuple[str, str
 
 
 
+def full_text_search_statements(table_name: str, columns: Iterable[str], key: str = 'rowid') -> list[str]:
+    '''Statements creating `<table_name>_fts', a trigram FTS5 index over
+    `columns' of `table_name' kept up to date by triggers.
+
+    The index refers to the rows by `key', an INTEGER column that a VACUUM
+    does not renumber, unlike the implicit rowid of a table without INTEGER
+    PRIMARY KEY.  Rows are indexed once their `key' is set, see
+    `full_text_search_key_migration'.'''
+    fts_name = f'{table_name}_fts'
+    columns = list(columns)
+    names = ', '.join(columns)
+    old_values = ', '.join(f'OLD.{col}' for col in columns)
+    new_values = ', '.join(f'NEW.{col}' for col in columns)
+    statements = [
+        f"CREATE VIRTUAL TABLE {fts_name} USING fts5({names}, content='{table_name}', content_rowid='{key}', tokenize='trigram')",
+        f"INSERT INTO {fts_name}({fts_name}) VALUES('rebuild')",
+        f'''CREATE TRIGGER {fts_name}_insert AFTER INSERT ON {table_name}
+            WHEN NEW.{key} IS NOT NULL
+            BEGIN
+                INSERT INTO {fts_name}(rowid, {names}) VALUES (NEW.{key}, {new_values});
+            END''',
+        f'''CREATE TRIGGER {fts_name}_delete AFTER DELETE ON {table_name}
+            WHEN OLD.{key} IS NOT NULL
+            BEGIN
+                INSERT INTO {fts_name}({fts_name}, rowid, {names}) VALUES ('delete', OLD.{key}, {old_values});
+            END''',
+        f'''CREATE TRIGGER {fts_name}_update AFTER UPDATE OF {names} ON {table_name}
+            WHEN OLD.{key} IS NOT NULL
+            BEGIN
+                INSERT INTO {fts_name}({fts_name}, rowid, {names}) VALUES ('delete', OLD.{key}, {old_values});
+                INSERT INTO {fts_name}(rowid, {names}) VALUES (NEW.{key}, {new_values});
+            END''',
+    ]
+    if key != 'rowid':
+        statements.append(
+            f'''CREATE TRIGGER {fts_name}_key AFTER UPDATE OF {key} ON {table_name}
+               WHEN OLD.{key} IS NULL
+               BEGIN
+                   INSERT INTO {fts_name}(rowid, {names}) VALUES (NEW.{key}, {new_values});
+               END''')
+    return statements
+
+
+@functools.lru_cache(maxsize=None)
+def has_trigram_fts5() -> bool:
+    '''Whether the SQLite in use has FTS5 and its trigram tokenizer (3.34+)
+
+    Without them, the `FULL_TEXT_SEARCH_COLUMNS' are searched with LIKE.'''
+    probe = sqlite3.connect(':memory:')
+    try:
+        probe.execute("CREATE VIRTUAL TABLE probe USING fts5(x, tokenize='trigram')")
+    except sqlite3.Error:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def full_text_search_migration(table: type["MiniOrm"], key: str = 'rowid') -> list[str]:
+    '''`full_text_search_statements' of `table' if `has_trigram_fts5'''
+    if not has_trigram_fts5():
+        return []
+    return full_text_search_statements(table.TABLE_NAME, table.FULL_TEXT_SEARCH_COLUMNS, key)
+
+
+def full_text_search_key_migration(table: type["MiniOrm"], key: str) -> list[str]:
+    '''Statements adding the INTEGER column `key' to `table' (numbered by a
+    trigger) and keying its full text search index on it instead of the
+    implicit rowid'''
+    table_name = table.TABLE_NAME
+    fts_name = f'{table_name}_fts'
+    return [
+        f'ALTER TABLE {table_name} ADD COLUMN {key} INTEGER',
+        f'UPDATE {table_name} SET {key} = rowid',
+        f'CREATE UNIQUE INDEX index_{key}_{table_name} ON {table_name} ({key})',
+        f'''CREATE TRIGGER {table_name}_{key}_insert AFTER INSERT ON {table_name}
+            WHEN NEW.{key} IS NULL
+            BEGIN
+                UPDATE {table_name} SET {key} = (SELECT COALESCE(MAX({key}), 0) + 1 FROM {table_name})
+                WHERE rowid = NEW.rowid;
+            END''',
+        *(f'DROP TRIGGER IF EXISTS {fts_name}_{event}' for event in ('insert', 'delete', 'update')),
+        f'DROP TABLE IF EXISTS {fts_name}',
+        *full_text_search_migration(table, key),
+    ]
+
+
+def missing_full_text_search(connection: sqlite3.Connection, tables: Iterable[type["MiniOrm"]]) -> list[type["MiniOrm"]]:
+    '''The `tables' whose full text search index was skipped by
+    `full_text_search_migration' but could be created now'''
+    tables = [table for table in tables if getattr(table, 'FULL_TEXT_SEARCH_COLUMNS', ())]
+    if not tables or not has_trigram_fts5():
+        return []
+    names = [f'{table.TABLE_NAME}_fts' for table in tables]
+    existing = {row[0] for row in connection.execute(
+        f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' for _ in names)})",
+        names)}
+    return [table for table, name in zip(tables, names) if name not in existing]
+
+
+DATA_VERSIONS_TABLE_NAME = 'data_versions'
+# Seconds since the epoch, with the fractional part
+CHANGED_AT_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def data_version_statements(table_name: str) -> list[str]:
+    '''Statements counting the changes of `table_name' in `data_versions'
+    (with the time of the last change) by triggers.
+
+    Unlike `PRAGMA data_version', the count is kept in the database: it is
+    the same for every connection and survives the CGI process.'''
+    versions = DATA_VERSIONS_TABLE_NAME
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    bump = f"UPDATE {versions} SET version = version + 1, modified = {now} WHERE table_name = '{table_name}';"
+    return [
+        f'''CREATE TABLE IF NOT EXISTS {versions} (
+                table_name TEXT NOT NULL PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                modified INTEGER NOT NULL)''',
+        f"INSERT INTO {versions} (table_name, modified) VALUES ('{table_name}', {now})",
+        *(f'''CREATE TRIGGER {table_name}_version_{event.lower()} AFTER {event} ON {table_name}
+              BEGIN {bump} END'''
+          for event in ('INSERT', 'UPDATE', 'DELETE')),
+    ]
+
+
+def changed_at_statements(table_name: str, columns: Iterable[str]) -> list[str]:
+    '''Statements adding `changed_at' to `table_name': the time (seconds
+    since the epoch) of the last change of one of its `columns', kept by
+    triggers.
+
+    The update trigger also catches the updates made by other triggers, e.g.
+    of `paid_cents'.  Payment.MIGRATIONS touches the reservations whose
+    payments change.'''
+    touch = f"UPDATE {table_name} SET changed_at = {CHANGED_AT_NOW}"
+    return [
+        f'ALTER TABLE {table_name} ADD COLUMN changed_at REAL NOT NULL DEFAULT 0',
+        # The changes made before the migration are unknown: the next
+        # incremental export gets every reservation.
+        touch,
+        f'CREATE INDEX index_changed_at_{table_name} ON {table_name} (changed_at)',
+        f'''CREATE TRIGGER {table_name}_changed_at_insert AFTER INSERT ON {table_name}
+              BEGIN {touch} WHERE rowid = NEW.rowid; END''',
+        f'''CREATE TRIGGER {table_name}_changed_at_update AFTER UPDATE OF {', '.join(columns)} ON {table_name}
+              BEGIN {touch} WHERE rowid = NEW.rowid; END''',
+    ]
+
+
+def data_version(connection: sqlite3.Connection, tables: Iterable[type["MiniOrm"]]) -> tuple[tuple[int, ...], int]:
+    '''Change counts of `tables' and the time of the last change of any of them
+
+    Pages use them to validate the copies cached by the browsers.'''
+    names = [table.TABLE_NAME for table in tables]
+    versions = dict.fromkeys(names, 0)
+    modified = 0
+    for name, version, table_modified in connection.execute(
+            f"SELECT table_name, version, modified FROM {DATA_VERSIONS_TABLE_NAME} "
+            f"WHERE table_name IN ({', '.join('?' for _ in names)})",
+            names):
+        versions[name] = version
+        modified = max(modified, table_modified)
+    return tuple(versions.values()), modified
+
+
+class Page(NamedTuple):
+    '''One page of rows fetched by keyset pagination, see `MiniOrm.select_page'.
+
+    `first_key' and `last_key' are the sort keys of the first and last item:
+    pass them as `before' resp. `after' to fetch the previous resp. next page.'''
+    items: list[Any]
+    first_key: Optional[list[Any]]
+    last_key: Optional[list[Any]]
+    has_previous: bool
+    has_next: bool
+
+
+def keyset_key_to_str(key: Optional[list[Any]]) -> Optional[str]:
+    return None if key is None else json.dumps(key, separators=(',', ':'))
+
+
+def keyset_key_from_str(value: Optional[str], ordering: Optional[list[tuple[str, bool]]] = None) -> Optional[list[Any]]:
+    '''Decode a sort key from a URL parameter, `None' if it is malformed or
+    doesn't fit `ordering' (see `MiniOrm.keyset_ordering')'''
+    if not value:
+        return None
+    try:
+        key = json.loads(value)
+    except ValueError:
+        return None
+    if (isinstance(key, list)
+            and all(x is None or isinstance(x, (str, int, float)) for x in key)
+            and (ordering is None or len(key) == len(ordering))):
+        return key
+    return None
+
+
 class MiniOrm:
     TABLE_NAME: str
     CREATION_STATEMENTS: Iterable[str]
@@ -36,6 +443,11 @@ class MiniOrm:
     SORTABLE_COLUMNS: dict[str, str] = {} # override with column info for `select'
 
     FILTERABLE_COLUMNS: dict[str, Union[tuple[()], tuple[str, str, Callable]]] = {} # override with column info for `select'
+    MIGRATIONS: dict[int, Union[Iterable[str], Callable[[type["MiniOrm"]], Iterable[str]]]] = {} # schema version -> statements, see `migrate_db'
+    KEYSET_TIEBREAKER = 'rowid' # unique column ending every keyset ordering, see `select_page'
+    FULL_TEXT_SEARCH_COLUMNS: tuple[str, ...] = () # FILTERABLE_COLUMNS searched with `full_text_search_statements' index
+    FULL_TEXT_SEARCH_KEY = 'rowid' # INTEGER column keying that index, must survive a VACUUM
+    __slots__ = () # subclasses list their attributes: no `__dict__' per row
 
     def __str__(self):
         try:
@@ -95,12 +507,62 @@ class MiniOrm:
 
     @staticmethod
     def compare_as_bool(x: str) -> tuple[str, str, Callable[[Any], int]]:
-        return (x, '=', lambda val: 1 if val else 0)
+        # `where_clause' writes `x != 0' or `x = 0' without parameter so that
+        # SQLite can use the partial indexes on `active != 0'.
+        return (x, 'bool', lambda val: 1 if val else 0)
 
     T = TypeVar("T", bound="MiniOrm")
 
     @classmethod
-    def select(cls: type[T], connection, filtering=None, order_columns=None, limit=None, offset=None) -> Generator[T, None, None]:
+    def insert_many(cls: type[T], connection, objects: Iterable[T], chunk_size: int = 200) -> list[tuple[Optional[Exception], T]]:
+        '''Insert `objects' with one `executemany' per `chunk_size' objects
+
+        Returns an (exception, object) pair per object, in order, where the
+        exception is None if the object was inserted.  Call it inside
+        `write_transaction'.'''
+        outcomes = []
+        objects = iter(objects)
+        while chunk := list(itertools.islice(objects, chunk_size)):
+            outcomes.extend(cls.insert_chunk(connection, chunk))
+        return outcomes
+
+    @classmethod
+    def insert_chunk(cls: type[T], connection, chunk: list[T]) -> list[tuple[Optional[Exception], T]]:
+        '''See `insert_many': when the `executemany' fails, its partial work
+        is rolled back and the rows are inserted one by one to find out which
+        rows fail.'''
+        names = [col for col, _ in cls.COLUMNS]
+        statement = f'INSERT INTO {cls.TABLE_NAME} ({",".join(names)}) VALUES ({",".join("?" * len(names))})'
+        rows = [[value for _, value in obj.assoc_iterable()] for obj in chunk]
+        connection.execute('SAVEPOINT insert_chunk')
+        try:
+            connection.executemany(statement, rows)
+        except sqlite3.Error:
+            connection.execute('ROLLBACK TO insert_chunk')
+        else:
+            connection.execute('RELEASE insert_chunk')
+            return [(None, obj) for obj in chunk]
+        outcomes = []
+        for obj, row in zip(chunk, rows):
+            try:
+                connection.execute(statement, row)
+            except Exception as exc:
+                outcomes.append((exc, obj))
+            else:
+                outcomes.append((None, obj))
+        connection.execute('RELEASE insert_chunk')
+        return outcomes
+
+    @classmethod
+    def select(cls: type[T], connection, filtering=None, order_columns=None, limit=None, offset=None, after=None, before=None) -> Generator[T, None, None]:
+        if after is not None or before is not None:
+            query, params, ordering = cls.keyset_query(filtering, order_columns, limit, after, before)
+            rows = connection.execute(query, params).fetchall()
+            if before is not None:
+                rows.reverse()
+            for row in rows:
+                yield cls.from_row(row[:-len(ordering)])
+            return
         params = dict()
         query = [f'SELECT {",".join(col[0] for col in cls.COLUMNS)} FROM {cls.TABLE_NAME}']
         if filtering is not None:
@@ -122,6 +584,122 @@ class MiniOrm:
         for row in connection.execute(' '.join(query), params):
             yield cls.from_row(row)
 
+    @classmethod
+    def select_page(cls, connection, filtering=None, order_columns=None, limit=20, after=None, before=None, offset=None) -> Page:
+        '''Fetch `limit' rows following `after' (or preceding `before')
+
+        Seeking to the sort key of the previous page's boundary instead of
+        skipping `OFFSET' rows keeps the cost of any page proportional to
+        `limit'.  `offset' is only used when there is no key to seek to.'''
+        query, params, ordering = cls.keyset_query(filtering, order_columns, limit + 1, after, before, offset)
+        return cls.make_page(
+            connection.execute(query, params).fetchall(), len(ordering), limit, after, before, offset, cls.from_row)
+
+    @classmethod
+    def keyset_ordering(cls, order_columns) -> list[tuple[str, bool]]:
+        '''List of (expression, descending) sorting the rows in a total order'''
+        ordering = []
+        for col in order_columns or ():
+            try:
+                ordering.append((cls.SORTABLE_COLUMNS[col.lower()], col[0].isupper()))
+            except KeyError:
+                continue
+        # Same direction as the last column: sorting on one indexed column
+        # walks the index (which ends with the rowid) in either direction.
+        ordering.append((cls.KEYSET_TIEBREAKER, ordering[-1][1] if ordering else False))
+        return ordering
+
+    @classmethod
+    def not_null_sort_expressions(cls) -> set[str]:
+        '''Sort expressions that can't be NULL (see `seek_clause')'''
+        not_null = {col for col, definition in cls.COLUMNS if 'NOT NULL' in definition.upper()}
+        return {cls.KEYSET_TIEBREAKER, *not_null, *(f'LOWER({col})' for col in not_null)}
+
+    @staticmethod
+    def seek_clause(ordering: list[tuple[str, bool]], key: list[Any], backwards: bool = False, not_null: Iterable[str] = ()) -> tuple[str, dict[str, Any]]:
+        '''Condition matching the rows sorted after `key' (before if `backwards')
+
+        SQLite sorts NULL before any other value, i.e. first when ascending
+        and last when descending.  A redundant range on the first sort
+        expression lets SQLite start the walk of an index on that expression
+        at `key', that range is only possible when no NULL comes after `key',
+        see `not_null'.'''
+        if len(key) != len(ordering):
+            raise ValueError(f"{key=} does not match {ordering=}")
+        params = dict()
+        alternatives = []
+        equalities = []
+        for idx, ((expression, descending), value) in enumerate(zip(ordering, key)):
+            var_name = f'seek_{idx}'
+            params[var_name] = value
+            if descending == backwards:
+                after = f'{expression} IS NOT NULL' if value is None else f'{expression} > :{var_name}'
+            else:
+                after = None if value is None else f'({expression} < :{var_name} OR {expression} IS NULL)'
+            if after is not None:
+                alternatives.append('(' + ' AND '.join([*equalities, after]) + ')')
+            equalities.append(f'{expression} IS :{var_name}')
+        if not alternatives:
+            return ('0', params)
+        clause = '(' + ' OR '.join(alternatives) + ')'
+        (first_expression, first_descending), first_value = ordering[0], key[0]
+        if first_value is not None:
+            if first_descending == backwards:
+                clause = f'({first_expression} >= :seek_0 AND {clause})'
+            elif first_expression in not_null:
+                clause = f'({first_expression} <= :seek_0 AND {clause})'
+        return (clause, params)
+
+    @classmethod
+    def keyset_query(cls, filtering, order_columns, limit, after, before, offset=None) -> tuple[str, dict[str, Any], list[tuple[str, bool]]]:
+        '''Query for `select' and `select_page'
+
+        The sort key of each row is appended after the table columns as
+        `sort_key_0', `sort_key_1', etc.  Rows come in reverse order when
+        seeking `before' a key.'''
+        ordering = cls.keyset_ordering(order_columns)
+        backwards = before is not None
+        params = dict()
+        clauses = []
+        if filtering is not None:
+            filter_clauses, extra_params = cls.where_clause(filtering)
+            if filter_clauses:
+                clauses.append(filter_clauses)
+                params.update(extra_params)
+        if before is not None or after is not None:
+            seek, extra_params = cls.seek_clause(
+                ordering, before if backwards else after, backwards, cls.not_null_sort_expressions())
+            clauses.append(seek)
+            params.update(extra_params)
+        query = [f'SELECT {",".join(col[0] for col in cls.COLUMNS)}, '
+                 f'{",".join(f"{expression} AS sort_key_{idx}" for idx, (expression, _) in enumerate(ordering))} '
+                 f'FROM {cls.TABLE_NAME}']
+        if clauses:
+            query.append(f'WHERE {" AND ".join(clauses)}')
+        query.append('ORDER BY ' + ','.join(
+            f'sort_key_{idx} {"DESC" if descending != backwards else "ASC"}'
+            for idx, (_, descending) in enumerate(ordering)))
+        if limit is not None:
+            query.append('LIMIT :limit')
+            params['limit'] = limit
+            if offset and after is None and before is None:
+                query.append('OFFSET :offset')
+                params['offset'] = offset
+        return ' '.join(query), params, ordering
+
+    @staticmethod
+    def make_page(rows, nb_keys: int, limit: int, after, before, offset, make_item: Callable[[Any], Any]) -> Page:
+        '''Build a `Page' from the (up to `limit + 1') rows of `keyset_query' '''
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return Page(items=[make_item(row[:-nb_keys]) for row in rows],
+                    first_key=list(rows[0][-nb_keys:]) if rows else None,
+                    last_key=list(rows[-1][-nb_keys:]) if rows else None,
+                    has_previous=has_more if before is not None else after is not None or bool(offset),
+                    has_next=before is not None or has_more)
+
     @classmethod
     def parse_from_row(cls: type[T], row: list[Any]) -> tuple[Union[T, None], list[Any]]:
         nb_cols = len(cls.COLUMNS)
@@ -186,8 +764,17 @@ class MiniOrm:
             except KeyError:
                 continue
             var_name = f'filter_{col}'
+            if col in cls.FULL_TEXT_SEARCH_COLUMNS and has_trigram_fts5():
+                search = cls.full_text_search_clause(col, val, var_name)
+                if search is not None:
+                    clauses.append(f'{table_id_prefix}{cls.FULL_TEXT_SEARCH_KEY} IN ({search[0]})')
+                    params[var_name] = search[1]
+                    continue
             col_value, operator, target_value = cls.encode_column_value_for_search(
                 col, val, info)
+            if operator == 'bool':
+                clauses.append(f'{table_id_prefix}{col_value} {"!=" if target_value else "="} 0')
+                continue
             params[var_name] = target_value
             clauses.append(f'{table_id_prefix}{col_value} {operator} :{var_name}')
         if clauses:
@@ -195,6 +782,69 @@ class MiniOrm:
         else:
             return ([], {})
 
+    @classmethod
+    def full_text_search_clause(cls, col: str, val: Any, var_name: str) -> Optional[tuple[str, str]]:
+        '''Subquery finding the `FULL_TEXT_SEARCH_KEY' of the rows whose `col'
+        contains `val' (case insensitive), None if the index can't help'''
+        val = str(val)
+        if len(val) < 3 or '%' in val:
+            # The trigram index can't MATCH less than 3 characters or LIKE
+            # patterns.  FTS5 would answer a LIKE by reading the rows of the
+            # table one at a time: `where_clause' LIKE scans them faster.
+            return None
+        fts_name = f'{cls.TABLE_NAME}_fts'
+        return (f'SELECT rowid FROM {fts_name} WHERE {fts_name} MATCH :{var_name}',
+                f'{col} : "' + val.replace('"', '""') + '"')
+
+
+# Per-date totals of the reservations, maintained by triggers (see
+# Reservation.MIGRATIONS) so that list_reservations.cgi does not scan all
+# reservations.  Maps column names to their definition in terms of a
+# reservations row; all but `reservations' only count active reservations.
+RESERVATION_TOTALS_TABLE_NAME = 'reservation_totals'
+RESERVATION_TOTALS = [
+    ('reservations', '1'),
+    ('active_reservations', '1'),
+    ('places', 'COALESCE({r}paying_seats + {r}free_seats, 0)'),
+]
+
+
+def _reservation_totals_terms(r: str) -> list[str]:
+    return [expression.format(r=r)
+            if col == 'reservations' else
+            f'(CASE WHEN {r}active != 0 THEN {expression.format(r=r)} ELSE 0 END)'
+            for col, expression in RESERVATION_TOTALS]
+
+
+def reservation_totals_statements(table_name: str) -> list[str]:
+    totals = RESERVATION_TOTALS_TABLE_NAME
+    columns = [col for col, _ in RESERVATION_TOTALS]
+    # Columns of the reservations table the totals depend on
+    counted_columns = ['date', 'active', 'paying_seats', 'free_seats']
+
+    def apply(row: str, sign: str) -> str:
+        return (f"INSERT OR IGNORE INTO {totals} (date) VALUES ({row}.date);\n"
+                f"UPDATE {totals} SET "
+                + ", ".join(f"{col} = {col} {sign} {term}"
+                            for col, term in zip(columns, _reservation_totals_terms(f'{row}.')))
+                + f" WHERE date = {row}.date;")
+
+    return [
+        default_creation_statement(
+            totals,
+            [('date', 'TEXT NOT NULL PRIMARY KEY'),
+             *((col, 'INTEGER NOT NULL DEFAULT 0') for col in columns)]),
+        f"""INSERT INTO {totals} (date, {", ".join(columns)})
+            SELECT date, {", ".join(f"SUM({term})" for term in _reservation_totals_terms(''))}
+            FROM {table_name} GROUP BY date""",
+        f"""CREATE TRIGGER {table_name}_totals_insert AFTER INSERT ON {table_name}
+            BEGIN {apply('NEW', '+')} END""",
+        f"""CREATE TRIGGER {table_name}_totals_update AFTER UPDATE OF {", ".join(counted_columns)} ON {table_name}
+            BEGIN {apply('OLD', '-')} {apply('NEW', '+')} END""",
+        f"""CREATE TRIGGER {table_name}_totals_delete AFTER DELETE ON {table_name}
+            BEGIN {apply('OLD', '-')} END""",
+    ]
+
 
 class Reservation(MiniOrm):
     TABLE_NAME = 'reservations'
@@ -214,10 +864,46 @@ class Reservation(MiniOrm):
         ("active", "INTEGER"),
         ("origin", "TEXT"),
     ]
+    __slots__ = (*(col for col, _ in COLUMNS), 'paid_cents')
     CREATION_STATEMENTS = [
         default_creation_statement(TABLE_NAME, COLUMNS),
         f'CREATE UNIQUE INDEX index_bank_id_{TABLE_NAME} ON {TABLE_NAME} (bank_id)',
         f'CREATE UNIQUE INDEX index_uuid_{TABLE_NAME} ON {TABLE_NAME} (uuid)']
+    FULL_TEXT_SEARCH_COLUMNS = ('last_name', 'email')
+    # Not in COLUMNS, see MIGRATIONS
+    FULL_TEXT_SEARCH_KEY = 'search_rowid'
+    MIGRATIONS = {
+        1: CREATION_STATEMENTS,
+        2: full_text_search_migration,
+        # Sort keys of list_reservations.cgi, which only lists active
+        # reservations.  Like every step, these statements are frozen: change
+        # an index in a new step.
+        3: [f'CREATE INDEX index_name_{TABLE_NAME} ON {TABLE_NAME} (LOWER(last_name||first_name)) WHERE active != 0',
+            f'CREATE INDEX index_email_{TABLE_NAME} ON {TABLE_NAME} (LOWER(email)) WHERE active != 0',
+            f'CREATE INDEX index_date_{TABLE_NAME} ON {TABLE_NAME} (date) WHERE active != 0',
+            f'CREATE INDEX index_paying_seats_{TABLE_NAME} ON {TABLE_NAME} (paying_seats) WHERE active != 0',
+            f'CREATE INDEX index_free_seats_{TABLE_NAME} ON {TABLE_NAME} (free_seats) WHERE active != 0',
+            f'CREATE INDEX index_origin_{TABLE_NAME} ON {TABLE_NAME} (LOWER(origin)) WHERE active != 0',
+            f'CREATE INDEX index_timestamp_{TABLE_NAME} ON {TABLE_NAME} (timestamp) WHERE active != 0'],
+        4: data_version_statements(TABLE_NAME),
+        # After Csrf's step 5
+        6: reservation_totals_statements(TABLE_NAME),
+        # `paid_cents' is the sum of the payments linked to the reservation,
+        # see the triggers in Payment.MIGRATIONS.  It is not part of COLUMNS.
+        7: [f'ALTER TABLE {TABLE_NAME} ADD COLUMN paid_cents INTEGER NOT NULL DEFAULT 0',
+            f"""UPDATE {TABLE_NAME} SET paid_cents = (
+                    SELECT COALESCE(SUM(amount_in_cents), 0) FROM payments WHERE payments.uuid = {TABLE_NAME}.uuid)""",
+            # Payments may be linked before the reservation is inserted
+            f"""CREATE TRIGGER {TABLE_NAME}_paid_cents_insert AFTER INSERT ON {TABLE_NAME}
+                BEGIN
+                    UPDATE {TABLE_NAME} SET paid_cents = (
+                        SELECT COALESCE(SUM(amount_in_cents), 0) FROM payments WHERE payments.uuid = NEW.uuid)
+                    WHERE rowid = NEW.rowid;
+                END"""],
+        8: changed_at_statements(TABLE_NAME, (*(col for col, _ in COLUMNS), 'paid_cents')),
+        # Key of the full text search index that a VACUUM keeps
+        9: functools.partial(full_text_search_key_migration, key='search_rowid'),
+    }
 
     @property
     def name(self) -> str:
@@ -240,10 +926,12 @@ class Reservation(MiniOrm):
         self.timestamp = timestamp
         self.active = active
         self.origin = origin
+        # Set by `with_paid_cents' to avoid one query per reservation
+        self.paid_cents: Optional[int] = None
 
     def insert_data(self, connection) -> "Reservation":
         connection.execute(
-            f'''INSERT INTO {self.TABLE_NAME} VALUES (
+            f'''INSERT INTO {self.TABLE_NAME} ({",".join(col[0] for col in self.COLUMNS)}) VALUES (
                     {",".join(":" + name for name, _ in self.assoc_iterable())}
                 )''',
             self.to_dict())
@@ -258,30 +946,110 @@ class Reservation(MiniOrm):
         ).fetchone()
 
     def remaining_amount_due_in_cents(self, connection: Union[sqlite3.Cursor, sqlite3.Connection]):
-        # TODO: not the most efficient but I have small data sets only anyway (less than 100 rows)
-        return self.cents_due - Payment.sum_payments(connection, self.uuid)
+        if self.paid_cents is None:
+            return self.cents_due - Payment.sum_payments(connection, self.uuid)
+        return self.cents_due - self.paid_cents
+
+    @classmethod
+    def paid_cents_by_uuid(cls, connection: Union[sqlite3.Cursor, sqlite3.Connection], uuids: Optional[Iterable[str]] = None) -> dict[str, int]:
+        if uuids is None:
+            return dict(connection.execute(f'SELECT uuid, paid_cents FROM {cls.TABLE_NAME}'))
+        uuids = list(uuids)
+        result = {}
+        # Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+        for start in range(0, len(uuids), 500):
+            chunk = uuids[start:start + 500]
+            result.update(connection.execute(
+                f'SELECT uuid, paid_cents FROM {cls.TABLE_NAME} WHERE uuid IN ({",".join("?" * len(chunk))})',
+                chunk))
+        return result
+
+    @classmethod
+    def with_paid_cents(cls, connection: Union[sqlite3.Cursor, sqlite3.Connection], reservations: Iterable["Reservation"]) -> Iterator["Reservation"]:
+        '''Attach `paid_cents' to reservations read from the DB with a single query'''
+        paid_cents = cls.paid_cents_by_uuid(connection)
+        for reservation in reservations:
+            reservation.paid_cents = paid_cents.get(reservation.uuid, 0)
+            yield reservation
+
+    @classmethod
+    def select_for_export(cls, connection: Union[sqlite3.Cursor, sqlite3.Connection], changed_since: Optional[float] = None, batch_size: int = 200) -> Iterator[tuple["Reservation", int]]:
+        '''(reservation, sum of its payments) pairs of export_csv.cgi
+
+        A single statement reading `paid_cents' along with the reservations,
+        `batch_size' rows at a time.  With `changed_since' (seconds since the
+        epoch), only the reservations made or changed since then: `changed_at'
+        is kept by triggers when they are edited, (de)activated or a payment
+        is (un)linked or hidden.'''
+        query = [f"SELECT {','.join(f'{cls.TABLE_NAME}.{col[0]}' for col in cls.COLUMNS)}, {cls.TABLE_NAME}.paid_cents FROM {cls.TABLE_NAME}"]
+        params = {}
+        if changed_since is not None:
+            query.append(f'WHERE {cls.TABLE_NAME}.changed_at >= :since')
+            params['since'] = changed_since
+        query.append(f"ORDER BY {','.join(cls.column_ordering_clause(col, cls.TABLE_NAME) for col in ('ACTIVE', 'date', 'name'))}")
+        cursor = connection.execute(' '.join(query), params)
+        while rows := cursor.fetchmany(batch_size):
+            for row in rows:
+                yield cls.from_row_with_paid_cents(row), row[-1]
+
+    @classmethod
+    def length(cls, connection, filtering=None):
+        if filtering is not None:
+            return super().length(connection, filtering)
+        return connection.execute(
+            f'SELECT COALESCE(SUM(reservations), 0) FROM {RESERVATION_TOTALS_TABLE_NAME}'
+        ).fetchone()[0]
+
+    @classmethod
+    def count_active(cls, connection) -> int:
+        '''Same as `length(connection, [('active', 1)])' without scanning the reservations'''
+        return connection.execute(
+            f'SELECT COALESCE(SUM(active_reservations), 0) FROM {RESERVATION_TOTALS_TABLE_NAME}'
+        ).fetchone()[0]
 
     @classmethod
     def summary_by_date(cls, connection):
         return connection.execute(
-            f"""SELECT date, SUM(paying_seats + free_seats) FROM {cls.TABLE_NAME}
-                WHERE active != 0 GROUP BY date ORDER BY date""")
+            f"""SELECT date, places FROM {RESERVATION_TOTALS_TABLE_NAME}
+                WHERE active_reservations > 0 ORDER BY date""")
+
+    @classmethod
+    def from_row_with_paid_cents(cls, row: list[Any]) -> "Reservation":
+        reservation = cls.from_row(row[:-1])
+        reservation.paid_cents = row[-1]
+        return reservation
 
     @classmethod
     def find_by_bank_id(cls, connection: Union[sqlite3.Cursor, sqlite3.Connection], bank_id: str) -> Union["Reservation", None]:
         row = connection.execute(
-            f"""SELECT {','.join(col[0] for col in cls.COLUMNS)} FROM {cls.TABLE_NAME}
+            f"""SELECT {','.join(col[0] for col in cls.COLUMNS)}, paid_cents FROM {cls.TABLE_NAME}
                 WHERE bank_id = :bank_id""",
             {"bank_id": bank_id}).fetchone()
-        return Reservation.from_row(row) if row else None
+        return cls.from_row_with_paid_cents(row) if row else None
+
+    @classmethod
+    def find_by_bank_ids(cls, connection: Union[sqlite3.Cursor, sqlite3.Connection], bank_ids: Iterable[str]) -> dict[str, "Reservation"]:
+        '''Like `find_by_bank_id' for many bank_ids at once, omitting the bank_ids without reservation'''
+        bank_ids = list(bank_ids)
+        result = {}
+        # Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+        for start in range(0, len(bank_ids), 500):
+            chunk = bank_ids[start:start + 500]
+            for row in connection.execute(
+                    f"""SELECT {','.join(col[0] for col in cls.COLUMNS)} FROM {cls.TABLE_NAME}
+                        WHERE bank_id IN ({",".join("?" * len(chunk))})""",
+                    chunk):
+                reservation = Reservation.from_row(row)
+                result[reservation.bank_id] = reservation
+        return result
 
     @classmethod
     def find_by_uuid(cls, connection: Union[sqlite3.Cursor, sqlite3.Connection], uuid: str) -> Union["Reservation", None]:
         row = connection.execute(
-            f"""SELECT {','.join(col[0] for col in cls.COLUMNS)} FROM {cls.TABLE_NAME}
+            f"""SELECT {','.join(col[0] for col in cls.COLUMNS)}, paid_cents FROM {cls.TABLE_NAME}
                 WHERE uuid = :uuid""",
             {"uuid": uuid}).fetchone()
-        return Reservation.from_row(row) if row else None
+        return cls.from_row_with_paid_cents(row) if row else None
 
     @classmethod
     def list_reservations_for_linking_with_payments(cls, connection, exclude_uuid: str) -> Iterable["Reservation"]:
@@ -332,12 +1100,64 @@ class Payment(MiniOrm):
         ("confirmation_timestamp", "REAL"),
         ("active", "INTEGER"),
     ]
+    __slots__ = tuple(col for col, _ in COLUMNS)
     CREATION_STATEMENTS = [
         default_creation_statement(TABLE_NAME, COLUMNS),
         f"CREATE INDEX index_uuid_{TABLE_NAME} ON {TABLE_NAME} (uuid)",
         f"CREATE INDEX index_src_id_{TABLE_NAME} ON {TABLE_NAME} (src_id)",
         f"CREATE UNIQUE INDEX index_bank_ref_{TABLE_NAME} ON {TABLE_NAME} (bank_ref)",
     ]
+    FULL_TEXT_SEARCH_COLUMNS = ('user', 'comment', 'other_account', 'other_name')
+    MIGRATIONS = {
+        1: CREATION_STATEMENTS,
+        2: full_text_search_migration,
+        # Sort keys of list_payments.cgi (the unique index on src_id serves that
+        # column), replaced by step 9
+        3: [f'CREATE INDEX index_timestamp_{TABLE_NAME} ON {TABLE_NAME} (timestamp) WHERE active != 0',
+            f'CREATE INDEX index_other_account_{TABLE_NAME} ON {TABLE_NAME} (LOWER(other_account)) WHERE active != 0',
+            f'CREATE INDEX index_other_name_{TABLE_NAME} ON {TABLE_NAME} (LOWER(other_name)) WHERE active != 0',
+            f'CREATE INDEX index_status_{TABLE_NAME} ON {TABLE_NAME} (status) WHERE active != 0',
+            f'CREATE INDEX index_comment_{TABLE_NAME} ON {TABLE_NAME} (LOWER(comment)) WHERE active != 0',
+            f'CREATE INDEX index_amount_in_cents_{TABLE_NAME} ON {TABLE_NAME} (amount_in_cents) WHERE active != 0'],
+        4: data_version_statements(TABLE_NAME),
+        # Keep reservations.paid_cents equal to `sum_payments'
+        7: [f"""CREATE TRIGGER {TABLE_NAME}_paid_cents_insert AFTER INSERT ON {TABLE_NAME}
+                WHEN NEW.uuid IS NOT NULL
+                BEGIN
+                    UPDATE reservations SET paid_cents = paid_cents + NEW.amount_in_cents WHERE uuid = NEW.uuid;
+                END""",
+            f"""CREATE TRIGGER {TABLE_NAME}_paid_cents_update AFTER UPDATE OF uuid, amount_in_cents ON {TABLE_NAME}
+                BEGIN
+                    UPDATE reservations SET paid_cents = paid_cents - OLD.amount_in_cents WHERE uuid = OLD.uuid;
+                    UPDATE reservations SET paid_cents = paid_cents + NEW.amount_in_cents WHERE uuid = NEW.uuid;
+                END""",
+            f"""CREATE TRIGGER {TABLE_NAME}_paid_cents_delete AFTER DELETE ON {TABLE_NAME}
+                WHEN OLD.uuid IS NOT NULL
+                BEGIN
+                    UPDATE reservations SET paid_cents = paid_cents - OLD.amount_in_cents WHERE uuid = OLD.uuid;
+                END"""],
+        # The paid_cents triggers already touch `changed_at' of the reservations
+        # when payments are inserted, (un)linked or deleted: not when hidden.
+        8: [f"""CREATE TRIGGER {TABLE_NAME}_changed_at_update AFTER UPDATE ON {TABLE_NAME}
+                WHEN OLD.uuid IS NOT NULL OR NEW.uuid IS NOT NULL
+                BEGIN
+                    UPDATE reservations SET changed_at = {CHANGED_AT_NOW} WHERE uuid IN (OLD.uuid, NEW.uuid);
+                END"""],
+        # list_payments.cgi lists the hidden payments too: the planner cannot
+        # use the partial indexes of step 3 for it
+        9: [f'DROP INDEX index_timestamp_{TABLE_NAME}',
+            f'DROP INDEX index_other_account_{TABLE_NAME}',
+            f'DROP INDEX index_other_name_{TABLE_NAME}',
+            f'DROP INDEX index_status_{TABLE_NAME}',
+            f'DROP INDEX index_comment_{TABLE_NAME}',
+            f'DROP INDEX index_amount_in_cents_{TABLE_NAME}',
+            f'CREATE INDEX index_timestamp_{TABLE_NAME} ON {TABLE_NAME} (timestamp)',
+            f'CREATE INDEX index_other_account_{TABLE_NAME} ON {TABLE_NAME} (LOWER(other_account))',
+            f'CREATE INDEX index_other_name_{TABLE_NAME} ON {TABLE_NAME} (LOWER(other_name))',
+            f'CREATE INDEX index_status_{TABLE_NAME} ON {TABLE_NAME} (status)',
+            f'CREATE INDEX index_comment_{TABLE_NAME} ON {TABLE_NAME} (LOWER(comment))',
+            f'CREATE INDEX index_amount_in_cents_{TABLE_NAME} ON {TABLE_NAME} (amount_in_cents)'],
+    }
     SORTABLE_COLUMNS = {
         'other_name': 'LOWER(other_name)',
         'other_account': 'LOWER(other_account)',
@@ -412,6 +1232,33 @@ class Payment(MiniOrm):
             {"src_id": self.src_id, "rowid": self.rowid})
         return self
 
+    @classmethod
+    def insert_chunk(cls, connection, chunk: list["Payment"]) -> list[tuple[Optional[Exception], "Payment"]]:
+        '''Like `MiniOrm.insert_chunk' but payments whose bank_ref is already
+        in the database get an IntegrityError without attempting the insert
+        (re-imported bank statements are mostly made of those) and the
+        inserted payments get their rowid.'''
+        known = {row[0] for row in connection.execute(
+            f'SELECT bank_ref FROM {cls.TABLE_NAME} WHERE bank_ref IN ({",".join("?" * len(chunk))})',
+            [pmnt.bank_ref for pmnt in chunk])}
+        last_rowid = connection.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM {cls.TABLE_NAME}').fetchone()[0]
+        inserted = iter(super().insert_chunk(connection, [pmnt for pmnt in chunk if pmnt.bank_ref not in known]))
+        # New rows get increasing rowids after the largest one
+        explicit_rowids = {pmnt.rowid for pmnt in chunk if pmnt.rowid is not None}
+        new_rowids = (row[0] for row in connection.execute(
+            f'SELECT rowid FROM {cls.TABLE_NAME} WHERE rowid > :rowid ORDER BY rowid', {'rowid': last_rowid})
+                      if row[0] not in explicit_rowids)
+        outcomes = []
+        for pmnt in chunk:
+            if pmnt.bank_ref in known:
+                outcomes.append((sqlite3.IntegrityError(f'UNIQUE constraint failed: {cls.TABLE_NAME}.bank_ref'), pmnt))
+                continue
+            exc, pmnt = next(inserted)
+            if exc is None and pmnt.rowid is None:
+                pmnt.rowid = next(new_rowids)
+            outcomes.append((exc, pmnt))
+        return outcomes
+
     def update_confirmation_timestamp(self, connection, confirmation_timestamp: Optional[float]) -> "Payment":
         self.confirmation_timestamp = confirmation_timestamp
         connection.execute(
@@ -463,7 +1310,15 @@ class Payment(MiniOrm):
         return self.status == "Accepté" and self.amount_in_cents is not None and self.amount_in_cents > 0
 
     @classmethod
-    def join_reservations(cls, connection, filtering=None, order_columns=None, limit=None, offset=None):
+    def join_reservations(cls, connection, filtering=None, order_columns=None, limit=None, offset=None, after=None, before=None):
+        if after is not None or before is not None:
+            query, params, ordering = cls.join_reservations_keyset_query(filtering, order_columns, limit, after, before)
+            rows = connection.execute(query, params).fetchall()
+            if before is not None:
+                rows.reverse()
+            for row in rows:
+                yield cls.payment_and_reservation_from_row(row[:-len(ordering)])
+            return
         # Duplicate of `select', I know :sad:
         params = dict()
         query = [f'SELECT {",".join(f"pys.{col[0]}" for col in cls.COLUMNS)}, {",".join(f"res.{col[0]}" for col in Reservation.COLUMNS)} FROM {cls.TABLE_NAME} as pys LEFT OUTER JOIN {Reservation.TABLE_NAME} as res ON pys.uuid = res.uuid']
@@ -484,96 +1339,110 @@ class Payment(MiniOrm):
             query.append('OFFSET :offset')
             params['offset'] = offset
         for row in connection.execute(' '.join(query), params):
-            payment, reservation_row = cls.parse_from_row(row)
-            if not payment:
-                raise RuntimeError("Unable to create Payment from DB data")
-            if all(col is None or col == "" for col in reservation_row):
-                reservation = None
-            else:
-                reservation, tail = Reservation.parse_from_row(reservation_row)
-                if not reservation or tail:
-                    indic = f"src_id={payment.src_id!r}" if payment.src_id else f"bank_ref={payment.bank_ref!r}"
-                    raise RuntimeError(f"Unable to create Reservation from DB data joined to Payment({indic})")
-            yield payment, reservation
+            yield cls.payment_and_reservation_from_row(row)
 
+    @classmethod
+    def join_reservations_page(cls, connection, filtering=None, order_columns=None, limit=20, after=None, before=None, offset=None) -> Page:
+        '''Like `select_page' but the items are (payment, reservation) pairs'''
+        query, params, ordering = cls.join_reservations_keyset_query(filtering, order_columns, limit + 1, after, before, offset)
+        return cls.make_page(connection.execute(query, params).fetchall(),
+                             len(ordering), limit, after, before, offset, cls.payment_and_reservation_from_row)
 
-class Csrf(MiniOrm):
-    TABLE_NAME = 'csrfs'
+    @classmethod
+    def join_reservations_keyset_query(cls, filtering, order_columns, limit, after, before, offset=None) -> tuple[str, dict[str, Any], list[tuple[str, bool]]]:
+        # Seek and limit the payments before joining so that the sort
+        # expressions can't clash with the reservations' column names.
+        payments_query, params, ordering = cls.keyset_query(filtering, order_columns, limit, after, before, offset)
+        backwards = before is not None
+        sort_keys = [f'pys.sort_key_{idx}' for idx in range(len(ordering))]
+        return (f'SELECT {",".join(f"pys.{col[0]}" for col in cls.COLUMNS)}, {",".join(f"res.{col[0]}" for col in Reservation.COLUMNS)}, {",".join(sort_keys)} '
+                f'FROM ({payments_query}) AS pys LEFT OUTER JOIN {Reservation.TABLE_NAME} AS res ON pys.uuid = res.uuid '
+                'ORDER BY ' + ','.join(f'{sort_key} {"DESC" if descending != backwards else "ASC"}'
+                                      for sort_key, (_, descending) in zip(sort_keys, ordering)),
+                params,
+                ordering)
+
+    @classmethod
+    def payment_and_reservation_from_row(cls, row) -> tuple["Payment", Optional["Reservation"]]:
+        payment, reservation_row = cls.parse_from_row(row)
+        if not payment:
+            raise RuntimeError("Unable to create Payment from DB data")
+        if all(col is None or col == "" for col in reservation_row):
+            reservation = None
+        else:
+            reservation, tail = Reservation.parse_from_row(reservation_row)
+            if not reservation or tail:
+                indic = f"src_id={payment.src_id!r}" if payment.src_id else f"bank_ref={payment.bank_ref!r}"
+                raise RuntimeError(f"Unable to create Reservation from DB data joined to Payment({indic})")
+        return payment, reservation
+
+
+class Csrf:
+    '''Token protecting the admin forms against cross-site request forgery
+
+    The token is the expiry (8 hexadecimal digits) followed by an HMAC of the
+    user, the IP address and the expiry: it is checked without any database
+    access.  The key is `csrf_secret' from the configuration or, when that is
+    empty, a random key generated once next to the database.
+
+    Tokens are issued per window of SESSION_IN_SECONDS, so that the pages
+    keep their token (and their ETag) during a window, and expire at the end
+    of the following window.'''
     SESSION_IN_SECONDS = 7200
-    COLUMNS = [
-        ("token", "TEXT NOT NULL PRIMARY KEY"),
-        ("timestamp", "REAL"),
-        ("user", "TEXT NOT NULL"),
-        ("ip", "TEXT NOT NULL"),
-    ]
-    CREATION_STATEMENTS = [default_creation_statement(TABLE_NAME, COLUMNS)]
+    SECRET_FILE_NAME = 'csrf_secret'
+    # The tokens used to be stored in this table
+    TABLE_NAME = 'csrfs'
+    MIGRATIONS = {5: [f'DROP TABLE IF EXISTS {TABLE_NAME}']}
+    __slots__ = ('token', 'expiry', 'user', 'ip')
     token: str
-    timestamp: float
+    expiry: int
     user: str
     ip: str
 
-    def __init__(self, token=None, timestamp=None, user=None, ip=None):
-        self.token = token or uuid.uuid4().hex
-        self.timestamp = timestamp or time.time()
-        self.user = user or os.getenv('REMOTE_USER')
-        self.ip = ip or os.getenv('REMOTE_ADDR')
-
+    def __init__(self, user: str, ip: str, expiry: int, secret: bytes):
+        self.user = user
+        self.ip = ip
+        self.expiry = expiry
+        self.token = f'{expiry:08x}{self.signature(secret, user, ip, expiry)}'
 
-    @classmethod
-    def gc(cls, connection) -> None:
-        connection.execute(
-            f'DELETE FROM {cls.TABLE_NAME} WHERE timestamp <= :timestamp',
-            {'timestamp': time.time() - 3 * cls.SESSION_IN_SECONDS})
 
-    def save(self, connection) -> None:
-        with connection:
-            connection.execute(
-                f'INSERT OR REPLACE INTO {self.TABLE_NAME} VALUES '
-                '(:token, :timestamp, :user, :ip)',
-                {'token': self.token,
-                 'timestamp': time.time(),
-                 'user': self.user,
-                 'ip': self.ip})
-            self.gc(connection)
+    @staticmethod
+    def signature(secret: bytes, user: str, ip: str, expiry: int) -> str:
+        return hmac.new(secret, f'{user}\0{ip}\0{expiry}'.encode('utf-8'), hashlib.sha256).hexdigest()
 
 
     @classmethod
-    def new(cls, connection) -> "Csrf":
-        result = cls()
-        result.save(connection)
-        return result
+    def secret(cls, connection) -> bytes:
+        configured = config.get_configuration().get('csrf_secret')
+        if configured:
+            return str(configured).encode('utf-8')
+        # `file' is empty for in-memory databases
+        db_path = next(file for _, name, file in connection.execute('PRAGMA database_list') if name == 'main')
+        try:
+            return _CSRF_SECRETS[db_path]
+        except KeyError:
+            pass
+        if db_path:
+            secret = _read_or_create_secret(os.path.join(os.path.dirname(db_path), cls.SECRET_FILE_NAME))
+        else:
+            secret = os.urandom(32)
+        _CSRF_SECRETS[db_path] = secret
+        return secret
 
 
     @classmethod
     def validate_and_update(cls, connection, token: str, user: str, ip: str) -> "Csrf":
         try:
-            data = connection.execute(
-                f'SELECT * from {cls.TABLE_NAME} '
-                'WHERE token = :token AND user = :user AND ip = :ip AND timestamp > :timestamp',
-                {'token': token,
-                 'user': user,
-                 'ip': ip,
-                 'timestamp': time.time() - cls.SESSION_IN_SECONDS}
-            ).fetchone()
-            result = cls(token=data[0], timestamp=time.time(), user=data[2], ip=data[3])
-            result.save(connection)
-            return result
-        except Exception:
+            expiry = int(token[:8], 16)
+        except (TypeError, ValueError):
+            raise KeyError(token)
+        secret = cls.secret(connection)
+        if expiry <= time.time() or not hmac.compare_digest(token[8:].encode('utf-8'), cls.signature(secret, user, ip, expiry).encode('ascii')):
             raise KeyError(token)
+        return cls.get_by_user_and_ip(connection, user, ip)
+
 
     @classmethod
     def get_by_user_and_ip(cls, connection, user: str, ip: str) -> "Csrf":
-        try:
-            data = connection.execute(
-                f'SELECT * from {cls.TABLE_NAME} '
-                'WHERE user = :user AND ip = :ip '
-                'ORDER BY timestamp DESC '
-                'LIMIT 1',
-                {'user': user,
-                 'ip': ip}
-            ).fetchone()
-            result = cls(token=data[0], timestamp=data[1], user=data[2], ip=data[3])
-        except Exception:
-            result = cls(user=user, ip=ip)
-        result.save(connection)
-        return result
+        window = int(time.time()) // cls.SESSION_IN_SECONDS
+        return cls(user, ip, (window + 2) * cls.SESSION_IN_SECONDS, cls.secret(connection))
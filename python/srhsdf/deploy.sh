@@ -49,7 +49,7 @@ else
     (cd "$(dirname "$0")/app/gestion" \
          && emacs --batch \
                   --eval "(progn (find-file \"index.org\") (org-html-export-to-html))")
-    tar cf - --exclude "#*" --exclude "*~" --exclude "*.bak" --exclude "*cache*" --exclude "index.org" --exclude ".dir-locals.el" --exclude "db.db" $excludes \
+    tar cf - --exclude "#*" --exclude "*~" --exclude "*.bak" --exclude "*cache*" --exclude "index.org" --exclude ".dir-locals.el" --exclude "csrf_secret" --exclude "db.db" $excludes \
         -C "$(dirname "$0")/app" \
         . \
         | tar xf - -C "$staging_dir"
@@ -57,10 +57,16 @@ else
     find "$staging_dir" -type f '(' -name '*.cgi' -o -name '*.py' ')' -print0 | xargs -0 dos2unix
     if [ "$virtualenv_folder" = "no" ] ; then
         setup_venv=""
+        cgi_python="$(sed -n -e '1s,^#!,,p' "$(dirname "$0")/app/post_reservation.cgi")"
     else
         find "$staging_dir" -type f -name '*.cgi' -print0 | xargs -0 -n 1 sed -i -e '1s,.*,#!'"${virtualenv_folder%/}"'/bin/python3,'
         setup_venv="; python -m venv '${virtualenv_folder%/}'; '${virtualenv_folder%/}/bin/pip' install qrcode"
+        cgi_python="${virtualenv_folder%/}/bin/python3"
     fi
+    # Bytecode of the libraries, so that no request pays for compiling them.
+    # It is compiled on the host: it must match the interpreter of the CGI
+    # scripts.
+    compile_bytecode="; '$cgi_python' -m compileall -q '$folder'"
     find "$staging_dir" -type f -name '*.cgi' -print0 | xargs -0 chmod 744
     app_htaccess="$staging_dir/.htaccess"
     cat <<EOF > "$app_htaccess"
@@ -73,9 +79,17 @@ Options -Indexes
 <filesMatch ".js\$">
     Header set Cache-Control "max-age=86400, public"
 </filesMatch>
+# Key signing the CSRF tokens when dbdir is the application folder:
+<Files "csrf_secret">
+    Deny from all
+</Files>
+# Bytecode compiled on deployment:
+<filesMatch ".pyc\$">
+    Deny from all
+</filesMatch>
 EOF
     dos2unix "$app_htaccess"
     tar czf - --"owner=$user" --"group=$group" -C "$staging_dir" . \
-        | ssh "$destination" "mkdir -p '$folder'; rm -f '$folder'/*.js; tar xvzf - -C '$folder' $setup_password $setup_access $setup_venv"
+        | ssh "$destination" "mkdir -p '$folder'; rm -f '$folder'/*.js; tar xvzf - -C '$folder' $setup_password $setup_access $setup_venv $compile_bytecode"
     rm -r "$staging_dir" || echo "Unable to clean up staging_dir='$staging_dir'"
 fi
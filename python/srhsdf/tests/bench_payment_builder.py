@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''Compare `lib_payments.make_payment_builder' with the builder it replaced
+
+Decodes a synthetic bank statement with both builders, checks that they
+build the same payments and prints their throughput:
+
+    TZ=Europe/Brussels python3 bench_payment_builder.py [rows]
+'''
+import random
+import sys
+import time
+from typing import Optional
+
+import sys_path_hack
+
+with sys_path_hack.app_in_path():
+    import lib_payments
+    from storage import Payment
+
+
+HEADER = ['Nº de séquence', "Date d'exécution", 'Date valeur', 'Montant', 'Devise du compte', 'Numéro de compte',
+          'Type de transaction', 'Contrepartie', 'Nom de la contrepartie', 'Communication', 'Détails', 'Statut',
+          'Motif du refus']
+
+
+def legacy_make_payment_builder(header_row: list[str]):
+    col_name_to_idx = {lib_payments._normalize_header(col_name): col_idx for col_idx, col_name in enumerate(header_row)}
+    columns = {attr_name: col_name_to_idx[col_name]
+               for col_name, attr_name in lib_payments.BANK_STATEMENT_HEADERS['fr'].items()}
+
+    def payment_builder(row: list[str], proto: Optional[Payment]=None) -> Payment:
+        amount_in_cents = round(float(row[columns["amount_in_cents"]].replace(",", ".")) * 100)
+        return Payment(
+            None,
+            timestamp=time.mktime(time.strptime(f"{row[columns['timestamp']]}T12:00+01:00", "%d/%m/%YT%H:%M%z")),
+            amount_in_cents=amount_in_cents,
+            comment=row[columns['comment']],
+            uuid=None,
+            src_id=row[columns['src_id']],
+            bank_ref=lib_payments.extract_bank_ref(row[columns['details']]),
+            other_account=row[columns['other_account']],
+            other_name=row[columns['other_name']],
+            status=row[columns['status']],
+            user=None if proto is None else proto.user,
+            ip=None if proto is None else proto.ip,
+            confirmation_timestamp=None if proto is None else proto.confirmation_timestamp,
+            active=True if proto is None else proto.active,
+        )
+
+    return payment_builder
+
+
+def synthetic_statement(rows: int, dates: int=40, seed: int=0) -> list[list[str]]:
+    rnd = random.Random(seed)
+    first_day = time.mktime((2023, 1, 2, 12, 0, 0, 0, 0, -1))
+    days = [time.strftime('%d/%m/%Y', time.localtime(first_day + 86400 * day)) for day in range(dates)]
+    statement = []
+    for idx in range(rows):
+        cents = rnd.randint(-50000, 50000)
+        amount = f"{'-' if cents < 0 else ''}{abs(cents) // 100}"
+        if cents % 100:
+            amount += f"{rnd.choice('.,')}{abs(cents) % 100:02}"
+        day = rnd.choice(days)
+        statement.append([f'2023-{idx:06}', day, day, amount, 'EUR', 'BE00010001000101', 'Virement en euros',
+                          f'BE{idx:014}', f'Name {idx}', f'Communication {idx}', f'DETAILS {idx} REFERENCE BANQUE : {idx:011} DATE VALEUR : {day}', 'Accepté', ''])
+    return statement
+
+
+def rows_per_second(builder, statement: list[list[str]], proto: Payment) -> tuple[float, list[Payment]]:
+    start = time.perf_counter()
+    payments = [builder(row, proto) for row in statement]
+    return len(statement) / (time.perf_counter() - start), payments
+
+
+def main(rows: int=100_000) -> int:
+    statement = synthetic_statement(rows)
+    proto = Payment(None, None, 0, None, None, None, '', None, None, None, 'bench', '127.0.0.1', None, True)
+    before, expected = rows_per_second(legacy_make_payment_builder(HEADER), statement, proto)
+    after, actual = rows_per_second(lib_payments.make_payment_builder(HEADER), statement, proto)
+    mismatches = sum(old.to_dict() != new.to_dict() for old, new in zip(expected, actual))
+    print(f'{rows} rows: before {before:,.0f} rows/s, after {after:,.0f} rows/s ({after / before:.1f}x), '
+          f'{mismatches} mismatches')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*map(int, sys.argv[1:])))
+
+# Local Variables:
+# compile-command: "TZ=Europe/Brussels python3 bench_payment_builder.py"
+# End:
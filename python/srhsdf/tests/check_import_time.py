@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''Check the import time of every CGI entry point against its budget
+
+Each script runs under `python3 -X importtime' without a CGI environment,
+i.e. on the path that redirects or refuses the request before doing any
+work.  Its import time is the cumulative time of the modules it imports on
+top of those of a bare interpreter, the best of a few runs.  Exits with an
+error when an entry point goes over its budget or imports one of the modules
+that only some code paths need:
+
+    python3 check_import_time.py [--repeat N] [--scale FACTOR]
+
+Use `--scale' on a machine slower than the one the budgets were set on.
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from typing import NamedTuple
+
+APP_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app')
+
+# Milliseconds, with some headroom over the measurements of the commit that
+# introduced them.
+BUDGETS_MS = {
+    'post_reservation.cgi': 70,
+    'show_reservation.cgi': 70,
+    'gestion/add_unchecked_reservation.cgi': 75,
+    'gestion/confirm_payment.cgi': 75,
+    'gestion/export_csv.cgi': 75,
+    'gestion/hide_payment.cgi': 75,
+    'gestion/import_payments.cgi': 75,
+    'gestion/link_payment_and_reservation.cgi': 75,
+    'gestion/list_payments.cgi': 75,
+    'gestion/list_reservations.cgi': 75,
+}
+
+# `cgi.test()' is all there is to it
+NOT_ENTRY_POINTS = {'gestion/test.cgi'}
+
+# Imported by the code paths that need them, never before the request is
+# known to be valid.
+LAZY_MODULES = frozenset((
+    'cgi', 'cgitb', 'csv', 'email.utils', 'qrcode', 'tempfile', 'uuid'))
+
+
+class ImportTime(NamedTuple):
+    microseconds: int
+    modules: frozenset
+
+
+def entry_points() -> list[str]:
+    scripts = []
+    for folder in ('', 'gestion'):
+        for name in sorted(os.listdir(os.path.join(APP_DIR, folder))):
+            script = f'{folder}/{name}' if folder else name
+            if name.endswith('.cgi') and script not in NOT_ENTRY_POINTS:
+                scripts.append(script)
+    return scripts
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, bool]]:
+    '''(module, cumulative microseconds, imported at top level) of `-X importtime' '''
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue  # header
+        # Nested imports are indented below the module importing them
+        imports.append((name.strip(), int(cumulative), not name[1:].startswith(' ')))
+    return imports
+
+
+def run_with_importtime(argv: list[str], cwd: str, temp_dir: str) -> list[tuple[str, int, bool]]:
+    environ = {'PATH': os.getenv('PATH', ''), 'TEMP': temp_dir, 'CONFIGURATION_JSON_DIR': temp_dir}
+    result = subprocess.run([sys.executable, '-X', 'importtime', *argv], cwd=cwd, env=environ,
+                            stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    return parse_importtime(result.stderr)
+
+
+def measure(script: str, repeat: int = 5) -> ImportTime:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        baseline = {name for name, _, _ in run_with_importtime(['-c', 'pass'], APP_DIR, temp_dir)}
+        path = os.path.join(APP_DIR, script)
+        # The first run may have to write the bytecode of the application
+        runs = [run_with_importtime([os.path.basename(path)], os.path.dirname(path), temp_dir)
+                for _ in range(repeat + 1)][1:]
+    modules = frozenset(name for run in runs for name, _, _ in run)
+    best = min(sum(t for name, t, top_level in run if top_level and name not in baseline)
+               for run in runs)
+    return ImportTime(best, modules)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Check the import time of the CGI entry points')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per entry point, the best one counts')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the budgets by FACTOR')
+    args = parser.parse_args(argv)
+    failures = 0
+    for script in entry_points():
+        budget_ms = BUDGETS_MS.get(script)
+        result = measure(script, args.repeat)
+        eager = sorted(LAZY_MODULES.intersection(result.modules))
+        verdict = 'ok'
+        if budget_ms is None:
+            verdict = 'NO BUDGET'
+        elif result.microseconds > budget_ms * args.scale * 1000:
+            verdict = 'OVER BUDGET'
+        elif eager:
+            verdict = f'IMPORTS {", ".join(eager)}'
+        failures += verdict != 'ok'
+        print(f'{script:45} {result.microseconds / 1000:7.1f}ms / {budget_ms or 0:4}ms {verdict}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# Local Variables:
+# compile-command: "python3 check_import_time.py"
+# End:
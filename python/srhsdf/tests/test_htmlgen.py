@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
+import csv
+import io
+import os
+import itertools
+import sys
+import tempfile
 import time
+import zlib
 import unittest
 from unittest.mock import patch
 
@@ -50,6 +57,289 @@ class CentsToEuro(unittest.TestCase):
                 self.assertEqual(htmlgen.cents_to_euro(cents), expected)
 
 
+class Render(unittest.TestCase):
+    def test_escaping(self):
+        self.assertEqual(htmlgen.render((('a', 'href', 'x?a=1&b="2"'), '<b> & c')),
+                         '<a href="x?a=1&amp;b=&quot;2&quot;">&lt;b&gt; &amp; c</a>')
+
+    def test_raw(self):
+        self.assertEqual(htmlgen.render(('p', ('raw', '<b>&nbsp;</b>'), 1, None)), '<p><b>&nbsp;</b>1None</p>')
+
+    def test_empty_elements(self):
+        self.assertEqual(htmlgen.render(('p', ('br',), (('input', 'type', 'text'),), ('BR',), ('span',))),
+                         '<p><br><input type="text"><BR><span></span></p>')
+
+    def test_repeated_siblings(self):
+        order = ((('div', 'class', 'left'), 'table n°'), ('div', (('img', 'src', 'a&b.png'),)))
+        self.assertEqual(htmlgen.render(('div', *itertools.chain(*itertools.repeat(order, 3)), order[1], 'x', 'x')),
+                         '<div>'
+                         + '<div class="left">table n°</div><div><img src="a&amp;b.png"></div>' * 3
+                         + '<div><img src="a&amp;b.png"></div>xx</div>')
+
+    def test_html_gen(self):
+        tree = ('ul', ('li', 'a'), ('li', 'b'))
+        self.assertEqual(''.join(htmlgen.html_gen(tree)), htmlgen.render(tree))
+
+    def test_html_document(self):
+        document = ''.join(htmlgen.html_document('<Title>', (('p', 'first'), ('p', 'second'))))
+        self.assertTrue(document.startswith('<!DOCTYPE HTML><html lang="fr"><head>'))
+        self.assertIn('<title>&lt;Title&gt;</title>', document)
+        self.assertIn('<p>first</p><p>second</p>', document)
+        self.assertTrue(document.endswith('</body></html>'))
+        self.assertEqual(''.join(htmlgen.html_document('<Title>', iter((('p', 'first'), ('p', 'second'))))), document)
+
+
+class ResponseTest(unittest.TestCase):
+    @staticmethod
+    def make_output():
+        return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+
+    def test_content_length_counts_bytes(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/csv; charset=utf-8', file=output, compression_level=0)
+            response.write('Prénom,')
+            response.write_all(('Dû', '\r\n'))
+            response.finish()
+        self.assertEqual(output.buffer.getvalue(),
+                         'Content-Type: text/csv; charset=utf-8\nContent-Length: 13\n\nPrénom,Dû\r\n'.encode('utf-8'))
+
+    def test_streaming_has_no_content_length(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/plain', file=output, streaming=True, chunk_size=4, compression_level=0)
+            response.write_all(('ab', 'cd', 'e'))
+            self.assertEqual(output.buffer.getvalue(), b'Content-Type: text/plain\n\nabcd')
+            response.finish()
+        self.assertEqual(output.buffer.getvalue(), b'Content-Type: text/plain\n\nabcde')
+
+    def test_no_headers_after_print_content_type(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', True):
+            htmlgen.respond_html(htmlgen.html_gen(('p', 'é')), file=output)
+        self.assertEqual(output.buffer.getvalue(), '<p>é</p>'.encode('utf-8'))
+
+
+    def test_gzip_when_accepted(self):
+        output = self.make_output()
+        body = 'Prénom,Nom\r\n' * 200
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/csv; charset=utf-8', file=output,
+                                        accept_encoding='deflate;q=0.5, gzip', compression_level=9)
+            response.write(body)
+            response.finish()
+        head, _, compressed = output.buffer.getvalue().partition(b'\n\n')
+        self.assertEqual(head.decode('latin1').splitlines(), [
+            'Content-Type: text/csv; charset=utf-8',
+            'Vary: Accept-Encoding',
+            'Content-Encoding: gzip',
+            f'Content-Length: {len(compressed)}'])
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS).decode('utf-8'), body)
+
+    def test_small_body_is_not_compressed(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/plain', file=output, accept_encoding='gzip', compression_level=6)
+            response.write('short')
+            response.finish()
+        self.assertEqual(output.buffer.getvalue(),
+                         b'Content-Type: text/plain\nVary: Accept-Encoding\nContent-Length: 5\n\nshort')
+
+    def test_streaming_deflate(self):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/plain', file=output, streaming=True, chunk_size=3,
+                                        accept_encoding='deflate', compression_level=6)
+            response.write_all(('abc', 'def', 'g'))
+            head, _, compressed = output.buffer.getvalue().partition(b'\n\n')
+            self.assertEqual(head, b'Content-Type: text/plain\nVary: Accept-Encoding\nContent-Encoding: deflate')
+            # Every chunk sent so far can be decoded already
+            self.assertEqual(zlib.decompressobj().decompress(compressed), b'abcdef')
+            response.finish()
+        self.assertEqual(zlib.decompress(output.buffer.getvalue().partition(b'\n\n')[2]), b'abcdefg')
+
+    def test_secret_is_not_compressed(self):
+        output = self.make_output()
+        body = '<input type="hidden" name="csrf_token" value="0123abcd">' * 100
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/html', file=output, accept_encoding='gzip', compression_level=6,
+                                        contains_secret=True)
+            response.write(body)
+            response.finish()
+        self.assertEqual(output.buffer.getvalue(),
+                         f'Content-Type: text/html\nContent-Length: {len(body)}\n\n{body}'.encode('utf-8'))
+
+    def test_compression_level_is_read_once(self):
+        with patch.object(htmlgen, '_COMPRESSION_LEVEL', None), \
+             patch.object(htmlgen.config, 'get_configuration', return_value={'compression_level': 3}) as get_configuration:
+            for _ in range(3):
+                self.assertEqual(htmlgen.Response('text/plain', file=self.make_output()).compression_level, 3)
+            htmlgen.forget_compression_level()
+            self.assertEqual(htmlgen.Response('text/plain', file=self.make_output()).compression_level, 3)
+        self.assertEqual(get_configuration.call_count, 2)
+
+    def test_negotiate_content_encoding(self):
+        for accept_encoding, expected in (
+                ('', None),
+                ('gzip, deflate, br', 'gzip'),
+                ('deflate, gzip;q=0.5', 'deflate'),
+                ('x-gzip', 'gzip'),
+                ('*', 'gzip'),
+                ('*;q=0.3, gzip;q=0', 'deflate'),
+                ('br, *;q=0', None),
+                ('identity', None),
+                ('gzip;q=bogus', None)):
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(htmlgen.negotiate_content_encoding(accept_encoding), expected)
+
+
+class ResponseAbort(unittest.TestCase):
+    @staticmethod
+    def make_output():
+        return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+
+    @staticmethod
+    def rows():
+        for idx in range(10):
+            if idx == 5:
+                raise KeyError('the culprit')
+            yield (f'Prénom {idx}', idx)
+
+    def export_csv(self, logdir, trailer=None, **kwargs):
+        output = self.make_output()
+        with patch.object(htmlgen, '_html_gen_printed_header', False):
+            response = htmlgen.Response('text/csv; charset=utf-8', file=output, streaming=True, **kwargs)
+            writer = csv.writer(response, 'excel')
+            try:
+                for row in self.rows():
+                    writer.writerow(row)
+                response.finish()
+            except Exception:
+                aborted = response.abort(logdir, trailer)
+        return aborted, output.buffer.getvalue()
+
+    def test_error_before_headers_were_sent(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(logdir, compression_level=0)
+            self.assertEqual(os.listdir(logdir), [])
+        self.assertFalse(aborted)
+        self.assertEqual(output, b'')
+
+    def test_error_in_the_middle_of_the_rows(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(logdir, chunk_size=20, compression_level=0)
+            (log_file,) = os.listdir(logdir)
+            with open(os.path.join(logdir, log_file)) as f:
+                self.assertIn('the culprit', f.read())
+        self.assertTrue(aborted)
+        head, _, body = output.partition(b'\n\n')
+        self.assertEqual(head, b'Content-Type: text/csv; charset=utf-8')
+        self.assertTrue(body.startswith('Prénom 0,0\r\n'.encode('utf-8')))
+        self.assertNotIn(b'<', body)
+        self.assertNotIn('Prénom 5'.encode('utf-8'), body)
+
+    def test_error_in_the_middle_of_compressed_rows(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(
+                logdir, chunk_size=20, accept_encoding='deflate', compression_level=6)
+            self.assertEqual(len(os.listdir(logdir)), 1)
+        self.assertTrue(aborted)
+        compressed = output.partition(b'\n\n')[2]
+        # The rows sent are still readable, nothing follows them
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(compressed)
+        self.assertTrue(body.startswith('Prénom 0,0\r\n'.encode('utf-8')))
+        self.assertEqual(decompressor.unused_data, b'')
+        self.assertFalse(decompressor.eof)
+
+    def test_error_with_a_trailer(self):
+        trailer = '"ERREUR: export incomplet"\r\n'
+        with tempfile.TemporaryDirectory() as logdir:
+            aborted, output = self.export_csv(
+                logdir, trailer, chunk_size=20, accept_encoding='deflate', compression_level=6)
+            self.assertEqual(len(os.listdir(logdir)), 1)
+        self.assertTrue(aborted)
+        compressed = output.partition(b'\n\n')[2]
+        # A complete stream whose last row tells the reader about the error
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(compressed)
+        self.assertTrue(decompressor.eof)
+        self.assertTrue(body.startswith('Prénom 0,0\r\n'.encode('utf-8')))
+        self.assertTrue(body.endswith(b'\r\n' + trailer.encode('utf-8')))
+        self.assertNotIn('Prénom 5'.encode('utf-8'), body)
+
+
+class ConditionalGet(unittest.TestCase):
+    @staticmethod
+    def make_output():
+        return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', newline='\n')
+
+    def conditional_get(self, version, last_modified, **environ):
+        output = self.make_output()
+        with patch.dict(os.environ, environ), \
+             patch.object(htmlgen, '_html_gen_printed_header', False), \
+             patch.object(htmlgen, 'configured_compression_level', return_value=0):
+            for name in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE'):
+                if name not in environ:
+                    os.environ.pop(name, None)
+            validators = htmlgen.conditional_get(version, last_modified, and_exit=False, file=output)
+        return validators, output.buffer.getvalue()
+
+    def test_first_request_gets_validators(self):
+        validators, output = self.conditional_get(('page', 1), 1_700_000_000)
+        self.assertEqual(output, b'')
+        headers = dict(validators)
+        self.assertEqual(headers['Cache-Control'], 'no-cache')
+        self.assertRegex(headers['ETag'], r'^W/"[0-9a-f]+"$')
+        self.assertIn('GMT', headers['Last-Modified'])
+
+    def test_matching_etag_gets_304(self):
+        etag = dict(self.conditional_get(('page', 1), 0)[0])['ETag']
+        for if_none_match in (etag, etag.removeprefix('W/'), f'"other", {etag}', '*'):
+            with self.subTest(if_none_match=if_none_match):
+                validators, output = self.conditional_get(('page', 1), 0, HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertIs(validators, None)
+                self.assertTrue(output.startswith(b'Status: 304\n'))
+                self.assertIn(f'ETag: {etag}\n'.encode('ascii'), output)
+                self.assertNotIn(b'Content-Length', output)
+                self.assertTrue(output.endswith(b'\n\n'))
+
+    def test_other_version_gets_validators(self):
+        etag = dict(self.conditional_get(('page', 1), 0)[0])['ETag']
+        validators, output = self.conditional_get(('page', 2), 0, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(output, b'')
+        self.assertNotEqual(dict(validators)['ETag'], etag)
+
+    def test_if_modified_since(self):
+        last_modified = dict(self.conditional_get(('page', 1), 0)[0])['Last-Modified']
+        self.assertIs(self.conditional_get(('page', 1), 0, HTTP_IF_MODIFIED_SINCE=last_modified)[0], None)
+        later = int(time.time()) + 3600
+        self.assertIsNotNone(self.conditional_get(('page', 1), later, HTTP_IF_MODIFIED_SINCE=last_modified)[0])
+        self.assertIsNotNone(self.conditional_get(('page', 1), 0, HTTP_IF_MODIFIED_SINCE='garbage')[0])
+        # If-None-Match has precedence
+        self.assertIsNotNone(self.conditional_get(
+            ('page', 1), 0, HTTP_IF_MODIFIED_SINCE=last_modified, HTTP_IF_NONE_MATCH='"other"')[0])
+
+    def test_http_date(self):
+        import email.utils
+        for seconds in (0, 951_782_400, 1_700_000_000, 4_102_444_799):
+            with self.subTest(seconds=seconds):
+                self.assertEqual(htmlgen.http_date(seconds), email.utils.formatdate(seconds, usegmt=True))
+
+
+class EnableCgitb(unittest.TestCase):
+    def test_exception_is_displayed(self):
+        output = io.StringIO()
+        with patch('sys.excepthook'), patch('sys.stdout', output):
+            htmlgen.enable_cgitb(display=1, logdir=None)
+            try:
+                raise KeyError('the culprit')
+            except KeyError:
+                sys.excepthook(*sys.exc_info())
+        self.assertIn('KeyError', output.getvalue())
+        self.assertIn('the culprit', output.getvalue())
+
+
 # Local Variables:
 # compile-command: "python3 test_htmlgen.py"
 # End:
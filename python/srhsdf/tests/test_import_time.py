@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+import check_import_time
+
+
+class ParseImporttime(unittest.TestCase):
+    def test_nesting(self):
+        stderr = ('import time: self [us] | cumulative | imported package\n'
+                  'import time:       100 |        100 |   _sqlite3\n'
+                  'import time:       200 |        300 | sqlite3\n'
+                  'DeprecationWarning: not an import\n'
+                  'import time:        50 |         50 | config\n')
+        self.assertEqual(check_import_time.parse_importtime(stderr),
+                         [('_sqlite3', 100, False), ('sqlite3', 300, True), ('config', 50, True)])
+
+
+class EntryPoints(unittest.TestCase):
+    def test_every_entry_point_has_a_budget(self):
+        self.assertEqual(set(check_import_time.entry_points()), set(check_import_time.BUDGETS_MS))
+
+    def test_lazy_modules_wait_for_a_valid_request(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for script in check_import_time.entry_points():
+                with self.subTest(script=script):
+                    path = os.path.join(check_import_time.APP_DIR, script)
+                    imports = check_import_time.run_with_importtime(
+                        [os.path.basename(path)], os.path.dirname(path), temp_dir)
+                    self.assertIn('storage', {name for name, _, _ in imports})
+                    self.assertEqual(check_import_time.LAZY_MODULES.intersection(name for name, _, _ in imports),
+                                     set())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "python3 test_import_time.py"
+# End:
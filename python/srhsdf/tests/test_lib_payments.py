@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import io
 import time
 import unittest
 from unittest.mock import patch
@@ -6,11 +7,13 @@ from unittest.mock import patch
 import conftest
 
 try:
+    import app.htmlgen as htmlgen
     import app.lib_payments as lib_payments
     import app.storage as storage
 except ImportError:
     import sys_path_hack
     with sys_path_hack.app_in_path():
+        import htmlgen
         import lib_payments
         import storage
 
@@ -126,6 +129,65 @@ class MakePaymentBuilder(unittest.TestCase):
                                  'ip': None})
 
 
+class AmountToCents(unittest.TestCase):
+    def test_examples(self):
+        for amount, expected in (('18', 1800), ('-50.34', -5034), ('-50,34', -5034), ('0,5', 50), ('.5', 50),
+                                 ('+0.29', 29), (' 1.10 ', 110), ('1e2', 10000), ('-1.005', -100)):
+            with self.subTest(amount=amount):
+                self.assertEqual(lib_payments.amount_to_cents(amount), expected)
+
+    def test_invalid(self):
+        for amount in ('', '-', 'EUR', '1,2,3'):
+            with self.subTest(amount=amount), self.assertRaises(ValueError):
+                lib_payments.amount_to_cents(amount)
+
+
+class IterMultipartForm(unittest.TestCase):
+    BODY = (b'preamble\r\n'
+            b'--b0undary\r\n'
+            b'Content-Disposition: form-data; name="csrf_token"\r\n'
+            b'\r\n'
+            b'c0ffee\r\n'
+            b'--b0undary\r\n'
+            b'Content-Disposition: form-data; name="skipped"\r\n'
+            b'\r\n'
+            b'one\r\ntwo\r\n'
+            b'--b0undary\r\n'
+            b'Content-Disposition: form-data; name="csv_file"; filename="x.csv"\r\n'
+            b'Content-Type: text/csv\r\n'
+            b'\r\n'
+            b'a;b\r\nc;d\n\r\n'
+            b'--b0undary--\r\n'
+            b'epilogue')
+
+    def parts(self, body, content_length=None, consume=lambda name: True):
+        return [(name, list(lines) if consume(name) else None)
+                for name, lines in lib_payments.iter_multipart_form(
+                        io.BytesIO(body), 'multipart/form-data; boundary="b0undary"', content_length)]
+
+    def test_parts(self):
+        self.assertEqual(self.parts(self.BODY),
+                         [('csrf_token', [b'c0ffee']), ('skipped', [b'one\r\n', b'two']), ('csv_file', [b'a;b\r\n', b'c;d\n'])])
+
+    def test_unconsumed_parts_are_skipped(self):
+        self.assertEqual(self.parts(self.BODY, consume=lambda name: name != 'skipped'),
+                         [('csrf_token', [b'c0ffee']), ('skipped', None), ('csv_file', [b'a;b\r\n', b'c;d\n'])])
+
+    def test_content_length(self):
+        truncated = self.BODY.index(b'c;d')
+        self.assertEqual(self.parts(self.BODY + b'--b0undary\r\n', truncated)[-1], ('csv_file', [b'a;b\r\n']))
+
+    def test_not_multipart(self):
+        with self.assertRaises(ValueError):
+            list(lib_payments.iter_multipart_form(io.BytesIO(self.BODY), 'application/x-www-form-urlencoded'))
+
+
+class DecodeLines(unittest.TestCase):
+    def test_fallback_to_latin1(self):
+        self.assertEqual(list(lib_payments.decode_lines(['d\xe9j\xe0'.encode('utf-8'), b'N\xba', 'é'.encode('utf-8')])),
+                         ['d\xe9j\xe0', 'N\xba', 'Ã©'])
+
+
 class ImportBankStatements(unittest.TestCase):
     bank_statements_csv = [
         "Nº de séquence;Date d'exécution;Date valeur;Montant;Devise du compte;Numéro de compte;Type de transaction;Contrepartie;Nom de la contrepartie;Communication;Détails;Statut;Motif du refus",
@@ -219,6 +281,46 @@ class ImportBankStatements(unittest.TestCase):
                                             "5.6.7.8")
         self.assertEqual(storage.Payment.length(connection), len(self.bank_statements_csv) - 1)
 
+    def test_streamed_upload(self):
+        connection = storage.ensure_connection({"dbdir": ":memory:"})
+        self.assertEqual(lib_payments.import_bank_statements(connection, iter([]), "user-test", "1.2.3.4"), [])
+        lines = (line + "\r\n" for line in ["", *self.bank_statements_csv, ""])
+        with patch.object(lib_payments, "IMPORT_BATCH_SIZE", 3):
+            result = lib_payments.import_bank_statements(connection, lines, "user-test", "1.2.3.4")
+        self.assertEqual([exc for exc, _ in result], [None] * (len(self.bank_statements_csv) - 1))
+        self.assertEqual(storage.Payment.length(connection), len(self.bank_statements_csv) - 1)
+
+    def test_upload_committed_in_batches(self):
+        configuration = {"dbdir": ":memory:"}
+        connection = storage.ensure_connection(configuration)
+        with patch.object(lib_payments, "IMPORT_BATCH_SIZE", 3):
+            result = lib_payments.import_bank_statements(connection,
+                                                         "\n".join(self.bank_statements_csv),
+                                                         "user-test",
+                                                         "1.2.3.4")
+        self.assertFalse(connection.in_transaction)
+        self.assertEqual([exc for exc, _ in result], [None] * (len(self.bank_statements_csv) - 1))
+        self.assertEqual(storage.Payment.length(connection), len(self.bank_statements_csv) - 1)
+
+
+    def test_results_are_yielded_batch_by_batch(self):
+        connection = storage.ensure_connection({"dbdir": ":memory:"})
+        read = []
+
+        def lines():
+            for line in self.bank_statements_csv:
+                read.append(line)
+                yield line + "\r\n"
+
+        with patch.object(lib_payments, "IMPORT_BATCH_SIZE", 2):
+            results = lib_payments.iter_import_bank_statements(connection, lines(), "user-test", "1.2.3.4")
+            self.assertIsNone(next(results)[0])
+            # The header and the first batch only
+            self.assertEqual(len(read), 3)
+            self.assertFalse(connection.in_transaction)
+            self.assertEqual(storage.Payment.length(connection), 2)
+            self.assertEqual([exc for exc, _ in results], [None] * (len(self.bank_statements_csv) - 2))
+        self.assertEqual(storage.Payment.length(connection), len(self.bank_statements_csv) - 1)
 
 class GetListPaymentsRow(unittest.TestCase):
     def test_payment_possible_bankid_but_no_reservation_match(self):
@@ -248,9 +350,8 @@ class GetListPaymentsRow(unittest.TestCase):
                                                       'action', 'srhsdf2024/gestion/link_payment_and_reservation.cgi'),
                                                      (('input', 'type', 'hidden', 'name', 'csrf_token', 'value', 'csrf_token_value'),),
                                                      (('input', 'type', 'hidden', 'name', 'bank_ref', 'value', bank_ref),),
-                                                     (('select', 'name', 'reservation_uuid'),
-                                                      (('option', 'value', ''), '--- Choisir la réservation correspondante ---'),
-                                                      (('option', 'value', 'deadbeef'), '12349876', ' ', 'testing test@example.com')),
+                                                     (('input', 'type', 'text', 'name', 'reservation_uuid', 'list', 'reservations-for-linking',
+                                                       'required', 'required', 'placeholder', 'Nom ou communication de la réservation'),),
                                                      (('input', 'type', 'submit', 'value', 'OK'),)),
                                                     (('form', 'style', 'display: inline', 'method', 'POST',
                                                       'action', 'srhsdf2024/gestion/hide_payment.cgi'),
@@ -300,9 +401,8 @@ class GetListPaymentsRow(unittest.TestCase):
                                              'action', '/gestion/link_payment_and_reservation.cgi'),
                                             (('input', 'type', 'hidden', 'name', 'csrf_token', 'value', 'csrf_token_value'),),
                                             (('input', 'type', 'hidden', 'name', 'bank_ref', 'value', '202308081060'),),
-                                            (('select', 'name', 'reservation_uuid'),
-                                             (('option', 'value', ''), '--- Choisir la réservation correspondante ---'),
-                                             (('option', 'value', 'otheruuid'), '+++123/1231/23123+++', ' ', 'Mr B C')),
+                                            (('input', 'type', 'text', 'name', 'reservation_uuid', 'list', 'reservations-for-linking',
+                                              'required', 'required', 'placeholder', 'Nom ou communication de la réservation'),),
                                             (('input', 'type', 'submit', 'value', 'OK'),)))))
 
     def test_payment_already_linked_to_reservation(self):
@@ -372,13 +472,85 @@ class GetListPaymentsRow(unittest.TestCase):
                                   'action', 'srhsdf2024/gestion/link_payment_and_reservation.cgi'),
                                  (('input', 'type', 'hidden', 'name', 'csrf_token', 'value', 'csrf_token_value'),),
                                  (('input', 'type', 'hidden', 'name', 'bank_ref', 'value', bank_ref),),
-                                 (('select', 'name', 'reservation_uuid'),
+                                 (('select', 'name', 'reservation_uuid', 'class', 'link-reservation'),
                                   (('option', 'value', 'deadbeef', 'selected', 'selected'),
-                                   '+++671/4235/58049+++', ' ', 'testing test@example.com'),
-                                  (('option', 'value', 'otheruuid'),
-                                   '+++123/1231/23123+++', ' ', 'Mr B test@example.com')),
+                                   '+++671/4235/58049+++', ' ', 'testing test@example.com')),
                                  (('input', 'type', 'submit', 'value', 'OK'),)))))
 
+    def test_shared_reconciliation(self):
+        configuration = {"dbdir": ":memory:"}
+        connection = storage.ensure_connection(configuration)
+        with connection:
+            reservations = [conftest.make_reservation(last_name=f'name {idx}', bank_id=f'{idx}' * 12, uuid=f'uuid{idx}').insert_data(connection)
+                            for idx in range(3)]
+            payments = [conftest.make_payment(src_id=f'{YEAR_PREFIX}-{idx}', comment=comment, uuid=uuid, bank_ref=f'ref{idx}').insert_data(connection)
+                        for idx, (comment, uuid) in enumerate((('000000000000', None),
+                                                               ('+++111/1111/11111+++', None),
+                                                               ('999999999999', None),
+                                                               ('unstructured', None),
+                                                               ('222222222222', 'uuid2')))]
+        items = [(pmnt, reservations[2] if pmnt.uuid else None) for pmnt in payments]
+        expected = [lib_payments.get_list_payments_row(connection, pmnt, res, 'example.com', '/gestion/list_payments.cgi', 'csrf_token_value')
+                    for pmnt, res in items]
+        queries = []
+        connection.set_trace_callback(queries.append)
+        try:
+            reconciliation = lib_payments.PaymentReconciliation(connection, items)
+            html_rows = [lib_payments.get_list_payments_row(connection, pmnt, res, 'example.com', '/gestion/list_payments.cgi', 'csrf_token_value', reconciliation)
+                         for pmnt, res in items]
+        finally:
+            connection.set_trace_callback(None)
+
+        self.assertEqual(html_rows, expected)
+        self.assertEqual(sorted(reconciliation.by_bank_id), ['000000000000', '111111111111'])
+        # One query to resolve the bank_ids, one to list the reservations
+        self.assertEqual(len(queries), 2)
+        # The options are rendered once for the whole page
+        datalist, script = reconciliation.page_elements()
+        self.assertEqual(datalist[0], ('datalist', 'id', 'reservations-for-linking'))
+        self.assertEqual([option[0] for option in datalist[1:]],
+                         [('option', 'value', 'uuid0'), ('option', 'value', 'uuid1'), ('option', 'value', 'uuid2')])
+        self.assertEqual(script[0], 'script')
+
+    def test_no_datalist_without_unlinked_payments(self):
+        configuration = {"dbdir": ":memory:"}
+        connection = storage.ensure_connection(configuration)
+        with connection:
+            reservation = conftest.make_reservation().insert_data(connection)
+            payment = conftest.make_payment(uuid=reservation.uuid).insert_data(connection)
+        reconciliation = lib_payments.PaymentReconciliation(connection, [(payment, reservation)])
+        lib_payments.get_list_payments_row(connection, payment, reservation, 'example.com', '/gestion/list_payments.cgi', 'csrf_token_value', reconciliation)
+
+        self.assertEqual(reconciliation.page_elements(), ())
+
+    def test_page_size_is_linear(self):
+        def page_size(count):
+            connection = storage.ensure_connection({"dbdir": ":memory:"})
+            with connection:
+                for idx in range(count):
+                    conftest.make_reservation(last_name=f'name {idx}', bank_id=f'{idx:012}', uuid=f'uuid{idx}').insert_data(connection)
+                payments = [conftest.make_payment(src_id=f'{YEAR_PREFIX}-{idx}', comment='unstructured', bank_ref=f'ref{idx}').insert_data(connection)
+                            for idx in range(count)]
+            reconciliation = lib_payments.PaymentReconciliation(connection, [(pmnt, None) for pmnt in payments])
+            rows = [('tr', *lib_payments.get_list_payments_row(connection, pmnt, None, 'example.com', '/gestion/list_payments.cgi', 'csrf_token_value', reconciliation))
+                    for pmnt in payments]
+            return len(htmlgen.render(('div', ('table', *rows), *reconciliation.page_elements())))
+
+        small, large = page_size(20), page_size(80)
+        # 4 times more payments and reservations: 16 times more if every
+        # payment listed every reservation
+        self.assertLess(large, 5 * small)
+
+    def test_find_reservation_to_link(self):
+        connection = storage.ensure_connection({"dbdir": ":memory:"})
+        with connection:
+            reservation = conftest.make_reservation(bank_id='123412341234', uuid='uuid0').insert_data(connection)
+        for value in ('uuid0', ' 123412341234', '+++123/4123/41234+++'):
+            with self.subTest(value=value):
+                self.assertEqual(lib_payments.find_reservation_to_link(connection, value).uuid, reservation.uuid)
+        for value in ('uuid1', '123412341235', '1234'):
+            with self.subTest(value=value):
+                self.assertIsNone(lib_payments.find_reservation_to_link(connection, value))
 
 if __name__ == '__main__':
     unittest.main()
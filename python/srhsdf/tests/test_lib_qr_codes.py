@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import sys_path_hack
+
+with sys_path_hack.app_in_path():
+    import lib_qr_codes
+
+
+class MatrixToSvg(unittest.TestCase):
+    def test_runs_of_dark_modules(self):
+        svg = lib_qr_codes.matrix_to_svg([[False, True, True],
+                                          [True, False, True],
+                                          [False, False, False]])
+        self.assertTrue(svg.startswith('<svg xmlns="http://www.w3.org/2000/svg" width="3mm" height="3mm" viewBox="0 0 3 3"'))
+        self.assertIn('<path d="M1 0h2v1h-2zM0 1h1v1h-1zM2 1h1v1h-1z" fill="#000"/>', svg)
+        self.assertTrue(svg.endswith('</svg>'))
+
+
+class SvgQrCode(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.configuration = {'dbdir': self.db_dir.name, 'qr_cache_max_bytes': 1000}
+        self.folder = os.path.join(self.db_dir.name, lib_qr_codes.CACHE_FOLDER)
+
+    def tearDown(self):
+        self.db_dir.cleanup()
+
+    @staticmethod
+    def fake_svg(content):
+        return f'<svg>{content}</svg>'
+
+    def test_cached_codes_are_not_rendered_again(self):
+        with patch.object(lib_qr_codes, 'make_svg', side_effect=self.fake_svg) as make_svg:
+            self.assertEqual(lib_qr_codes.svg_qr_code('BCD\n001', self.configuration), '<svg>BCD\n001</svg>')
+            self.assertEqual(lib_qr_codes.svg_qr_code('BCD\n001', self.configuration), '<svg>BCD\n001</svg>')
+            self.assertEqual(lib_qr_codes.svg_qr_code('BCD\n002', self.configuration), '<svg>BCD\n002</svg>')
+        self.assertEqual([call.args for call in make_svg.call_args_list], [('BCD\n001',), ('BCD\n002',)])
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         sorted(f'{lib_qr_codes.cache_key(c)}.svg' for c in ('BCD\n001', 'BCD\n002')))
+
+    def test_least_recently_used_codes_are_evicted(self):
+        self.configuration['qr_cache_max_bytes'] = 3 * len(self.fake_svg('0' * 100))
+        contents = [str(i) * 100 for i in range(3)]
+        with patch.object(lib_qr_codes, 'make_svg', side_effect=self.fake_svg):
+            now = time.time_ns()
+            for age, content in zip((30, 20, 10), contents):
+                lib_qr_codes.svg_qr_code(content, self.configuration)
+                path = os.path.join(self.folder, f'{lib_qr_codes.cache_key(content)}.svg')
+                os.utime(path, ns=(now, now - age * 10**9))
+            # The oldest code becomes the most recently used one
+            lib_qr_codes.svg_qr_code(contents[0], self.configuration)
+            lib_qr_codes.svg_qr_code('3' * 100, self.configuration)
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         sorted(f'{lib_qr_codes.cache_key(c)}.svg' for c in (contents[0], contents[2], '3' * 100)))
+
+    def test_in_memory_db_has_no_cache(self):
+        self.configuration['dbdir'] = ':memory:'
+        with patch.object(lib_qr_codes, 'make_svg', side_effect=self.fake_svg) as make_svg:
+            lib_qr_codes.svg_qr_code('x', self.configuration)
+            lib_qr_codes.svg_qr_code('x', self.configuration)
+        self.assertEqual(make_svg.call_count, 2)
+        self.assertFalse(os.path.exists(self.folder))
+
+    def test_unwritable_cache_is_not_an_error(self):
+        with patch.object(lib_qr_codes, 'make_svg', side_effect=self.fake_svg), \
+             patch.object(lib_qr_codes, '_store', side_effect=PermissionError):
+            self.assertEqual(lib_qr_codes.svg_qr_code('x', self.configuration), '<svg>x</svg>')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "python3 test_lib_qr_codes.py"
+# End:
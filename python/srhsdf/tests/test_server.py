@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import call, patch
+
+import sys_path_hack
+
+with sys_path_hack.app_in_path():
+    import config
+    import server
+    import storage
+
+
+HELLO_CGI = '''
+import os
+import sys
+sys.path.append('..')
+from htmlgen import html_document, respond_html
+if __name__ == '__main__':
+    respond_html(html_document('hello', (('p', os.getenv('REQUEST_METHOD'), ' ', os.getenv('QUERY_STRING'), ' ', sys.stdin.read()),)))
+'''
+
+REDIRECT_CGI = '''
+from htmlgen import redirect
+if __name__ == '__main__':
+    redirect('https://example.com/elsewhere')
+'''
+
+FAILING_CGI = '''
+from htmlgen import print_content_type
+if __name__ == '__main__':
+    try:
+        raise RuntimeError('boom')
+    except Exception:
+        if print_content_type('text/html; charset=utf-8'):
+            print()
+        raise
+'''
+
+
+class TestApplication(unittest.TestCase):
+    def setUp(self):
+        self.app_dir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.app_dir.name, 'gestion'))
+        for name, source in (('hello.cgi', HELLO_CGI),
+                             ('gestion/redirect.cgi', REDIRECT_CGI),
+                             ('failing.cgi', FAILING_CGI),
+                             ('styles.css', 'p {}'),
+                             ('configuration.json', '{"secret": 1}')):
+            with open(os.path.join(self.app_dir.name, name), 'w') as f:
+                f.write(source)
+        self.application = server.make_application(self.app_dir.name)
+
+    def tearDown(self):
+        config.forget_configuration()
+        storage._CONNECTION_POOL = None
+        self.app_dir.cleanup()
+
+    def request(self, path, method='GET', query_string='', body=b''):
+        environ = {'REQUEST_METHOD': method,
+                   'PATH_INFO': path,
+                   'QUERY_STRING': query_string,
+                   'SERVER_NAME': 'localhost',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body)}
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+            response['header_names'] = [name for name, _ in headers]
+
+        response['body'] = b''.join(self.application(environ, start_response))
+        return response
+
+    def test_get(self):
+        response = self.request('/hello.cgi', query_string='a=1')
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual(response['headers']['Content-Type'], 'text/html; charset=utf-8')
+        self.assertEqual(response['headers']['Content-Length'], str(len(response['body'])))
+        self.assertEqual(response['header_names'].count('Content-Length'), 1)
+        self.assertIn(b'<p>GET a=1 </p>', response['body'])
+
+    def test_post_body_is_stdin(self):
+        response = self.request('/hello.cgi', method='POST', body=b'x=y')
+        self.assertIn(b'<p>POST  x=y</p>', response['body'])
+
+    def test_headers_are_reset_between_requests(self):
+        for _ in range(2):
+            response = self.request('/hello.cgi')
+            self.assertEqual(response['status'], '200 OK')
+            self.assertTrue(response['body'].startswith(b'<!DOCTYPE HTML>'))
+
+    def test_redirect_exits(self):
+        response = self.request('/gestion/redirect.cgi')
+        self.assertEqual(response['status'], '302 Found')
+        self.assertEqual(response['headers']['Location'], 'https://example.com/elsewhere')
+
+    def test_exception_is_reported(self):
+        response = self.request('/failing.cgi')
+        self.assertEqual(response['status'], '200 OK')
+        self.assertIn(b'boom', response['body'])
+        # the server survives the exception
+        self.assertEqual(self.request('/hello.cgi')['status'], '200 OK')
+
+    def test_static_files(self):
+        self.assertEqual(self.request('/styles.css')['body'], b'p {}')
+        for path in ('/configuration.json', '/../etc/passwd', '/unknown.cgi'):
+            with self.subTest(path=path):
+                self.assertEqual(self.request(path)['status'], '404 Not Found')
+
+
+class TestSplitCgiResponse(unittest.TestCase):
+    def test_examples(self):
+        for output, expected in (
+                (b'Content-Type: text/plain\n\nbody', ('200 OK', [('Content-Type', 'text/plain')], b'body')),
+                (b'Status: 302\nLocation: /x\n\n', ('302 Found', [('Location', '/x')], b'')),
+                (b'no headers', ('500 Internal Server Error', [('Content-Type', 'text/plain; charset=utf-8')], b'no headers')),
+        ):
+            with self.subTest(output=output):
+                self.assertEqual(server.split_cgi_response(output), expected)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def tearDown(self):
+        storage._CONNECTION_POOL = None
+
+    def test_pooled_connection_is_reused(self):
+        with tempfile.TemporaryDirectory() as dbdir:
+            storage.enable_connection_pool()
+            connection = storage.create_db({'dbdir': dbdir})
+            connection.close()
+            self.assertIs(storage.create_db({'dbdir': dbdir}), connection)
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM reservations').fetchone()[0], 0)
+            storage._CONNECTION_POOL = None
+            self.assertIsNot(storage.create_db({'dbdir': dbdir}), connection)
+
+    def test_uncommitted_changes_are_rolled_back(self):
+        with tempfile.TemporaryDirectory() as dbdir:
+            storage.enable_connection_pool()
+            connection = storage.create_db({'dbdir': dbdir})
+            connection.execute(f'DELETE FROM {storage.DATA_VERSIONS_TABLE_NAME}')
+            storage.release_pooled_connections()
+            self.assertGreater(connection.execute(f'SELECT COUNT(*) FROM {storage.DATA_VERSIONS_TABLE_NAME}').fetchone()[0], 0)
+
+
+class TestReloadConfiguration(unittest.TestCase):
+    def test_sighup_is_forwarded_to_the_workers(self):
+        with patch.object(server, '_PREFORK_CHILDREN', [101, 102]), \
+             patch.object(server.os, 'kill', side_effect=[ProcessLookupError, None]) as kill, \
+             patch.object(server.config, 'forget_configuration') as forget_configuration:
+            server._reload_configuration(server.signal.SIGHUP, None)
+        forget_configuration.assert_called_once_with()
+        self.assertEqual(kill.call_args_list, [call(101, server.signal.SIGHUP), call(102, server.signal.SIGHUP)])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# Local Variables:
+# compile-command: "python3 test_server.py"
+# End:
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
 import sqlite3
+import tempfile
+import threading
 import time
 from typing import Optional
 import unittest
+from unittest.mock import patch
 
 import sys_path_hack
 from conftest import make_payment, make_reservation
@@ -109,6 +113,142 @@ class TestReservation(unittest.TestCase):
         self.assertEqual(reservation.origin, 'origin')
 
 
+class TestFullTextSearch(unittest.TestCase):
+    def setUp(self):
+        self.connection = storage.create_db({'dbdir': ':memory:'})
+        with self.connection:
+            for idx, (last_name, email) in enumerate((('Dupont', 'jean@example.com'),
+                                                      ('DUPONT-Durand', 'marie_d@example.org'),
+                                                      ('Émile', '0475/12.34.56'))):
+                make_reservation(last_name=last_name, email=email,
+                                 bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}').insert_data(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_same_results_as_like(self):
+        for col, val in (('last_name', 'dupont'), ('last_name', 'du'), ('last_name', 'dur%'), ('last_name', 'zzz'),
+                         ('email', 'example'), ('email', '12.34'), ('email', 'marie_d')):
+            with self.subTest(col=col, val=val):
+                self.assertEqual(
+                    sorted(r.uuid for r in storage.Reservation.select(self.connection, filtering=[(col, val)])),
+                    sorted(row[0] for row in self.connection.execute(
+                        f'SELECT uuid FROM reservations WHERE LOWER({col}) LIKE :val',
+                        {'val': storage.MiniOrm.maybe_add_wildcards(val.lower())})))
+
+    def search(self, col, val):
+        return sorted(r.uuid for r in storage.Reservation.select(self.connection, filtering=[(col, val)]))
+
+    def test_short_searches_do_not_use_the_index(self):
+        for val in ('du', 'dur%'):
+            with self.subTest(val=val):
+                query, params, _ = storage.Reservation.keyset_query([('last_name', val)], [], 10, None, None)
+                plan = ' '.join(row[-1] for row in self.connection.execute(f'EXPLAIN QUERY PLAN {query}', params))
+                self.assertNotIn('reservations_fts', plan)
+
+    def test_index_survives_vacuum(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM reservations WHERE uuid = 'uuid_0'")
+        self.connection.execute('VACUUM')
+        self.assertEqual(self.search('last_name', 'durand'), ['uuid_1'])
+        self.assertEqual(self.search('email', '12.34'), ['uuid_2'])
+        with self.connection:
+            make_reservation(last_name='Zorro', bank_id='bank_id_3', uuid='uuid_3').insert_data(self.connection)
+        self.assertEqual(self.search('last_name', 'zorro'), ['uuid_3'])
+        self.assertEqual(self.search('email', '12.34'), ['uuid_2'])
+
+    def test_index_follows_updates(self):
+        with self.connection:
+            self.connection.execute("UPDATE reservations SET last_name = 'Martin' WHERE uuid = 'uuid_0'")
+            make_payment(rowid=None, src_id='src_1', bank_ref='ref_1', other_name='Mme Dupont').insert_data(self.connection)
+        self.assertEqual([r.uuid for r in storage.Reservation.select(self.connection, filtering=[('last_name', 'dupont')])],
+                         ['uuid_1'])
+        self.assertEqual([p.src_id for p, _ in storage.Payment.join_reservations(self.connection, filtering=[('other_name', 'dupont')])],
+                         ['src_1'])
+
+
+class TestWithoutTrigramFts5(unittest.TestCase):
+    '''SQLite older than 3.34 or built without FTS5'''
+    FTS_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%fts' ORDER BY name"
+
+    def search(self, connection, val):
+        return [r.uuid for r in storage.Reservation.select(connection, filtering=[('last_name', val)])]
+
+    def test_like_until_the_index_can_be_created(self):
+        with patch.object(storage, 'has_trigram_fts5', return_value=False):
+            connection = storage.create_db({'dbdir': ':memory:'})
+            self.assertEqual(connection.execute(self.FTS_TABLES).fetchall(), [])
+            with connection:
+                for idx, last_name in enumerate(('Dupont', 'Durand')):
+                    make_reservation(last_name=last_name, bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}').insert_data(connection)
+            self.assertEqual(self.search(connection, 'dupo'), ['uuid_0'])
+            self.assertEqual(self.search(connection, 'd_'), ['uuid_0', 'uuid_1'])
+        try:
+            # The same database opened by an SQLite with trigram FTS5
+            storage.migrate_db(connection)
+            self.assertEqual([row[0] for row in connection.execute(self.FTS_TABLES)], ['payments_fts', 'reservations_fts'])
+            self.assertEqual(self.search(connection, 'dupo'), ['uuid_0'])
+            query, params, _ = storage.Reservation.keyset_query([('last_name', 'dupo')], [], 10, None, None)
+            self.assertIn('VIRTUAL TABLE INDEX',
+                          ' '.join(row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {query}', params)))
+        finally:
+            connection.close()
+
+
+class TestReservationTotals(unittest.TestCase):
+    def setUp(self):
+        self.connection = storage.create_db({'dbdir': ':memory:'})
+        with self.connection:
+            for idx, (date, paying_seats, free_seats, active) in enumerate((('2024-03-23', 2, 0, True),
+                                                                            ('2024-03-23', 3, 1, False),
+                                                                            ('2024-03-24', 4, 2, True),
+                                                                            ('2024-03-23', 1, None, True))):
+                make_reservation(last_name=f'n{idx}', date=date, paying_seats=paying_seats, free_seats=free_seats,
+                                 active=active, bank_id=f'bank_id_{idx}', uuid=f'uuid_{idx}',
+                                 ).insert_data(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def assertTotalsMatchReservations(self):
+        # The original queries scanning all reservations
+        self.assertEqual(storage.Reservation.length(self.connection),
+                         self.connection.execute('SELECT COUNT(*) FROM reservations').fetchone()[0])
+        self.assertEqual(storage.Reservation.count_active(self.connection),
+                         storage.Reservation.length(self.connection, [('active', 1)]))
+        self.assertEqual(list(storage.Reservation.summary_by_date(self.connection)),
+                         [(date, places or 0) for date, places in self.connection.execute(
+                             '''SELECT date, SUM(paying_seats + free_seats) FROM reservations
+                                WHERE active != 0 GROUP BY date ORDER BY date''')])
+
+    def test_after_inserts(self):
+        self.assertEqual(storage.Reservation.length(self.connection), 4)
+        self.assertEqual(storage.Reservation.count_active(self.connection), 3)
+        self.assertEqual(list(storage.Reservation.summary_by_date(self.connection)),
+                         [('2024-03-23', 2), ('2024-03-24', 6)])
+        self.assertTotalsMatchReservations()
+
+    def test_after_activation_changes(self):
+        for uuid, active in (('uuid_0', False), ('uuid_1', True), ('uuid_2', False)):
+            with self.subTest(uuid=uuid, active=active):
+                with self.connection:
+                    self.connection.execute('UPDATE reservations SET active = ? WHERE uuid = ?', (active, uuid))
+                self.assertTotalsMatchReservations()
+        self.assertEqual(list(storage.Reservation.summary_by_date(self.connection)), [('2024-03-23', 4)])
+
+    def test_after_other_changes(self):
+        with self.connection:
+            self.connection.execute("UPDATE reservations SET date = '2024-03-24', free_seats = 7 WHERE uuid = 'uuid_3'")
+            self.connection.execute("DELETE FROM reservations WHERE uuid = 'uuid_0'")
+        self.assertTotalsMatchReservations()
+
+    def test_failed_insert_is_not_counted(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.connection:
+                make_reservation(uuid='uuid_0', bank_id='new').insert_data(self.connection)
+        self.assertTotalsMatchReservations()
+
+
 class TestPayments(unittest.TestCase):
     CONNECTION: sqlite3.Connection
     CONFIGURATION = {}
@@ -205,6 +345,24 @@ class TestPayments(unittest.TestCase):
                 self.assertEqual(storage.Payment.column_ordering_clause(col, table_id_prefix=prefix),
                                  expected)
 
+    def test_insert_many(self):
+        payments = [make_payment(bank_ref='ref_src_id_0', src_id='bulk_0'), # already in the DB
+                    make_payment(bank_ref='bulk_1', src_id='bulk_1'),
+                    make_payment(bank_ref='bulk_2', src_id='bulk_2', status=None), # NOT NULL
+                    make_payment(bank_ref='bulk_1', src_id='bulk_3'), # duplicate of the 2nd one
+                    make_payment(bank_ref='bulk_4', src_id='bulk_4')]
+        length = storage.Payment.length(self.CONNECTION)
+        with storage.write_transaction(self.CONNECTION):
+            outcomes = storage.Payment.insert_many(self.CONNECTION, payments, chunk_size=3)
+        self.assertEqual([pmnt for _, pmnt in outcomes], payments)
+        self.assertEqual([exc is None for exc, _ in outcomes], [False, True, False, False, True])
+        self.assertEqual([storage.is_unique_constraint_error(outcomes[idx][0]) for idx in (0, 2, 3)], [True, False, True])
+        self.assertEqual(storage.Payment.length(self.CONNECTION), length + 2)
+        for pmnt in (payments[1], payments[4]):
+            self.assertEqual(
+                self.CONNECTION.execute('SELECT bank_ref FROM payments WHERE rowid = ?', (pmnt.rowid, )).fetchone(),
+                (pmnt.bank_ref, ))
+
     def test_sum_of_two_payments(self):
         self.assertEqual(storage.Payment.sum_payments(self.CONNECTION, self.UUID_WITH_TWO_PAYMENTS), 7)
 
@@ -223,6 +381,93 @@ class TestPayments(unittest.TestCase):
             with self.subTest(uuid=reservation.uuid):
                 self.assertEqual(reservation.remaining_amount_due_in_cents(self.CONNECTION), expected)
 
+    def test_select_for_export(self):
+        with patch.object(storage.Payment, 'sum_payments') as sum_payments:
+            self.assertEqual(
+                sorted((r.bank_id, paid_cents)
+                       for r, paid_cents in storage.Reservation.select_for_export(self.CONNECTION, batch_size=1)),
+                [('bank_id_1', 7), ('bank_id_2', 4)])
+            sum_payments.assert_not_called()
+
+    def test_select_for_export_changed_since(self):
+        def exported(changed_since):
+            return sorted(r.bank_id for r, _ in storage.Reservation.select_for_export(self.CONNECTION, changed_since))
+
+        def forget_changes():
+            with self.CONNECTION:
+                self.CONNECTION.execute('UPDATE reservations SET changed_at = 0')
+
+        self.assertEqual(exported(time.time() - 60), ['bank_id_1', 'bank_id_2'])
+        self.assertEqual(exported(time.time() + 60), [])
+        forget_changes()
+        self.assertEqual(exported(1), [])
+        p3 = storage.Payment.find_by_bank_ref(self.CONNECTION, 'ref_src_id_2')
+        with self.CONNECTION:
+            p3.update_uuid(self.CONNECTION, self.UUID_WITH_TWO_PAYMENTS, 'unit-test-user', '1.2.3.6')
+        self.assertEqual(exported(1), ['bank_id_1', 'bank_id_2'])
+        forget_changes()
+        # Unlinking changes the reservation the payment was linked to
+        with self.CONNECTION:
+            p3.update_uuid(self.CONNECTION, None, 'unit-test-user', '1.2.3.6')
+        self.assertEqual(exported(1), ['bank_id_1'])
+        forget_changes()
+        with self.CONNECTION:
+            storage.Payment.find_by_bank_ref(self.CONNECTION, 'ref_src_id_0').hide(self.CONNECTION, 'unit-test-user', '1.2.3.6')
+        self.assertEqual(exported(1), ['bank_id_1'])
+        forget_changes()
+        with self.CONNECTION:
+            self.CONNECTION.execute("UPDATE reservations SET active = 0 WHERE bank_id = 'bank_id_2'")
+        self.assertEqual(exported(1), ['bank_id_2'])
+        forget_changes()
+        with self.CONNECTION:
+            self.CONNECTION.execute("UPDATE reservations SET email = 'new@example.com' WHERE bank_id = 'bank_id_1'")
+        self.assertEqual(exported(1), ['bank_id_1'])
+        forget_changes()
+        with self.CONNECTION:
+            make_reservation(bank_id='bank_id_0', uuid='recent').insert_data(self.CONNECTION)
+        self.assertEqual(exported(1), ['bank_id_0'])
+
+    def test_paid_cents_is_maintained(self):
+        def paid_cents():
+            return storage.Reservation.paid_cents_by_uuid(self.CONNECTION)[self.UUID_WITH_TWO_PAYMENTS]
+
+        self.assertEqual(paid_cents(), 7)
+        with self.CONNECTION:
+            make_payment(bank_ref='new', amount_in_cents=100, uuid=self.UUID_WITH_TWO_PAYMENTS).insert_data(self.CONNECTION)
+        self.assertEqual(paid_cents(), 107)
+        p1 = storage.Payment.find_by_bank_ref(self.CONNECTION, "ref_src_id_0")
+        with self.CONNECTION:
+            p1.update_uuid(self.CONNECTION, "beef12346789fedc", "unit-test-user", "1.2.3.6")
+        self.assertEqual(paid_cents(), 104)
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(self.CONNECTION, ["beef12346789fedc"]),
+                         {"beef12346789fedc": 7})
+        with self.CONNECTION:
+            p1.update_uuid(self.CONNECTION, None, "unit-test-user", "1.2.3.6")
+            p1.hide(self.CONNECTION, "unit-test-user", "1.2.3.6")
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(self.CONNECTION),
+                         {self.UUID_WITH_TWO_PAYMENTS: 104, "beef12346789fedc": 4})
+
+    def test_paid_cents_of_reservation_inserted_after_payment(self):
+        with self.CONNECTION:
+            make_payment(bank_ref='early', amount_in_cents=100, uuid='late').insert_data(self.CONNECTION)
+            make_reservation(bank_id='late', uuid='late').insert_data(self.CONNECTION)
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(self.CONNECTION, ['late', 'unknown']), {'late': 100})
+
+    def test_with_paid_cents(self):
+        with patch.object(storage.Payment, 'sum_payments') as sum_payments:
+            self.assertEqual(
+                sorted(r.remaining_amount_due_in_cents(self.CONNECTION)
+                       for r in storage.Reservation.with_paid_cents(
+                               self.CONNECTION, storage.Reservation.select(self.CONNECTION))),
+                [12345 - 7, 34512 - 4])
+            for uuid, expected in ((self.UUID_WITH_TWO_PAYMENTS, 12345 - 7), ("beef12346789fedc", 34512 - 4)):
+                with self.subTest(uuid=uuid):
+                    reservation = storage.Reservation.find_by_uuid(self.CONNECTION, uuid)
+                    self.assertEqual(reservation.remaining_amount_due_in_cents(self.CONNECTION), expected)
+                    reservation = storage.Reservation.find_by_bank_id(self.CONNECTION, reservation.bank_id)
+                    self.assertEqual(reservation.remaining_amount_due_in_cents(self.CONNECTION), expected)
+            sum_payments.assert_not_called()
+
     def test_join_payments_and_reservations(self):
         joined = list(storage.Payment.join_reservations(self.CONNECTION))
         self.assertEqual(len(joined), 13)
@@ -237,6 +482,21 @@ class TestPayments(unittest.TestCase):
         self.assertEqual(sum((res is not None and res.bank_id == "bank_id_1" for _, res in joined)), 1)
         self.assertEqual(sum((res is not None and res.bank_id == "bank_id_2" for _, res in joined)), 1)
 
+    def test_join_reservations_page__like_list_payments_cgi(self):
+        expected = [(pmnt.rowid, None if res is None else res.uuid) for pmnt, res in storage.Payment.join_reservations(
+            self.CONNECTION, filtering=[('active', True)], order_columns=['SRC_ID', 'timestamp'], offset=1, limit=-1)]
+        pages = [storage.Payment.join_reservations_page(
+            self.CONNECTION, filtering=[('active', True)], order_columns=['SRC_ID', 'timestamp'], limit=5, offset=1)]
+        self.assertTrue(pages[0].has_previous)
+        while pages[-1].has_next:
+            pages.append(storage.Payment.join_reservations_page(
+                self.CONNECTION, filtering=[('active', True)], order_columns=['SRC_ID', 'timestamp'], limit=5, after=pages[-1].last_key))
+        self.assertEqual([(pmnt.rowid, None if res is None else res.uuid) for page in pages for pmnt, res in page.items],
+                         expected)
+        previous = storage.Payment.join_reservations_page(
+            self.CONNECTION, filtering=[('active', True)], order_columns=['SRC_ID', 'timestamp'], limit=5, before=pages[1].first_key)
+        self.assertEqual([pmnt.rowid for pmnt, _ in previous.items], [pmnt.rowid for pmnt, _ in pages[0].items])
+
     def test_confirmation_timestamp(self):
         p1 = storage.Payment.find_by_bank_ref(self.CONNECTION, "ref_src_id_0")
         self.assertEqual(p1.confirmation_timestamp, 864060.3)
@@ -359,6 +619,302 @@ class TestPayments_max_timestamp(unittest.TestCase):
                 self.assertLessEqual(reloaded.timestamp, after_save)
 
 
+class TestMigrations(unittest.TestCase):
+    def test_new_db_is_at_latest_version(self):
+        connection = storage.create_db({'dbdir': ':memory:'})
+        self.assertEqual(
+            connection.execute('PRAGMA user_version').fetchone()[0],
+            storage.schema_version((storage.Csrf, storage.Reservation, storage.Payment)))
+        self.assertEqual(storage.Reservation.length(connection), 0)
+
+    def test_db_created_before_versioning(self):
+        connection = sqlite3.connect(':memory:')
+        for table in (storage.Reservation, storage.Payment):
+            table.create_in_db(connection)
+        with connection:
+            make_payment().insert_data(connection)
+        storage.migrate_db(connection)
+        self.assertEqual(storage.Payment.length(connection), 1)
+        self.assertGreater(connection.execute('PRAGMA user_version').fetchone()[0], 0)
+
+    def test_totals_of_db_created_before_versioning(self):
+        connection = sqlite3.connect(':memory:')
+        for table in (storage.Reservation, storage.Payment):
+            table.create_in_db(connection)
+        with connection:
+            for idx, active in enumerate((True, False, True)):
+                make_reservation(active=active, uuid=f'uuid_{idx}', bank_id=f'bank_id_{idx}').insert_data(connection)
+        storage.migrate_db(connection)
+        self.assertEqual(storage.Reservation.length(connection), 3)
+        self.assertEqual(storage.Reservation.count_active(connection), 2)
+        self.assertEqual(list(storage.Reservation.summary_by_date(connection)), [('2024-11-30', 10)])
+
+    def test_paid_cents_of_db_created_before_versioning(self):
+        connection = sqlite3.connect(':memory:')
+        for table in (storage.Reservation, storage.Payment):
+            table.create_in_db(connection)
+        with connection:
+            connection.execute(
+                f"INSERT INTO reservations VALUES ({','.join('?' * len(storage.Reservation.COLUMNS))})",
+                [getattr(make_reservation(uuid='abc'), col) for col, _ in storage.Reservation.COLUMNS])
+            make_payment(uuid='abc', amount_in_cents=123).insert_data(connection)
+        storage.migrate_db(connection)
+        self.assertEqual(storage.Reservation.paid_cents_by_uuid(connection), {'abc': 123})
+
+    def test_csrf_table_is_dropped(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE csrfs (token TEXT NOT NULL PRIMARY KEY, timestamp REAL, user TEXT NOT NULL, ip TEXT NOT NULL)')
+        storage.migrate_db(connection)
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'csrfs'").fetchone()[0], 0)
+
+    def test_payment_indexes_cover_hidden_payments(self):
+        connection = storage.create_db({'dbdir': ':memory:'})
+        partial_indexes = {table: count for table, count in connection.execute(
+            "SELECT tbl_name, COUNT(*) FROM sqlite_master WHERE type = 'index' AND sql LIKE '%WHERE active != 0' GROUP BY tbl_name")}
+        self.assertNotIn('payments', partial_indexes)
+        self.assertIn('reservations', partial_indexes)
+        # list_payments.cgi does not filter on `active'
+        query, params, _ = storage.Payment.keyset_query(None, ['amount_in_cents'], 5, [1000, 9], None)
+        plan = ' '.join(row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + query, params))
+        self.assertIn('USING INDEX index_amount_in_cents_payments', plan)
+
+    def test_full_text_search_is_looked_for_once_per_database(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            configuration = {'dbdir': db_dir}
+            storage.create_db(configuration).close()
+            with patch.object(storage, 'missing_full_text_search', wraps=storage.missing_full_text_search) as missing:
+                for _ in range(3):
+                    storage.create_db(configuration).close()
+        self.assertEqual(missing.call_count, 1)
+
+    def test_new_steps_are_applied_once(self):
+        class Table(storage.MiniOrm):
+            TABLE_NAME = 'migration_test'
+            MIGRATIONS = {1: ['CREATE TABLE migration_test (a INTEGER)']}
+
+        connection = sqlite3.connect(':memory:')
+        self.assertEqual(storage.migrate_db(connection, [Table]), 1)
+        Table.MIGRATIONS = {**Table.MIGRATIONS,
+                            2: ['ALTER TABLE migration_test ADD COLUMN b TEXT'],
+                            3: ["INSERT INTO migration_test VALUES (3, 'x')"]}
+        for _ in range(2):
+            self.assertEqual(storage.migrate_db(connection, [Table]), 3)
+        self.assertEqual(connection.execute('SELECT * FROM migration_test').fetchall(), [(3, 'x')])
+
+    def test_partial_index(self):
+        class Table(storage.MiniOrm):
+            TABLE_NAME = 'migration_test'
+            COLUMNS = [('name', 'TEXT'), ('active', 'INTEGER')]
+            SORTABLE_COLUMNS = {'name': 'LOWER(name)'}
+            FILTERABLE_COLUMNS = {'active': storage.MiniOrm.compare_as_bool('active')}
+            MIGRATIONS = {1: [storage.default_creation_statement(TABLE_NAME, COLUMNS)],
+                          2: [f'CREATE INDEX index_name_{TABLE_NAME} ON {TABLE_NAME} (LOWER(name)) WHERE active != 0']}
+
+        connection = sqlite3.connect(':memory:')
+        storage.migrate_db(connection, [Table])
+        query, params, _ = Table.keyset_query([('active', 'yes')], ['name'], 10, ['b', 4], None)
+        plan = ' '.join(row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + query, params))
+        self.assertIn('SEARCH migration_test USING INDEX index_name_migration_test', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_failed_step_leaves_db_unchanged(self):
+        class Table(storage.MiniOrm):
+            TABLE_NAME = 'migration_test'
+            MIGRATIONS = {1: ['CREATE TABLE migration_test (a INTEGER)', 'NOT SQL']}
+
+        connection = sqlite3.connect(':memory:')
+        with self.assertRaises(sqlite3.OperationalError):
+            storage.migrate_db(connection, [Table])
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], 0)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0], 0)
+
+
+class TestDataVersion(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.connection = storage.create_db({'dbdir': self.db_dir.name})
+
+    def tearDown(self):
+        self.connection.close()
+        self.db_dir.cleanup()
+
+    def version(self, connection=None):
+        return storage.data_version(connection or self.connection, (storage.Reservation, storage.Payment))
+
+    def test_changes_are_counted(self):
+        (reservations, payments), _ = self.version()
+        with self.connection:
+            reservation = make_reservation(uuid='uuid-version', bank_id='000000000097')
+            reservation.insert_data(self.connection)
+        (reservations_after_insert, payments_after_insert), _ = self.version()
+        self.assertGreater(reservations_after_insert, reservations)
+        self.assertEqual(payments_after_insert, payments)
+        with self.connection:
+            make_payment(uuid='uuid-version', bank_ref='bank-ref-version').insert_data(self.connection)
+        (reservations_after_payment, payments_after_payment), _ = self.version()
+        # The trigger keeping `paid_cents' up to date changed the reservation
+        self.assertGreater(reservations_after_payment, reservations_after_insert)
+        self.assertGreater(payments_after_payment, payments_after_insert)
+        with self.connection:
+            self.connection.execute('DELETE FROM payments')
+        self.assertGreater(self.version()[0][1], payments_after_payment)
+
+    def test_same_for_every_connection(self):
+        with self.connection:
+            make_reservation(uuid='uuid-version', bank_id='000000000097').insert_data(self.connection)
+        other = storage.create_db({'dbdir': self.db_dir.name})
+        try:
+            self.assertEqual(self.version(other), self.version())
+        finally:
+            other.close()
+
+    def test_csrf_tokens_do_not_count(self):
+        before = self.version()
+        storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1')
+        self.assertEqual(self.version(), before)
+
+    def test_last_modified(self):
+        before = time.time()
+        with self.connection:
+            make_reservation(uuid='uuid-version', bank_id='000000000097').insert_data(self.connection)
+        self.assertLessEqual(int(before), self.version()[1])
+        self.assertLessEqual(self.version()[1], time.time())
+
+
+class TestCsrf(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.connection = storage.create_db({'dbdir': self.db_dir.name})
+
+    def tearDown(self):
+        self.connection.close()
+        self.db_dir.cleanup()
+
+    def test_token_is_validated_without_writing(self):
+        changes = self.connection.total_changes
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        self.assertEqual(storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token, token)
+        self.assertEqual(storage.Csrf.validate_and_update(self.connection, token, 'user', '127.0.0.1').token, token)
+        self.assertEqual(self.connection.total_changes, changes)
+        self.assertFalse(self.connection.in_transaction)
+
+    def test_invalid_tokens(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        for bad_token, user, ip in ((token, 'other', '127.0.0.1'),
+                                    (token, 'user', '10.0.0.1'),
+                                    (f'{int(token[:8], 16) + 1:08x}{token[8:]}', 'user', '127.0.0.1'),
+                                    (token[8:], 'user', '127.0.0.1'),
+                                    (token[:8] + 'é' * 64, 'user', '127.0.0.1'),
+                                    ('', 'user', '127.0.0.1')):
+            with self.subTest(token=bad_token, user=user, ip=ip):
+                self.assertRaises(KeyError, storage.Csrf.validate_and_update, self.connection, bad_token, user, ip)
+
+    def test_expired_token(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        with patch('time.time', return_value=time.time() + 2 * storage.Csrf.SESSION_IN_SECONDS):
+            self.assertRaises(KeyError, storage.Csrf.validate_and_update, self.connection, token, 'user', '127.0.0.1')
+
+    def test_key_is_shared_by_connections(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        self.assertTrue(os.path.exists(os.path.join(self.db_dir.name, storage.Csrf.SECRET_FILE_NAME)))
+        storage._CSRF_SECRETS.clear()
+        other = storage.create_db({'dbdir': self.db_dir.name})
+        try:
+            self.assertEqual(storage.Csrf.validate_and_update(other, token, 'user', '127.0.0.1').token, token)
+        finally:
+            other.close()
+
+    def test_configured_key(self):
+        token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+        with patch('config.get_configuration', return_value={'csrf_secret': 'configured'}):
+            configured_token = storage.Csrf.get_by_user_and_ip(self.connection, 'user', '127.0.0.1').token
+            self.assertNotEqual(configured_token, token)
+            self.assertRaises(KeyError, storage.Csrf.validate_and_update, self.connection, token, 'user', '127.0.0.1')
+
+
+class TestConnectionProfile(unittest.TestCase):
+    def test_defaults(self):
+        with tempfile.TemporaryDirectory() as dbdir:
+            connection = storage.create_db({'dbdir': dbdir})
+            try:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+                self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+            finally:
+                connection.close()
+
+    def test_configuration_overrides_defaults(self):
+        with tempfile.TemporaryDirectory() as dbdir:
+            connection = storage.create_db({'dbdir': dbdir,
+                                            'sqlite_journal_mode': 'DELETE',
+                                            'sqlite_busy_timeout': 250,
+                                            'sqlite_synchronous': 'full',
+                                            'sqlite_cache_size': -4000})
+            try:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+                self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone()[0], 250)
+                self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 2)
+                self.assertEqual(connection.execute('PRAGMA cache_size').fetchone()[0], -4000)
+            finally:
+                connection.close()
+
+    def test_invalid_values(self):
+        for key, value in (('sqlite_journal_mode', 'wal; DROP TABLE payments'),
+                           ('sqlite_synchronous', 'sometimes'),
+                           ('sqlite_mmap_size', 'big')):
+            with self.subTest(key=key):
+                with self.assertRaises(ValueError):
+                    storage.connection_profile({key: value})
+
+
+class TestWriteTransaction(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.TemporaryDirectory()
+        self.configuration = {'dbdir': self.dbdir.name, 'sqlite_busy_timeout': 0}
+        self.writer = storage.create_db(self.configuration)
+        # Another process, but released from a timer thread in some tests
+        self.other = storage.connect(os.path.join(self.dbdir.name, 'db.db'),
+                                     storage.connection_profile(self.configuration),
+                                     check_same_thread=False)
+
+    def tearDown(self):
+        self.writer.close()
+        self.other.close()
+        self.dbdir.cleanup()
+
+    def test_commit_and_rollback(self):
+        with storage.write_transaction(self.writer):
+            make_payment(src_id='committed').insert_data(self.writer)
+        with self.assertRaises(RuntimeError):
+            with storage.write_transaction(self.writer):
+                make_payment(src_id='rolled back', bank_ref='other').insert_data(self.writer)
+                raise RuntimeError('abort')
+        self.assertEqual([p.src_id for p in storage.Payment.select(self.other)], ['committed'])
+
+    def test_writers_wait_for_each_other(self):
+        self.other.execute('BEGIN IMMEDIATE')
+        timer = threading.Timer(0.05, self.other.rollback)
+        timer.start()
+        try:
+            with storage.write_transaction(self.writer, attempts=10):
+                make_payment().insert_data(self.writer)
+        finally:
+            timer.join()
+        self.assertEqual(storage.Payment.length(self.other), 1)
+
+    def test_gives_up_eventually(self):
+        self.other.execute('BEGIN IMMEDIATE')
+        with self.assertRaises(sqlite3.OperationalError):
+            with storage.write_transaction(self.writer, attempts=2, first_delay=0.001):
+                pass
+        self.assertFalse(self.writer.in_transaction)
+
+    def test_readers_do_not_wait_for_writer(self):
+        with storage.write_transaction(self.writer):
+            make_payment().insert_data(self.writer)
+            self.assertEqual(storage.Payment.length(self.other), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -129,10 +129,6 @@ function count_reservations {
     sql_query "SELECT COUNT(*) FROM reservations;"
 }
 
-function count_csrfs {
-    sql_query "SELECT COUNT(*) FROM csrfs;"
-}
-
 function count_payments {
     sql_query "SELECT COUNT(*) FROM payments;"
 }
@@ -141,17 +137,14 @@ function count_active_payments {
     sql_query "SELECT COUNT(*) FROM payments WHERE active=1;"
 }
 
-function get_user_of_csrf_token {
-    sql_query "SELECT user FROM csrfs WHERE token='$1';"
-}
-
-function get_remote_addr_of_csrf_token {
-    sql_query "SELECT ip FROM csrfs WHERE token='$1';"
-}
-
+# Token that the local CGI scripts issue to user $1 at address $2 (default
+# 1.2.3.4): the tokens are signed, not stored in the DB (see Csrf in
+# storage.py).
 function get_csrf_token_of_user {
-    # Ignores IP address... but there should be only one anyway.
-    sql_query "SELECT token FROM csrfs WHERE user='$1' ORDER BY timestamp DESC LIMIT 1;"
+    (cd "$app_dir" \
+         && env TEMP="$test_dir" CONFIGURATION_JSON_DIR="$test_dir" \
+                python3 -c 'import sys, config, storage; print(storage.Csrf.get_by_user_and_ip(storage.create_db(config.get_configuration()), *sys.argv[1:]).token)' \
+                "$1" "${2:-1.2.3.4}")
 }
 
 function get_bank_id_from_reservation_uuid {
@@ -221,9 +214,6 @@ function generic_test_valid_reservation_for_test_date
        ]; then
         die "test_$test_name: Wrong data saved in DB"
     fi
-    if [ "$(count_csrfs)" -gt "1" ]; then
-        die "test_$test_name: CSRF problem: new CSRF token created."
-    fi
     echo "test_$test_name: ok"
 }
 
@@ -411,7 +401,6 @@ function test_01_local_post_reservation
     bank_id="$(sed -n -e '/^Location: /s/.*bank_id=\([0-9]*\).*/\1/p' "$test_output")"
     [ -z "$bank_id" ] && die "No bank_id in $test_output"
     [ "$(count_reservations)" -eq 1 ] || die "Reservation count wrong"
-    [ "$(count_csrfs)" -eq 0 ] || die "CSRF count wrong"
     [ "$(count_payments)" -eq 0 ] || die "Payment count wrong"
     test_output="$(capture_cgi_output --output "$test_output" "$test_name" GET show_reservation.cgi "bank_id=$bank_id&uuid_hex=$uuid_hex")"
     assert_html_response "$test_name" "$test_output" \
@@ -422,7 +411,6 @@ function test_01_local_post_reservation
                          "$bank_id" \
                          "$uuid_hex"
     [ "$(count_reservations)" -eq 1 ] || die "$test_name: Reservation count wrong"
-    [ "$(count_csrfs)" -eq 0 ] || die "$test_name: CSRF count wrong"
     [ "$(count_payments)" -eq 0 ] || die "$test_name: Payment count wrong"
     echo "$test_name: ok"
 }
@@ -444,7 +432,7 @@ function test_02_local_list_empty_payments
             > "$test_output"
     fi
     do_diff "$test_output"
-    if [ "$(count_csrfs)" -ne "1" -o "$(get_user_of_csrf_token "$csrf_token")" != "$admin_user" ]; then
+    if [ "$csrf_token" != "$(get_csrf_token_of_user "$admin_user")" ]; then
         die "$test_name: CSRF problem."
     fi
     echo "test_02_local_list_empty_payments: ok"
@@ -456,7 +444,6 @@ function test_03_local_list_reservations__1_reservation
     test_name="03_local_list_reservations__1_reservation"
     test_output="$(capture_admin_cgi_output "$test_name" GET list_reservations.cgi "")"
     [ "$(count_reservations)" -eq 1 ] || die "$test_name: Reservation count wrong"
-    [ "$(count_csrfs)" -eq 1 ] || die "$test_name: CSRF count wrong"
     [ "$(count_payments)" -eq 0 ] || die "$test_name: Payment count wrong"
     csrf_token="$(get_csrf_token_of_user "$admin_user")"
     [ -n "$csrf_token" ] || die "Unable to get csrf_token of $admin_user"
@@ -472,7 +459,6 @@ function test_04_local_export_reservations_csv__1_reservation
     test_name="04_local_export_reservations_csv__1_reservation"
     test_output="$(capture_admin_cgi_output --output "$test_dir/$test_name.csv" "$test_name" GET export_csv.cgi '')"
     [ "$(count_reservations)" -eq 1 ] || die "$test_name: Reservation count wrong"
-    [ "$(count_csrfs)" -eq 1 ] || die "$test_name: CSRF count wrong"
     [ "$(count_payments)" -eq 0 ] || die "$test_name: Payment count wrong"
     csrf_token="$(get_csrf_token_of_user "$admin_user")"
     [ -n "$csrf_token" ] || die "Unable to get csrf_token of $admin_user"
@@ -491,7 +477,6 @@ function test_05_local_add_unchecked_reservation
     [ -n "$csrf_token" ] || die "$test_name: Unable to get csrf_token of $admin_user before POST"
     test_output="$(capture_admin_cgi_output "$test_name" POST "add_unchecked_reservation.cgi" 'csrf_token='"$csrf_token"'&last_name=cmdlinename&comment=fromcmdline&date=2099-01-01&paying_seats=3&free_seats=4')"
     [ "$(count_reservations)" -eq 2 ] || die "$test_name: Reservation count wrong"
-    [ "$(count_csrfs)" -eq 1 ] || die "$test_name: CSRF count wrong"
     [ "$(count_payments)" -eq 0 ] || die "$test_name: Payment count wrong"
     grep -q '^Status: 302' "$test_output" || die "$test_name: not a redirection"
     bank_id="$(sed -ne 's/.*bank_id=\([0-9]*\).*/\1/p' "$test_output")"
@@ -504,7 +489,6 @@ function test_05_local_add_unchecked_reservation
 
 # 01: List reservations when DB is still empty, then
 # - Verify output HTML
-# - Verify CSRF is in DB
 # - Verify reservations is empty
 function test_01_list_empty_reservations
 {
@@ -525,16 +509,12 @@ function test_01_list_empty_reservations
     if [ "$(count_reservations)" != "0" ]; then
         die "Reservations table is not empty."
     fi
-    if [ "$(count_csrfs)" -gt "1" -o "$(get_user_of_csrf_token "$csrf_token")" != "$admin_user" ]; then
-        die "CSRF problem."
-    fi
     echo "test_01_list_empty_reservations: ok"
 }
 
 # 02: Attempt to register for an invalid date
 # - Verify output HTML
 # - Verify reservations is still empty
-# - No new CSRF token
 function test_02_invalid_date_for_reservation
 {
     local test_output
@@ -545,16 +525,12 @@ function test_02_invalid_date_for_reservation
     if [ "$(count_reservations)" != "0" ]; then
         die "test_02_invalid_date_for_reservation: Reservations table is not empty."
     fi
-    if [ "$(count_csrfs)" -gt "1" ]; then
-        die "test_02_invalid_date_for_reservation: CSRF problem: new CSRF token created."
-    fi
     echo "test_02_invalid_date_for_reservation: ok"
 }
 
 # 03: Register for a test date
 # - Verify output HTML
 # - Verify reservations contains 1 row with correct information
-# - No new CSRF token
 function test_03_valid_reservation_for_test_date
 {
     generic_test_valid_reservation_for_test_date 03_valid_reservation_for_test_date \
@@ -564,16 +540,12 @@ function test_03_valid_reservation_for_test_date
 
 function test_03_00_locally_upload_payments
 {
-    local test_name test_output uuid_hex content_boundary row_count bank_transaction_number csrf_token remote_addr year_prefix
+    local test_name test_output uuid_hex content_boundary row_count bank_transaction_number csrf_token year_prefix
     test_name="test_03_00_locally_upload_payments"
     csrf_token="$(get_csrf_token_of_user "$admin_user")"
     if [ -z "$csrf_token" ]; then
        die "$test_name no CSRF token generated for $admin_user"
     fi
-    remote_addr="$(get_remote_addr_of_csrf_token "$csrf_token")"
-    if [ -z "$remote_addr" ]; then
-       die "$test_name no REMOTE_ADDR generated for $admin_user"
-    fi
     uuid_hex="$(sql_query 'select uuid from reservations where last_name="TestName" limit 1')"
     if [ -z "$uuid_hex" ]; then
         die "$test_name Unable to find reservation uuid"
@@ -603,7 +575,7 @@ Content-Disposition: form-data; name=\"submit\"
 Importer les extraits de compte
 --${content_boundary}--
 "
-    test_output="$(capture_admin_cgi_output --remote-addr "${remote_addr}" "${test_name}" POST import_payments.cgi "" CONTENT_TYPE="multipart/form-data; boundary=$content_boundary")"
+    test_output="$(capture_admin_cgi_output "${test_name}" POST import_payments.cgi "" CONTENT_TYPE="multipart/form-data; boundary=$content_boundary")"
     export CONTENT_STDIN=""
     grep -q "^Status: 302" "$test_output" || die "$test_name No Status: 302 redirect in $test_output"
     target="gestion/list_payments.cgi"
@@ -617,16 +589,12 @@ Importer les extraits de compte
 
 function test_03_01_locally_hide_payment
 {
-    local test_name test_output uuid_hex content_boundary row_count bank_ref csrf_token remote_addr year_prefix
+    local test_name test_output uuid_hex content_boundary row_count bank_ref csrf_token year_prefix
     test_name="test_03_01_locally_hide_payment"
     csrf_token="$(get_csrf_token_of_user "$admin_user")"
     if [ -z "$csrf_token" ]; then
        die "$test_name no CSRF token generated for $admin_user"
     fi
-    remote_addr="$(get_remote_addr_of_csrf_token "$csrf_token")"
-    if [ -z "$remote_addr" ]; then
-       die "$test_name no REMOTE_ADDR generated for $admin_user"
-    fi
     uuid_hex="$(sql_query 'select uuid from reservations where last_name="TestName" limit 1')"
     if [ -z "$uuid_hex" ]; then
         die "$test_name Unable to find reservation uuid"
@@ -648,7 +616,7 @@ Content-Disposition: form-data; name=\"submit\"
 Importer les extraits de compte
 --${content_boundary}--
 "
-    test_output="$(capture_admin_cgi_output --remote-addr "${remote_addr}" "${test_name}" POST hide_payment.cgi "" CONTENT_TYPE="multipart/form-data; boundary=$content_boundary")"
+    test_output="$(capture_admin_cgi_output "${test_name}" POST hide_payment.cgi "" CONTENT_TYPE="multipart/form-data; boundary=$content_boundary")"
     export CONTENT_STDIN=""
     grep -q "^Status: 302" "$test_output" || die "$test_name No Status: 302 redirect in $test_output"
     target="gestion/list_payments.cgi"
@@ -668,7 +636,6 @@ Importer les extraits de compte
 # 04: Register for Saturday
 # - Verify output HTML
 # - Verify reservations contains 1 row with correct information
-# - No new CSRF token
 function test_04_valid_reservation_for_saturday
 {
     generic_test_valid_reservation_for_test_date 04_valid_reservation_for_saturday \
@@ -679,7 +646,6 @@ function test_04_valid_reservation_for_saturday
 # 05: Register for Sunday
 # - Verify output HTML
 # - Verify reservations contains 1 row with correct information
-# - No new CSRF token
 function test_05_valid_reservation_for_sunday
 {
     generic_test_valid_reservation_for_test_date 05_valid_reservation_for_sunday \
@@ -689,7 +655,6 @@ function test_05_valid_reservation_for_sunday
 
 # 06: List reservations with new content, limit & sorting options
 # - Verify output HTML
-# - Verify CSRF is in DB (no new CSRF token created)
 function test_06_list_reservations
 {
     local test_output csrf_token
@@ -700,9 +665,6 @@ function test_06_list_reservations
     if [ "$(count_reservations)" != "3" ]; then
         die "Reservations table wrong."
     fi
-    if [ "$(count_csrfs)" -gt "1" -o "$(get_user_of_csrf_token "$csrf_token")" != "$admin_user" ]; then
-        die "CSRF problem."
-    fi
     make_list_reservations_output_deterministic "$test_output.tmp" > "$test_output"
     do_diff "$test_output"
     echo "test_06_list_reservations: ok"
@@ -710,7 +672,6 @@ function test_06_list_reservations
 
 # 07: Admin tries to create new reservation without CSRF token
 # - Verify output HTML
-# - Verify CSRF is in DB (no new CSRF token created)
 function test_07_new_reservation_without_CSRF_token_fails
 {
     generic_test_new_reservation_without_valid_CSRF_token_fails 07_new_reservation_without_CSRF_token_fails ""
@@ -718,7 +679,6 @@ function test_07_new_reservation_without_CSRF_token_fails
 
 # 08: Admin tries to create new reservation with wrong CSRF token
 # - Verify output HTML
-# - Verify CSRF is in DB (no new CSRF token created)
 function test_08_new_reservation_with_wrong_CSRF_token_fails
 {
     generic_test_new_reservation_without_valid_CSRF_token_fails 08_new_reservation_without_CSRF_token_fails "-F csrf_token=deadbeefc0ffeeb01"
@@ -726,13 +686,13 @@ function test_08_new_reservation_with_wrong_CSRF_token_fails
 
 # 09: Admin creates new reservation with correct CSRF token
 # - Verify output HTML
-# - Verify CSRF is in DB (no new CSRF token created)
 # - Verify new data created
 function test_09_new_reservation_with_correct_CSRF_token_succeeds
 {
     local test_output csrf_token bank_id formatted_communication uuid_hex
     test_output="$test_dir/09_new_reservation_with_correct_CSRF_token_succeeds.html"
-    csrf_token="$(get_csrf_token_of_user "$admin_user")"
+    do_curl_as_admin 'gestion/list_reservations.cgi' "$test_output.form"
+    csrf_token="$(sed -n -e 's/.*csrf_token" value="\([a-f0-9A-F]*\)".*/\1/p' "$test_output.form")"
     do_curl_with_redirect --admin \
                           'gestion/add_unchecked_reservation.cgi' \
                           "$test_output.tmp" \
@@ -750,9 +710,6 @@ function test_09_new_reservation_with_correct_CSRF_token_succeeds
         die "test_09_new_reservation_with_correct_CSRF_token_succeeds: uuid hex not in link or link not found"
     fi
     get_db_file
-    if [ "$(count_csrfs)" -gt "1" ]; then
-        die ": CSRF problem: new CSRF token created."
-    fi
     if [ "$(count_reservations)" != "4" ]; then
         die "test_09_new_reservation_with_correct_CSRF_token_succeeds: Reservations table should contain $total_reservations_count row."
     fi
@@ -804,7 +761,6 @@ function test_11_deactivate_a_reservation
 # 12: Register with a name with special characters to test HTML escaping & SQL injection resistence
 # - Verify output HTML
 # - Verify reservations contains 1 row with correct information
-# - No new CSRF token
 # - Verify updated administrative list
 function test_12_bobby_tables_and_co
 {
@@ -827,9 +783,6 @@ function test_12_bobby_tables_and_co
     sql_query 'select email,last_name from reservations where email like "%body%html%"' \
               > "$sql_output"
     do_diff "$sql_output"
-    if [ "$(count_csrfs)" -gt "1" -o "$(get_user_of_csrf_token "$csrf_token")" != "$admin_user" ]; then
-        die "CSRF problem."
-    fi
     make_list_reservations_output_deterministic "$test_output.tmp" > "$test_output"
     do_diff "$test_output"
     echo "test_12_bobby_tables_and_co: ok"